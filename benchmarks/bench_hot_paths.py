@@ -0,0 +1,140 @@
+"""
+Times the processing stages that don't need a network on synthetic rides of growing size
+and records the peak memory of every stage with tracemalloc.
+
+    python benchmarks/bench_hot_paths.py [--sizes 1000 10000 100000 1000000] [--stages ...]
+                                         [--repeat 3] [--output benchmarks/results] [--compare earlier.json]
+
+Results are saved as JSON, --compare prints the change against an earlier run.
+Timings are taken without tracemalloc, the memory of a stage is measured in an extra run.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+# facilitate imports from project root
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from chase_rank.match import load_gpx  # noqa: E402
+from chase_rank.process import from_track_match, get_section_analytics, surface_stats  # noqa: E402
+from chase_rank.wrappers.valhalla_handler import ValhallaHandler  # noqa: E402
+from synthetic import synthetic_match, synthetic_ride, write_gpx  # noqa: E402
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+STAGES = ["load_gpx", "split_track", "_combine_data", "get_section_analytics", "surface_stats"]
+RESULTS_PATH = Path(__file__).resolve().parent / "results"
+
+# the distance calculations shift geo frames and warn about the missing crs of the shifted copy on every call
+warnings.filterwarnings("ignore", message="CRS not set for some of the concatenation inputs")
+
+
+def prepare(size: int, work_path: Path) -> Dict:
+    # inputs of every stage, built from the outputs of the previous ones outside of the measurements
+    track = synthetic_ride(size)
+    gpx_path = Path(work_path, f"synthetic_{size}.gpx")
+    write_gpx(track, gpx_path)
+    edges, shape, trace_df = synthetic_match(track)
+    edges_df = ValhallaHandler._load_edges(edges, shape)
+    split_track = ValhallaHandler.split_track(track)
+    points_df = from_track_match(ValhallaHandler._combine_data(split_track, trace_df, edges_df))
+    return {
+        "load_gpx": (load_gpx, (gpx_path,)),
+        "split_track": (ValhallaHandler.split_track, (track,)),
+        "_combine_data": (ValhallaHandler._combine_data, (split_track, trace_df, edges_df)),
+        "get_section_analytics": (get_section_analytics, (points_df,)),
+        "surface_stats": (surface_stats, (points_df,)),
+    }
+
+
+def measure(function: Callable, args: tuple, repeat: int) -> Dict:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": min(seconds),
+        "mean_seconds": float(np.mean(seconds)),
+        "peak_mb": peak / 2 ** 20,
+    }
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=Path(__file__).resolve().parent
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def run(sizes: List[int], stages: List[str], repeat: int) -> List[Dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as work_path:
+        for size in sizes:
+            inputs = prepare(size, Path(work_path))
+            for stage in stages:
+                function, args = inputs[stage]
+                result = {"stage": stage, "points": size, **measure(function, args, repeat)}
+                print(f"{stage:>22} {size:>9} points {result['seconds']:9.3f}s {result['peak_mb']:9.1f}MB")
+                results.append(result)
+    return results
+
+
+def compare(results: List[Dict], earlier_path: Path) -> pd.DataFrame:
+    earlier = pd.DataFrame(json.loads(earlier_path.read_text())["results"]).set_index(["stage", "points"])
+    current = pd.DataFrame(results).set_index(["stage", "points"])
+    comparison = current[["seconds", "peak_mb"]].join(
+        earlier[["seconds", "peak_mb"]], rsuffix="_earlier", how="inner")
+    # above 1 means the current run is faster / needs less memory
+    comparison["speedup"] = comparison["seconds_earlier"] / comparison["seconds"]
+    comparison["memory_ratio"] = comparison["peak_mb_earlier"] / comparison["peak_mb"]
+    return comparison.round(3)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", type=Path, default=RESULTS_PATH)
+    parser.add_argument("--compare", type=Path, default=None)
+    arguments = parser.parse_args()
+
+    report = {**environment(), "repeat": arguments.repeat, "results": run(
+        arguments.sizes, arguments.stages, arguments.repeat)}
+
+    arguments.output.mkdir(parents=True, exist_ok=True)
+    report_path = Path(arguments.output, f"hot_paths_{datetime.now():%Y%m%d_%H%M%S}.json")
+    report_path.write_text(json.dumps(report, indent=2))
+    print(f"saved {report_path}")
+
+    if arguments.compare:
+        print(compare(report["results"], arguments.compare).to_string())
@@ -0,0 +1,60 @@
+"""
+Measures how long typical entry points take to import, every run in a fresh interpreter.
+
+    python benchmarks/bench_import_time.py [runs]
+
+Besides the time it lists which of the heavy dependencies each import pulled in.
+"from chase_rank.wrappers import *" loads every handler and shows the cost of the old eager package.
+"""
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+
+STATEMENTS = [
+    "from chase_rank.wrappers import StravaUserHandler",
+    "from chase_rank.wrappers import StravaHandler",
+    "from chase_rank.wrappers import TrackHandler",
+    "from chase_rank.wrappers import ValhallaHandler",
+    "from chase_rank.wrappers import ActivityHandler, MatchHandler",
+    "import chase_rank.pipeline",
+    "from chase_rank.wrappers import *",
+]
+HEAVY_MODULES = [
+    "numpy", "pandas", "geopandas", "shapely", "pyproj", "pyarrow", "requests",
+    "routingpy", "geopy", "gpxpy", "osmium", "overpy", "rasterio", "prometheus_client",
+]
+
+# runs in the fresh interpreter, prints the seconds and the loaded heavy modules as JSON
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+exec({statement!r})
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+
+def measure(statement: str, runs: int) -> (float, list):
+    seconds = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(statement=statement, heavy=HEAVY_MODULES)],
+            capture_output=True, text=True, check=True, cwd=ROOT_PATH
+        ).stdout
+        run_seconds, loaded = json.loads(output.strip().splitlines()[-1])
+        seconds.append(run_seconds)
+    return statistics.median(seconds), loaded
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    # the first run warms the bytecode cache
+    measure(STATEMENTS[-1], 1)
+    for statement in STATEMENTS:
+        median_seconds, loaded = measure(statement, runs)
+        print(f"{statement:<62} {median_seconds * 1000:7.0f}ms  {', '.join(loaded) or '-'}")
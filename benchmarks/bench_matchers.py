@@ -0,0 +1,142 @@
+"""
+Compares valhalla and OSRM on the same tracks: throughput, latency per track and how well the matches agree.
+
+    python benchmarks/bench_matchers.py [--valhalla http://127.0.0.1:8002] [--osrm http://127.0.0.1:5000]
+                                        [--tracks ../data/tracks | --count 20 --size 3600]
+                                        [--concurrency 4] [--output benchmarks/results]
+
+Both engines have to run with the same extract (bin/run_valhalla.ps1, bin/run_osrm.ps1) and OSRM needs
+the way node index (way_categorizer.build_way_node_index) to report way ids.
+Without --tracks synthetic rides around Stuttgart are used, which only make sense for throughput:
+they don't follow real roads.
+Agreement is the share of points both engines matched to the same osm way.
+"""
+import argparse
+import json
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import geopandas as gpd
+import numpy as np
+
+# facilitate imports from project root
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from chase_rank.wrappers.matcher import Matcher  # noqa: E402
+from chase_rank.wrappers.osrm_handler import OSRMHandler  # noqa: E402
+from chase_rank.wrappers.valhalla_handler import ValhallaHandler  # noqa: E402
+from synthetic import synthetic_ride  # noqa: E402
+
+RESULTS_PATH = Path(__file__).resolve().parent / "results"
+
+warnings.filterwarnings("ignore", message="CRS not set for some of the concatenation inputs")
+
+
+def load_tracks(tracks_path: Path, count: int, size: int) -> Dict[str, gpd.GeoDataFrame]:
+    if tracks_path is not None:
+        return {path.stem: gpd.read_parquet(path) for path in sorted(tracks_path.glob("*.parquet"))[:count]}
+    return {f"synthetic_{seed}": synthetic_ride(size, seed=seed) for seed in range(count)}
+
+
+def run_engine(matcher: Matcher, tracks: Dict[str, gpd.GeoDataFrame], concurrency: int) -> (Dict, Dict):
+    matches = {}
+    seconds = {}
+
+    def match(name: str):
+        start = time.perf_counter()
+        try:
+            matches[name] = matcher.match(tracks[name])
+        except Exception as e:
+            print(f"  {name} failed: {e}")
+            matches[name] = None
+        seconds[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(match, tracks))
+    wall_seconds = time.perf_counter() - start
+
+    latencies = np.array(list(seconds.values()))
+    points = sum(len(track) for track in tracks.values())
+    matched = [match for match in matches.values() if match is not None]
+    matched_points = sum(int(match["osm_way_id"].notnull().sum()) for match in matched)
+    return matches, {
+        "tracks": len(tracks),
+        "failed_tracks": len(tracks) - len(matched),
+        "wall_seconds": round(wall_seconds, 3),
+        "points_per_second": round(points / wall_seconds, 1),
+        "median_seconds": round(float(np.median(latencies)), 3),
+        "p95_seconds": round(float(np.percentile(latencies, 95)), 3),
+        "matched_share": round(matched_points / points, 4),
+    }
+
+
+def agreement(first: Dict, second: Dict) -> Dict:
+    both_matched = 0
+    same_way = 0
+    points = 0
+    for name, first_match in first.items():
+        second_match = second.get(name)
+        if first_match is None or second_match is None:
+            continue
+        first_ways = first_match["osm_way_id"].values
+        second_ways = second_match["osm_way_id"].values
+        matched = ~np.isnan(first_ways) & ~np.isnan(second_ways)
+        points += len(first_ways)
+        both_matched += int(matched.sum())
+        same_way += int((first_ways[matched] == second_ways[matched]).sum())
+    return {
+        "points": points,
+        "both_matched_share": round(both_matched / points, 4) if points else None,
+        # among the points matched by both engines
+        "same_way_share": round(same_way / both_matched, 4) if both_matched else None,
+    }
+
+
+def main(engines: Dict[str, Matcher], tracks: Dict[str, gpd.GeoDataFrame], concurrency: int) -> Dict:
+    matches = {}
+    results = {}
+    for name, matcher in engines.items():
+        print(f"{name}: matching {len(tracks)} tracks")
+        matches[name], results[name] = run_engine(matcher, tracks, concurrency)
+        print(f"  {results[name]}")
+    names: List[str] = list(engines)
+    report = {"engines": results}
+    if len(names) == 2:
+        report["agreement"] = agreement(matches[names[0]], matches[names[1]])
+        print(f"agreement: {report['agreement']}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--valhalla", nargs="*", default=["http://127.0.0.1:8002"])
+    parser.add_argument("--osrm", nargs="*", default=["http://127.0.0.1:5000"])
+    parser.add_argument("--tracks", type=Path, default=None)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--size", type=int, default=3600)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output", type=Path, default=RESULTS_PATH)
+    arguments = parser.parse_args()
+
+    engines = {}
+    if arguments.valhalla:
+        engines["valhalla"] = ValhallaHandler(arguments.valhalla)
+    if arguments.osrm:
+        engines["osrm"] = OSRMHandler(arguments.osrm)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "concurrency": arguments.concurrency,
+        **main(engines, load_tracks(arguments.tracks, arguments.count, arguments.size), arguments.concurrency)
+    }
+
+    arguments.output.mkdir(parents=True, exist_ok=True)
+    report_path = Path(arguments.output, f"matchers_{datetime.now():%Y%m%d_%H%M%S}.json")
+    report_path.write_text(json.dumps(report, indent=2))
+    print(f"saved {report_path}")
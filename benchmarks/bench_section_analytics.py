@@ -0,0 +1,92 @@
+"""
+Compares get_section_analytics with the previous row by row implementation on a 50k point track.
+
+    python benchmarks/bench_section_analytics.py [points]
+"""
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# facilitate imports from project root
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from chase_rank.process import get_section_analytics  # noqa: E402
+
+
+def reference_section_analytics(gpx_frame: pd.DataFrame) -> pd.DataFrame:
+    # the loop based implementation get_section_analytics replaced
+    last_time = None
+    section_dict = {
+        "section": [],
+        "paused_time": [],
+        "total_asc": [],
+        "total_desc": [],
+        "total_distance": [],
+        "arg_kph": [],
+        "distance_between_stops": []
+    }
+
+    for index, group in gpx_frame.groupby(gpx_frame["section"]):
+        paused_time = group.iloc[0]["time"] - last_time if last_time else timedelta(days=0)
+        last_time = group.iloc[-1]["time"]
+        section_dict["section"].append(index)
+        section_dict["paused_time"].append(paused_time)
+
+        total_asc = 0
+        total_desc = 0
+        for i in range(0, len(group) - 1):
+            a = i + 1
+            diff = group.iloc[a]["elev"] - group.iloc[i]["elev"]
+            if diff >= 0:
+                total_asc = total_asc + diff
+            elif diff <= 0:
+                total_desc = total_desc + diff
+
+        section_dict["total_asc"].append(round(total_asc, 2))
+        section_dict["total_desc"].append(round(total_desc, 2))
+
+        distance = group["distance"].sum()
+        avrg_kph = distance / len(group) * 3.6
+        section_dict["total_distance"].append(round(distance, 2))
+        section_dict["arg_kph"].append(round(avrg_kph, 2))
+        section_dict["distance_between_stops"].append(group.iloc[-1]["distance"])
+
+    return pd.DataFrame(data=section_dict)
+
+
+def synthetic_points(size: int, seed: int = 0) -> pd.DataFrame:
+    # 1s intervals with a pause every few thousand points
+    rng = np.random.default_rng(seed)
+    steps = np.ones(size, dtype=np.int64)
+    steps[rng.choice(size, size // 2000, replace=False)] = rng.integers(30, 600, size // 2000)
+    times = np.datetime64("2022-10-23T12:00:00") + np.cumsum(steps).astype("timedelta64[s]")
+    frame = pd.DataFrame({
+        "time": times,
+        "elev": 300 + np.cumsum(rng.normal(0, 0.3, size)),
+        "distance": rng.gamma(4, 2, size),
+    })
+    frame["section"] = (frame["time"].diff() != pd.Timedelta("1 second")).cumsum()
+    return frame
+
+
+def timed(function, *args) -> (float, object):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    points = synthetic_points(size)
+
+    reference_seconds, reference = timed(reference_section_analytics, points)
+    vectorized_seconds, vectorized = timed(get_section_analytics, points)
+
+    pd.testing.assert_frame_equal(reference, vectorized, check_dtype=False)
+    print(f"{size} points, {len(vectorized)} sections")
+    print(f"reference:  {reference_seconds:8.3f}s")
+    print(f"vectorized: {vectorized_seconds:8.3f}s ({reference_seconds / vectorized_seconds:.0f}x)")
@@ -0,0 +1,138 @@
+"""
+Runs ValhallaHandler against local stand-in valhalla servers to check the balancing and health checks.
+
+    python benchmarks/bench_valhalla_pool.py [--backends 3] [--requests 600] [--concurrency 12] [--latency 0.02]
+
+The stand-ins answer /trace_attributes after a fixed latency and /status right away.
+Three scenarios are run on the same request load:
+  - single: one backend, the baseline of the old handler
+  - pool: all backends, one of them twice as slow, it should get fewer requests
+  - failover: a backend is stopped in the middle of the run and started again later,
+    it has to be ejected without failing requests and re-admitted by the probes
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# facilitate imports from project root
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from chase_rank.wrappers.valhalla_handler import ValhallaHandler  # noqa: E402
+
+# smallest answer that makes it through ValhallaHandler._request
+TRACE_ATTRIBUTES = json.dumps({"edges": [], "matched_points": [], "shape": ""}).encode()
+LOCATIONS = [(9.18, 48.78), (9.181, 48.781), (9.182, 48.782)]
+
+
+class StandIn:
+    """
+    A stand-in valhalla on a local port that can be stopped and started again on the same port.
+    """
+
+    def __init__(self, latency: float, port: int = 0):
+        self.latency = latency
+        self.port = port
+        self.server: ThreadingHTTPServer = None
+        self.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _handler(self):
+        latency = self.latency
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self, body: bytes):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._answer(b'{"version": "stand-in"}')
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(latency)
+                self._answer(TRACE_ATTRIBUTES)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_load(handler: ValhallaHandler, requests: int, concurrency: int) -> dict:
+    failed = 0
+    # += on a shared int isn't atomic between the threads of the executor
+    lock = threading.Lock()
+
+    def request(_):
+        nonlocal failed
+        try:
+            handler._match_section(LOCATIONS)
+        except Exception:
+            with lock:
+                failed += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(request, range(requests)))
+    seconds = time.perf_counter() - start
+    return {"seconds": round(seconds, 3), "requests_per_second": round(requests / seconds, 1), "failed": failed}
+
+
+def scenario(name: str, handler: ValhallaHandler, requests: int, concurrency: int, during=None):
+    if during is not None:
+        threading.Thread(target=during, daemon=True).start()
+    result = run_load(handler, requests, concurrency)
+    print(f"\n{name}: {result}")
+    print(handler.backend_report().drop(columns=["last_probe"]).to_string())
+    handler.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--concurrency", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=0.02)
+    arguments = parser.parse_args()
+
+    # the last stand-in is twice as slow as the others
+    stand_ins = [StandIn(arguments.latency) for _ in range(arguments.backends - 1)]
+    stand_ins.append(StandIn(arguments.latency * 2))
+    urls = [stand_in.url for stand_in in stand_ins]
+
+    scenario("single", ValhallaHandler(urls[0]), arguments.requests, arguments.concurrency)
+    scenario("pool", ValhallaHandler(urls), arguments.requests, arguments.concurrency)
+
+    def restart_first():
+        time.sleep(0.2)
+        stand_ins[0].stop()
+        time.sleep(1.)
+        stand_ins[0].start()
+
+    scenario(
+        "failover",
+        ValhallaHandler(urls, timeout=1., probe_interval=0.25, max_failures=1, eject_seconds=5.),
+        arguments.requests * 2, arguments.concurrency, during=restart_first
+    )
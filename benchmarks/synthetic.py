@@ -0,0 +1,129 @@
+"""
+Synthetic rides for benchmarks, shaped like the tracks of TrackHandler.
+
+Rides are recorded every second with a few smartphone hiccups, stop at crossings and for breaks
+(some recorders keep logging while standing, others pause), wobble around the real position
+with GPS jitter and change surface every few hundred meters.
+Everything is generated from a seed, the same size and seed always produce the same ride.
+"""
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from chase_rank.way_categorizer import VALHALLA_SURFACES
+
+START = np.datetime64("2022-10-23T09:00:00")
+# meters per degree of latitude, good enough to move a synthetic rider around
+METERS_PER_DEGREE = 111_320.
+
+
+def synthetic_ride(size: int, seed: int = 0, latitude: float = 48.78, longitude: float = 9.18) -> gpd.GeoDataFrame:
+    """
+    Creates a ride with size points as TrackHandler stores them:
+    latitude, longitude, altitude, timestamp and geometry in EPSG:3857.
+    """
+    rng = np.random.default_rng(seed)
+
+    # mostly 1s intervals, smartphones sometimes skip a few seconds
+    steps = np.ones(size, dtype=np.int64)
+    hiccups = rng.random(size) < 0.01
+    steps[hiccups] = rng.integers(2, 6, hiccups.sum())
+    # short stops at crossings and a few longer breaks without any points
+    stops = rng.random(size) < 1 / 600
+    steps[stops] = rng.integers(10, 90, stops.sum())
+    breaks = rng.random(size) < 1 / 20_000
+    steps[breaks] = rng.integers(600, 3600, breaks.sum())
+    steps[0] = 0
+    timestamps = START + np.cumsum(steps).astype("timedelta64[s]")
+
+    # speed changes slowly, standing still while the recorder keeps logging at a red light
+    speed = np.clip(rng.normal(7, 0.3, size) + 3 * np.sin(np.cumsum(rng.normal(0, 0.01, size))), 1, 14)
+    standing = np.repeat(rng.random(size // 120 + 1) < 0.05, 120)[:size]
+    speed[standing] = 0.
+    heading = np.cumsum(rng.normal(0, 0.05, size))
+    north = np.cumsum(speed * np.cos(heading))
+    east = np.cumsum(speed * np.sin(heading))
+
+    # gps jitter of a few meters and rare jumps far off the road
+    jitter = rng.normal(0, 3, (2, size))
+    outliers = rng.random(size) < 1 / 5000
+    jitter[:, outliers] += rng.normal(0, 150, (2, outliers.sum()))
+    latitudes = latitude + (north + jitter[0]) / METERS_PER_DEGREE
+    longitudes = longitude + (east + jitter[1]) / (METERS_PER_DEGREE * np.cos(np.radians(latitude)))
+
+    altitude = 250 + np.cumsum(rng.normal(0, 0.08, size)) + rng.normal(0, 0.5, size)
+
+    return gpd.GeoDataFrame(
+        {
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "altitude": altitude,
+            "timestamp": timestamps,
+        },
+        geometry=gpd.points_from_xy(longitudes, latitudes),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3857")
+
+
+def synthetic_match(track: gpd.GeoDataFrame, seed: int = 0) -> Tuple[List[Dict], List[Tuple], pd.DataFrame]:
+    """
+    Fakes the answer of valhalla for a track: edges like in the trace_attributes response,
+    the decoded match shape and a trace frame with the edge_index of every point.
+    Edges are 100m to 1km long, a few points can't be matched at all.
+    """
+    rng = np.random.default_rng(seed)
+    size = len(track)
+
+    edge_starts = [0]
+    while edge_starts[-1] < size:
+        # at about 7m/s an edge of 100m to 1km takes 15 to 150 points
+        edge_starts.append(edge_starts[-1] + int(rng.integers(15, 150)))
+    edge_starts = np.array(edge_starts[:-1])
+    edge_count = len(edge_starts)
+
+    # surfaces come in runs of a few edges
+    surface_runs = np.repeat(rng.integers(0, len(VALHALLA_SURFACES) - 1, edge_count // 3 + 1), 3)[:edge_count]
+    uses = rng.choice(["road", "cycleway", "track", "path", "service_road"], edge_count)
+
+    shape = list(zip(track["longitude"].values.tolist(), track["latitude"].values.tolist()))
+    edge_ends = np.append(edge_starts[1:], size - 1)
+    edges = [{
+        "length": float(rng.uniform(0.1, 1.)),
+        "speed": 20,
+        "road_class": "residential",
+        "use": uses[index],
+        "unpaved": bool(surface_runs[index] >= VALHALLA_SURFACES.index("compacted")),
+        "surface": VALHALLA_SURFACES[surface_runs[index]],
+        "travel_mode": "bicycle",
+        "way_id": int(100_000_000 + index),
+        "begin_shape_index": int(begin),
+        "end_shape_index": int(end),
+    } for index, (begin, end) in enumerate(zip(edge_starts, edge_ends))]
+
+    edge_index = (np.searchsorted(edge_starts, np.arange(size), side="right") - 1).astype(np.float64)
+    edge_index[rng.random(size) < 0.01] = np.nan
+    trace_df = pd.DataFrame({
+        "lon": track["longitude"].values,
+        "lat": track["latitude"].values,
+        "type": "matched",
+        "edge_index": edge_index,
+    })
+    return edges, shape, trace_df
+
+
+def write_gpx(track: gpd.GeoDataFrame, path: Path):
+    # minimal GPX 1.1 like the exports of most recorders
+    times = np.datetime_as_string(track["timestamp"].values.astype("datetime64[s]"), unit="s")
+    points = "\n".join(
+        f'<trkpt lat="{latitude:.7f}" lon="{longitude:.7f}"><ele>{altitude:.1f}</ele><time>{time}Z</time></trkpt>'
+        for latitude, longitude, altitude, time in zip(
+            track["latitude"].values, track["longitude"].values, track["altitude"].values, times)
+    )
+    path.write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx version="1.1" creator="chase-rank benchmarks" xmlns="http://www.topografix.com/GPX/1/1">\n'
+        f"<trk><name>synthetic</name><trkseg>\n{points}\n</trkseg></trk>\n</gpx>\n"
+    )
@@ -0,0 +1,194 @@
+"""
+Pool of interchangeable HTTP backends, e.g. several valhalla or OSRM containers serving the same region.
+
+Requests go to the healthy backend with the least outstanding requests.
+Backends that fail max_failures times in a row are ejected for eject_seconds; afterwards they get
+a single trial request, which re-admits them on success. A background thread probes every backend
+periodically, so ejected backends come back as soon as they answer again.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from .instrumentation import record_http, request_size, span
+from .lazy import lazy_import
+
+requests = lazy_import("requests")
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # consecutive
+        self.ejections = 0
+        self.ejected_until = 0.
+        self.seconds = 0.
+        self.max_seconds = 0.
+        # exponentially weighted latency, breaks ties between backends with as many outstanding requests
+        self.latency = 0.
+        self.last_probe: bool = None
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def as_dict(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "url": self.url,
+            "healthy": self.available(now),
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.,
+            "ejections": self.ejections,
+            "mean_seconds": round(self.seconds / self.requests, 6) if self.requests else 0.,
+            "max_seconds": round(self.max_seconds, 6),
+            "latency": round(self.latency, 6),
+            "last_probe": self.last_probe,
+        }
+
+
+class BackendPool:
+    """
+    Least outstanding requests balancing with passive (failed requests) and active (probes) health checks.
+    probe gets a Backend and returns whether it is healthy, without a probe there is no background thread.
+    """
+
+    def __init__(self,
+                 urls: List[str],
+                 probe: Callable[[Backend], bool] = None,
+                 probe_interval: float = 10.,
+                 max_failures: int = 3,
+                 eject_seconds: float = 30.,
+                 latency_weight: float = 0.2):
+        if not urls:
+            raise ValueError("a backend pool needs at least one url")
+        self.backends = [Backend(url) for url in urls]
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.latency_weight = latency_weight
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._prober: threading.Thread = None
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def acquire(self, exclude: List[Backend] = ()) -> Backend:
+        # the probes start with the first request, so creating a handler never spawns threads
+        if self.probe is not None and self._prober is None:
+            self.start()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in exclude]
+            if not candidates:
+                candidates = self.backends
+            available = [backend for backend in candidates if backend.available(now)]
+            # with every backend ejected it's better to try one than to fail right away
+            backend = min(available or candidates, key=lambda b: (b.outstanding, b.latency))
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend: Backend, seconds: float, failed: bool = False):
+        with self._lock:
+            backend.outstanding -= 1
+            backend.requests += 1
+            backend.seconds += seconds
+            backend.max_seconds = max(backend.max_seconds, seconds)
+            backend.latency += self.latency_weight * (seconds - backend.latency)
+            if failed:
+                backend.errors += 1
+                backend.failures += 1
+                if backend.failures >= self.max_failures:
+                    self._eject(backend)
+            else:
+                backend.failures = 0
+                backend.ejected_until = 0.
+
+    def _eject(self, backend: Backend):
+        if backend.available(time.monotonic()):
+            backend.ejections += 1
+            logger.warning("ejecting %s after %s failures", backend.url, backend.failures)
+        backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    def request(self, service: str, method: str, path: str, timeout: float = None, **kwargs) -> requests.Response:
+        """
+        Sends the request to the least busy backend, connection errors, timeouts and server errors are retried
+        on the other backends. Raises the last error if no backend could be reached at all.
+        """
+        tried = []
+        last_error = None
+        while len(tried) < len(self.backends):
+            backend = self.acquire(exclude=tried)
+            tried.append(backend)
+            start = time.perf_counter()
+            try:
+                with span(service, "request"):
+                    response = requests.request(method=method, url=f"{backend.url}{path}", timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                # unreachable or too slow, the next backend gets a try
+                self.release(backend, time.perf_counter() - start, failed=True)
+                logger.warning("%s request to %s failed: %s", service, backend.url, e)
+                last_error = e
+                continue
+
+            # bad input is answered with 4xx, only server errors count against the backend
+            server_error = response.status_code >= 500
+            self.release(backend, time.perf_counter() - start, failed=server_error)
+            record_http(service, response.status_code, request_size(response.request), len(response.content))
+            if server_error and len(tried) < len(self.backends):
+                logger.warning("%s request to %s failed: %s, retrying", service, backend.url, response)
+                continue
+            return response
+        raise last_error
+
+    def probe_all(self):
+        for backend in self.backends:
+            try:
+                healthy = self.probe(backend)
+            except Exception:
+                healthy = False
+            with self._lock:
+                backend.last_probe = healthy
+                if healthy and not backend.available(time.monotonic()):
+                    logger.info("re-admitting %s", backend.url)
+                    backend.failures = 0
+                    backend.ejected_until = 0.
+                elif not healthy:
+                    backend.failures = max(backend.failures, self.max_failures)
+                    self._eject(backend)
+
+    def _run_probes(self):
+        while not self._stop.wait(self.probe_interval):
+            self.probe_all()
+
+    def start(self):
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._stop.clear()
+            self._prober = threading.Thread(target=self._run_probes, name="backend-probes", daemon=True)
+            self._prober.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._prober is not None:
+            self._prober.join()
+            self._prober = None
+
+    def report(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame([backend.as_dict() for backend in self.backends]).set_index("url")
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import hashlib
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .instrumentation import record_cache
+from .lazy import lazy_import
+from .storage import atomic_path
+
+affine = lazy_import("affine")
+gpd = lazy_import("geopandas")
+pyproj = lazy_import("pyproj")
+rasterio = lazy_import("rasterio")
+
+
+@dataclass
+class DEMTile:
+    path: Path
+    crs: str
+    transform: affine.Affine
+    width: int
+    height: int
+    nodata: float
+    # bounds in the crs of the tile
+    left: float
+    bottom: float
+    right: float
+    top: float
+
+
+@dataclass
+class _TileGrid:
+    # tiles of a single crs, binned into cells about the size of a tile
+    left: float
+    bottom: float
+    cell_width: float
+    cell_height: float
+    # positions in ElevationCorrector.tiles, in the order they are tried
+    cells: Dict[Tuple[int, int], List[int]]
+
+    def cell(self, x: np.ndarray, y: np.ndarray) -> (np.ndarray, np.ndarray):
+        return (np.floor((x - self.left) / self.cell_width).astype(np.int64),
+                np.floor((y - self.bottom) / self.cell_height).astype(np.int64))
+
+
+class DEMTileCache:
+    """
+    LRU cache of decoded DEM tiles.
+    With a cache_path decoded tiles are also written as .npy files and memory mapped afterwards,
+    so later runs skip decoding the GeoTIFFs and the OS page cache can share the tiles between processes.
+    """
+
+    def __init__(self, max_tiles: int = 16, cache_path: Path = None):
+        self.max_tiles = max_tiles
+        self.cache_path = cache_path
+        self.tiles: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # how often a GeoTIFF actually had to be decoded
+        self.reads: Dict[Path, int] = {}
+
+    def _decode(self, tile: DEMTile) -> np.ndarray:
+        self.reads[tile.path] = self.reads.get(tile.path, 0) + 1
+        with rasterio.open(tile.path) as source:
+            data = source.read(1).astype(np.float32)
+        if tile.nodata is not None:
+            data[data == tile.nodata] = np.nan
+        return data
+
+    def _npy_path(self, tile: DEMTile) -> Path:
+        # tiles of different folders share stems and tiles get replaced by newer versions
+        stat = tile.path.stat()
+        key = f"{tile.path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+        return Path(self.cache_path, f"{tile.path.stem}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy")
+
+    def _load(self, tile: DEMTile) -> np.ndarray:
+        if self.cache_path is None:
+            return self._decode(tile)
+
+        npy_path = self._npy_path(tile)
+        if not npy_path.exists():
+            self.cache_path.mkdir(parents=True, exist_ok=True)
+            # other processes map the file, they must never see half of it
+            with atomic_path(npy_path) as temporary_path, open(temporary_path, "wb") as file_pointer:
+                np.save(file_pointer, self._decode(tile))
+        return np.load(npy_path, mmap_mode="r")
+
+    def get(self, tile: DEMTile) -> np.ndarray:
+        data = self.tiles.get(tile.path)
+        record_cache("dem_tile", hit=data is not None)
+        if data is not None:
+            self.hits += 1
+            self.tiles.move_to_end(tile.path)
+            return data
+
+        self.misses += 1
+        data = self._load(tile)
+        self.tiles[tile.path] = data
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return data
+
+
+class ElevationCorrector:
+    """
+    Replaces the noisy altitude of a track with elevations sampled from local DEM GeoTIFF tiles.
+    All points of a track are sampled in one vectorized batch per tile,
+    points outside of all tiles keep their recorded elevation.
+    Points are binned into a grid of the tile bounds first, so every tile only looks at the points near it.
+    """
+
+    def __init__(self, dem_path: Path, cache: DEMTileCache = None):
+        self.dem_path = dem_path
+        self.cache = cache or DEMTileCache()
+        self.tiles: List[DEMTile] = []
+        self._grids: Dict[str, _TileGrid] = {}
+        self._transformers: Dict[str, pyproj.Transformer] = {}
+        self._load_tiles()
+        self._build_grids()
+
+    def _load_tiles(self):
+        # only the metadata is read here, pixels are decoded on demand by the cache
+        for tile_path in sorted(self.dem_path.glob("*.tif")):
+            with rasterio.open(tile_path) as source:
+                self.tiles.append(DEMTile(
+                    path=tile_path,
+                    crs=source.crs.to_string(),
+                    transform=source.transform,
+                    width=source.width,
+                    height=source.height,
+                    nodata=source.nodata,
+                    left=source.bounds.left,
+                    bottom=source.bounds.bottom,
+                    right=source.bounds.right,
+                    top=source.bounds.top,
+                ))
+
+    def _build_grids(self):
+        tiles_by_crs = defaultdict(list)
+        for position, tile in enumerate(self.tiles):
+            tiles_by_crs[tile.crs].append(position)
+        for crs, positions in tiles_by_crs.items():
+            tiles = [self.tiles[position] for position in positions]
+            grid = _TileGrid(
+                left=min(tile.left for tile in tiles),
+                bottom=min(tile.bottom for tile in tiles),
+                cell_width=float(np.median([tile.right - tile.left for tile in tiles])) or 1.,
+                cell_height=float(np.median([tile.top - tile.bottom for tile in tiles])) or 1.,
+                cells=defaultdict(list),
+            )
+            for position, tile in zip(positions, tiles):
+                (left, right), (bottom, top) = grid.cell(
+                    np.array([tile.left, tile.right]), np.array([tile.bottom, tile.top]))
+                for column in range(left, right + 1):
+                    for row in range(bottom, top + 1):
+                        grid.cells[(column, row)].append(position)
+            self._grids[crs] = grid
+
+    def _project(self, crs: str, longitudes: np.ndarray, latitudes: np.ndarray) -> (np.ndarray, np.ndarray):
+        if crs not in self._transformers:
+            self._transformers[crs] = pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+        return self._transformers[crs].transform(longitudes, latitudes)
+
+    def _sample_tile(self, tile: DEMTile, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        data = self.cache.get(tile)
+        # fractional pixel positions, pixel centers are at .5
+        columns, rows = ~tile.transform * (x, y)
+        columns = np.clip(columns - 0.5, 0, tile.width - 1)
+        rows = np.clip(rows - 0.5, 0, tile.height - 1)
+
+        # bilinear interpolation between the four surrounding pixels
+        column_0 = np.minimum(np.floor(columns).astype(np.int64), tile.width - 2 if tile.width > 1 else 0)
+        row_0 = np.minimum(np.floor(rows).astype(np.int64), tile.height - 2 if tile.height > 1 else 0)
+        column_1 = np.minimum(column_0 + 1, tile.width - 1)
+        row_1 = np.minimum(row_0 + 1, tile.height - 1)
+        column_weight = columns - column_0
+        row_weight = rows - row_0
+
+        top = data[row_0, column_0] * (1 - column_weight) + data[row_0, column_1] * column_weight
+        bottom = data[row_1, column_0] * (1 - column_weight) + data[row_1, column_1] * column_weight
+        return top * (1 - row_weight) + bottom * row_weight
+
+    def sample(self, longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        elevations = np.full(len(longitudes), np.nan)
+        for crs, grid in self._grids.items():
+            # points already sampled from the tiles of another crs are done
+            positions = np.flatnonzero(np.isnan(elevations))
+            if not len(positions):
+                break
+            x, y = self._project(crs, longitudes[positions], latitudes[positions])
+            x, y = np.asarray(x), np.asarray(y)
+            finite = np.isfinite(x) & np.isfinite(y)
+            positions, x, y = positions[finite], x[finite], y[finite]
+            if not len(positions):
+                continue
+
+            columns, rows = grid.cell(x, y)
+            cells, inverse = np.unique(np.stack([columns, rows], axis=1), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            order = np.argsort(inverse, kind="stable")
+            for (column, row), members in zip(
+                    cells.tolist(), np.split(order, np.cumsum(np.bincount(inverse))[:-1])):
+                tile_positions = grid.cells.get((column, row))
+                if not tile_positions:
+                    continue
+                cell_x, cell_y = x[members], y[members]
+                missing = np.ones(len(members), dtype=bool)
+                for tile_position in tile_positions:
+                    tile = self.tiles[tile_position]
+                    inside = (missing & (tile.left <= cell_x) & (cell_x <= tile.right)
+                              & (tile.bottom <= cell_y) & (cell_y <= tile.top))
+                    if not inside.any():
+                        continue
+                    values = self._sample_tile(tile, cell_x[inside], cell_y[inside])
+                    elevations[positions[members[inside]]] = values
+                    # nodata pixels can still be covered by a neighbouring tile
+                    missing[inside] = np.isnan(values)
+                    if not missing.any():
+                        break
+        return elevations
+
+    def correct(self, points_df: gpd.GeoDataFrame, elevation_column: str = "elev") -> gpd.GeoDataFrame:
+        # works on frames of match.load_gpx ("elev") as well as TrackHandler tracks ("altitude")
+        elevations = self.sample(points_df["longitude"].values, points_df["latitude"].values)
+        corrected = points_df.copy()
+        recorded = corrected[elevation_column].values.astype(np.float64)
+        corrected[elevation_column] = np.where(np.isnan(elevations), recorded, elevations)
+        return corrected
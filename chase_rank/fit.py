@@ -0,0 +1,148 @@
+import struct
+from typing import BinaryIO, Dict
+
+import numpy as np
+
+# https://developer.garmin.com/fit/protocol/
+# only the parts needed to get the positions out of activity files are implemented
+FIT_EPOCH = np.datetime64("1989-12-31T00:00:00", "s")
+RECORD_MESSAGE = 20
+TIMESTAMP_FIELD = 253
+POSITION_LAT_FIELD = 0
+POSITION_LONG_FIELD = 1
+ALTITUDE_FIELD = 2
+ENHANCED_ALTITUDE_FIELD = 78
+SEMICIRCLES_TO_DEGREES = 180 / 2 ** 31
+
+# base type numbers (lower 5 bits of the base type byte) of signed integers
+SIGNED_BASE_TYPES = {1, 3, 5, 14}
+
+
+class FitDecodeError(Exception):
+    pass
+
+
+def _invalid_value(size: int, signed: bool) -> int:
+    # every base type marks missing values with its maximum
+    return (1 << (size * 8 - 1)) - 1 if signed else (1 << (size * 8)) - 1
+
+
+class _Definition:
+
+    def __init__(self, global_number: int, byteorder: str, fields: list, developer_size: int):
+        self.global_number = global_number
+        self.byteorder = byteorder
+        self.size = sum(size for _, size, _ in fields) + developer_size
+        # offset, size and signedness of every field so we can pick single fields from the message
+        self.fields = {}
+        offset = 0
+        for number, size, base_type in fields:
+            self.fields[number] = (offset, size, (base_type & 0x1F) in SIGNED_BASE_TYPES)
+            offset += size
+
+    def read(self, message: bytes, number: int) -> (int, None):
+        field = self.fields.get(number)
+        if field is None:
+            return None
+        offset, size, signed = field
+        value = int.from_bytes(message[offset:offset + size], self.byteorder, signed=signed)
+        if value == _invalid_value(size, signed):
+            return None
+        return value
+
+
+def read_fit(file_pointer: BinaryIO) -> Dict[str, np.ndarray]:
+    """
+    Decodes the record messages of a fit activity file into the same arrays as match.read_gpx.
+    Chained fit files are read one after another, each of them is a segment.
+    """
+    content = file_pointer.read()
+    columns = {"time": [], "latitude": [], "longitude": [], "elevation": [], "segment": []}
+
+    position = 0
+    segment = 0
+    while position + 12 <= len(content):
+        header_size = content[position]
+        data_size = struct.unpack_from("<I", content, position + 4)[0]
+        if content[position + 8:position + 12] != b".FIT":
+            raise FitDecodeError(f"no fit header at byte {position}")
+        end = position + header_size + data_size
+        position += header_size
+
+        definitions: Dict[int, _Definition] = {}
+        last_timestamp = None
+        while position < end:
+            record_header = content[position]
+            position += 1
+
+            if record_header & 0x80:
+                # compressed timestamp header, the offset replaces the lower 5 bits of the last timestamp
+                local_type = (record_header >> 5) & 0x03
+                offset = record_header & 0x1F
+                if last_timestamp is not None:
+                    timestamp = (last_timestamp & ~0x1F) + offset
+                    if offset < (last_timestamp & 0x1F):
+                        timestamp += 0x20
+                    last_timestamp = timestamp
+            elif record_header & 0x40:
+                # definition message
+                local_type = record_header & 0x0F
+                byteorder = "big" if content[position + 1] else "little"
+                global_number = int.from_bytes(content[position + 2:position + 4], byteorder)
+                field_count = content[position + 4]
+                position += 5
+                fields = [tuple(content[position + 3 * i:position + 3 * i + 3]) for i in range(field_count)]
+                position += 3 * field_count
+                developer_size = 0
+                if record_header & 0x20:
+                    developer_count = content[position]
+                    position += 1
+                    developer_size = sum(content[position + 3 * i + 1] for i in range(developer_count))
+                    position += 3 * developer_count
+                definitions[local_type] = _Definition(global_number, byteorder, fields, developer_size)
+                continue
+            else:
+                local_type = record_header & 0x0F
+
+            definition = definitions.get(local_type)
+            if definition is None:
+                raise FitDecodeError(f"data message without definition at byte {position - 1}")
+            message = content[position:position + definition.size]
+            position += definition.size
+
+            timestamp = definition.read(message, TIMESTAMP_FIELD)
+            if timestamp is not None:
+                last_timestamp = timestamp
+            if definition.global_number != RECORD_MESSAGE:
+                continue
+
+            latitude = definition.read(message, POSITION_LAT_FIELD)
+            longitude = definition.read(message, POSITION_LONG_FIELD)
+            if latitude is None or longitude is None:
+                # indoor records or records before the gps fix
+                continue
+            altitude = definition.read(message, ENHANCED_ALTITUDE_FIELD)
+            if altitude is None:
+                altitude = definition.read(message, ALTITUDE_FIELD)
+
+            columns["time"].append(last_timestamp if last_timestamp is not None else -1)
+            columns["latitude"].append(latitude * SEMICIRCLES_TO_DEGREES)
+            columns["longitude"].append(longitude * SEMICIRCLES_TO_DEGREES)
+            # altitude has a scale of 5 and an offset of 500
+            columns["elevation"].append(altitude / 5 - 500 if altitude is not None else np.nan)
+            columns["segment"].append(segment)
+
+        # skip the crc at the end of the file
+        position = end + 2
+        segment += 1
+
+    seconds = np.array(columns["time"], dtype=np.int64)
+    time = (FIT_EPOCH + seconds.astype("timedelta64[s]")).astype("datetime64[ns]")
+    time[seconds < 0] = np.datetime64("NaT")
+    return {
+        "time": time,
+        "latitude": np.array(columns["latitude"], dtype=np.float64),
+        "longitude": np.array(columns["longitude"], dtype=np.float64),
+        "elevation": np.array(columns["elevation"], dtype=np.float64),
+        "segment": np.array(columns["segment"], dtype=np.int32),
+    }
@@ -0,0 +1,127 @@
+"""
+Cleans GPS points before they are sent to a matcher.
+
+Smartphones record the same second twice, jump hundreds of meters for a single point and keep
+logging while standing at a crossing, wobbling around a few meters. Valhalla answers such points
+with errors (171, no suitable edges), empty sections or loops around the block.
+clean_points finds the points worth matching, reindex_points maps every original point to one of them,
+so the result of the matcher can be spread over the whole track again.
+"""
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+# fast descents reach 25 m/s, nobody on a bike gets faster
+MAX_SPEED = 30.
+# about 1g, braking and accelerating on a bike stay well below
+MAX_ACCELERATION = 10.
+# standing points wobble around within this radius (m), riding gets further within STATIONARY_WINDOW points
+JITTER_RADIUS = 15.
+STATIONARY_WINDOW = 10
+
+
+def _distances(longitudes_1: np.ndarray, latitudes_1: np.ndarray,
+               longitudes_2: np.ndarray, latitudes_2: np.ndarray) -> np.ndarray:
+    # equirectangular, exact enough for points seconds apart and much cheaper than a geodesic
+    latitudes = np.radians((latitudes_1 + latitudes_2) / 2)
+    delta_x = np.radians(longitudes_2 - longitudes_1) * np.cos(latitudes)
+    delta_y = np.radians(latitudes_2 - latitudes_1)
+    return EARTH_RADIUS * np.hypot(delta_x, delta_y)
+
+
+def _spikes(longitudes: np.ndarray, latitudes: np.ndarray, seconds: np.ndarray,
+            max_speed: float, max_acceleration: float) -> np.ndarray:
+    """
+    Points reached and left at an impossible speed, or with an impossible speed up right before
+    and slow down right after them. A single long jump, e.g. after the signal came back, is no spike.
+    """
+    spikes = np.zeros(len(seconds), dtype=bool)
+    if len(seconds) < 3:
+        return spikes
+    durations = np.diff(seconds)
+    # speed between every point and the next one
+    speeds = _distances(longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:]) / durations
+    too_fast = speeds > max_speed
+    spikes[1:-1] = too_fast[:-1] & too_fast[1:]
+
+    accelerations = np.zeros(len(seconds))
+    accelerations[1:-1] = np.diff(speeds) / ((durations[:-1] + durations[1:]) / 2)
+    spikes[2:-2] |= (accelerations[1:-3] > max_acceleration) & (accelerations[3:-1] < -max_acceleration)
+    return spikes
+
+
+def _stationary(longitudes: np.ndarray, latitudes: np.ndarray, jitter_radius: float, window: int) -> np.ndarray:
+    """
+    Inner points of runs of standing points that stay around the center of their run.
+    A point stands if the points window positions before and after it are within jitter_radius,
+    the jitter between consecutive points is as fast as riding but goes nowhere.
+    The first and last point of a run are kept, the matcher still sees where the stop began and ended.
+    """
+    size = len(longitudes)
+    if size <= window:
+        return np.zeros(size, dtype=bool)
+    positions = np.arange(size)
+    before = np.maximum(positions - window, 0)
+    after = np.minimum(positions + window, size - 1)
+    standing = (
+        (_distances(longitudes[before], latitudes[before], longitudes, latitudes) <= jitter_radius)
+        & (_distances(longitudes, latitudes, longitudes[after], latitudes[after]) <= jitter_radius)
+    )
+
+    starts = np.ones(size, dtype=bool)
+    starts[1:] = standing[1:] != standing[:-1]
+    runs = np.cumsum(starts) - 1
+    last = np.append(runs[1:] != runs[:-1], True)
+    # pushing the bike uphill drifts away from the center of the run, those points are kept
+    sizes = np.bincount(runs)
+    centers_x = np.bincount(runs, weights=longitudes) / sizes
+    centers_y = np.bincount(runs, weights=latitudes) / sizes
+    near = _distances(centers_x[runs], centers_y[runs], longitudes, latitudes) <= jitter_radius
+    return standing & ~starts & ~last & near
+
+
+def clean_points(longitudes: np.ndarray,
+                 latitudes: np.ndarray,
+                 timestamps: np.ndarray,
+                 max_speed: float = MAX_SPEED,
+                 max_acceleration: float = MAX_ACCELERATION,
+                 jitter_radius: float = JITTER_RADIUS,
+                 stationary_window: int = STATIONARY_WINDOW,
+                 rounds: int = 3) -> np.ndarray:
+    """
+    Positions of the points worth matching, in order.
+    Drops points without valid coordinates, repeated or backwards timestamps, spikes and standing jitter.
+    Spikes are searched for again after dropping some, the next point of a run of outliers only shows then.
+    """
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    seconds = (np.asarray(timestamps) - np.asarray(timestamps)[:1]) / np.timedelta64(1, "s")
+
+    valid = (
+        np.isfinite(longitudes) & np.isfinite(latitudes) & np.isfinite(seconds)
+        & (np.abs(longitudes) <= 180) & (np.abs(latitudes) <= 90)
+        # lost fixes are often reported at null island
+        & ((longitudes != 0) | (latitudes != 0))
+    )
+    kept = np.flatnonzero(valid)
+
+    # only the first point of every second counts, points from the past are dropped as well
+    kept_seconds = seconds[kept]
+    later = np.ones(len(kept), dtype=bool)
+    later[1:] = kept_seconds[1:] > np.maximum.accumulate(kept_seconds)[:-1]
+    kept = kept[later]
+
+    for _ in range(rounds):
+        spikes = _spikes(longitudes[kept], latitudes[kept], seconds[kept], max_speed, max_acceleration)
+        if not spikes.any():
+            break
+        kept = kept[~spikes]
+
+    return kept[~_stationary(longitudes[kept], latitudes[kept], jitter_radius, stationary_window)]
+
+
+def reindex_points(kept: np.ndarray, size: int) -> np.ndarray:
+    """
+    Position in the kept points for each of the size original points.
+    Dropped points take the last kept point before them, dropped points at the start the first kept point.
+    """
+    return np.maximum(np.searchsorted(kept, np.arange(size), side="right") - 1, 0)
@@ -0,0 +1,263 @@
+"""
+Timing spans, traffic, error and cache counters of the handlers.
+
+Everything is recorded twice: as prometheus metrics, served with start_metrics_server,
+and in the stats of the current run, which save_run_report writes as JSON.
+SamplingProfiler is an opt-in profiler that periodically samples the stacks of all threads.
+"""
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Metrics:
+    """
+    Prometheus metrics of the package, only created (and prometheus_client imported) once something is recorded.
+    """
+
+    def __init__(self):
+        from prometheus_client import Counter, Gauge, Histogram
+
+        self.span_seconds = Histogram(
+            "chase_rank_span_seconds",
+            "Wall time spent in a handler stage",
+            ["handler", "stage"],
+            buckets=(.001, .005, .01, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120.)
+        )
+        self.http_requests = Counter(
+            "chase_rank_http_requests_total", "Requests to external services", ["service", "status"])
+        self.http_bytes = Counter(
+            "chase_rank_http_bytes_total", "Bytes sent to and received from external services",
+            ["service", "direction"])
+        self.valhalla_errors = Counter(
+            "chase_rank_valhalla_errors_total", "Errors returned by valhalla", ["error_code"])
+        self.cache_requests = Counter(
+            "chase_rank_cache_requests_total", "Lookups of locally stored data", ["cache", "result"])
+        self.strava_rate_limit = Gauge(
+            "chase_rank_strava_rate_limit", "Strava rate limit from the response headers", ["window"])
+        self.strava_rate_limit_usage = Gauge(
+            "chase_rank_strava_rate_limit_usage", "Strava rate limit usage from the response headers", ["window"])
+
+
+_metrics: _Metrics = None
+_metrics_lock = threading.Lock()
+
+
+def metrics() -> _Metrics:
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = _Metrics()
+    return _metrics
+
+
+class RunStats:
+    """
+    Totals of everything recorded since the start of the run, collected for the JSON report.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+        # (handler, stage) -> [count, seconds, max_seconds]
+        self.spans: Dict[Tuple[str, str], List[float]] = collections.defaultdict(lambda: [0, 0., 0.])
+        self.http: Dict[Tuple[str, str], int] = collections.Counter()
+        self.bytes: Dict[Tuple[str, str], int] = collections.Counter()
+        self.valhalla_errors: Dict[str, int] = collections.Counter()
+        self.cache: Dict[Tuple[str, str], int] = collections.Counter()
+        self.strava_rate_limit: Dict[str, int] = {}
+
+    def as_dict(self) -> Dict:
+        with self.lock:
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "finished": datetime.now().isoformat(timespec="seconds"),
+                "spans": {
+                    f"{handler}.{stage}": {
+                        "count": int(count),
+                        "seconds": round(seconds, 6),
+                        "max_seconds": round(max_seconds, 6),
+                    }
+                    for (handler, stage), (count, seconds, max_seconds) in sorted(self.spans.items())
+                },
+                "http": {f"{service}.{status}": count for (service, status), count in sorted(self.http.items())},
+                "bytes": {f"{service}.{direction}": count
+                          for (service, direction), count in sorted(self.bytes.items())},
+                "valhalla_errors": dict(self.valhalla_errors),
+                "cache": {f"{cache}.{result}": count for (cache, result), count in sorted(self.cache.items())},
+                "strava_rate_limit": dict(self.strava_rate_limit),
+            }
+
+
+_run = RunStats()
+
+
+def reset_run():
+    # starts a new run, the prometheus metrics keep counting
+    global _run
+    _run = RunStats()
+
+
+def run_report() -> Dict:
+    return _run.as_dict()
+
+
+def save_run_report(path: Path, profiler: "SamplingProfiler" = None) -> Dict:
+    report = run_report()
+    if profiler is not None:
+        report["profile"] = profiler.report()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=2))
+    return report
+
+
+def start_metrics_server(port: int = 8000):
+    from prometheus_client import start_http_server
+
+    metrics()
+    start_http_server(port)
+
+
+@contextmanager
+def span(handler: str, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics().span_seconds.labels(handler, stage).observe(seconds)
+        with _run.lock:
+            stats = _run.spans[(handler, stage)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+
+def record_http(service: str, status: int, sent: int = 0, received: int = 0):
+    metric = metrics()
+    metric.http_requests.labels(service, str(status)).inc()
+    metric.http_bytes.labels(service, "sent").inc(sent)
+    metric.http_bytes.labels(service, "received").inc(received)
+    with _run.lock:
+        _run.http[(service, str(status))] += 1
+        _run.bytes[(service, "sent")] += sent
+        _run.bytes[(service, "received")] += received
+
+
+def request_size(request) -> int:
+    # size of a prepared requests.Request as it goes over the wire, without the http overhead
+    body = request.body or b""
+    return len(request.url) + len(body if isinstance(body, bytes) else body.encode())
+
+
+def record_valhalla_error(error_code):
+    metrics().valhalla_errors.labels(str(error_code)).inc()
+    with _run.lock:
+        _run.valhalla_errors[str(error_code)] += 1
+
+
+def record_cache(cache: str, hit: bool):
+    result = "hit" if hit else "miss"
+    metrics().cache_requests.labels(cache, result).inc()
+    with _run.lock:
+        _run.cache[(cache, result)] += 1
+
+
+def record_strava_rate_limit(limit_15_min: int, limit_daily: int, usage_15_min: int, usage_daily: int):
+    metric = metrics()
+    metric.strava_rate_limit.labels("15_min").set(limit_15_min)
+    metric.strava_rate_limit.labels("daily").set(limit_daily)
+    metric.strava_rate_limit_usage.labels("15_min").set(usage_15_min)
+    metric.strava_rate_limit_usage.labels("daily").set(usage_daily)
+    with _run.lock:
+        _run.strava_rate_limit = {
+            "limit_15_min": limit_15_min,
+            "limit_daily": limit_daily,
+            "usage_15_min": usage_15_min,
+            "usage_daily": usage_daily,
+        }
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads every interval seconds.
+    Its overhead only depends on the interval, so it can stay attached to production runs:
+
+        with SamplingProfiler() as profiler:
+            ...
+        profiler.report()
+    """
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        # stacks from the outermost to the innermost frame
+        self.stacks: Dict[Tuple[str, ...], int] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def top(self, n: int = 20, cumulative: bool = False) -> List[Tuple[str, int]]:
+        # functions by the number of samples they were running in (or below with cumulative=True)
+        counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            if cumulative:
+                for function in set(stack):
+                    counts[function] += count
+            elif stack:
+                counts[stack[-1]] += count
+        return counts.most_common(n)
+
+    def collapsed(self) -> str:
+        # folded stacks as used by flamegraph.pl and speedscope
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.items())
+
+    def report(self, n: int = 20) -> Dict:
+        return {
+            "interval": self.interval,
+            "samples": self.samples,
+            "self": self.top(n),
+            "cumulative": self.top(n, cumulative=True),
+        }
@@ -0,0 +1,369 @@
+"""
+Shared job queue to spread fetching, matching and analyzing over workers on several machines.
+
+The queue is a SQLite file on a volume all workers mount. Activities are submitted in shards,
+a worker leases a shard, renews the lease with heartbeats while it works and completes it at the end.
+Shards of crashed workers are handed out again once their lease runs out. Heartbeats also record
+the activities already done, so the next worker continues where the crashed one stopped.
+Every task checks the storage first, running a shard twice never repeats finished work.
+
+    queue = JobQueue(Path("/shared/jobs.sqlite"))
+    queue.submit("match", [(activity_id, user_id, start_date), ...])
+    # on every node
+    Worker(queue, {"match": match_task(track_handler, match_handler, ValhallaHandler(...))}).run()
+
+Leases are compared against the clocks of the workers, they have to be kept in sync (NTP).
+A shard with a failed activity goes back to the queue, the next attempt only retries the failed ones.
+Matches are written atomically, a normalized MatchHandler adds new edges to the shared edge table
+under a file lock, so workers can store matches in either format into the same folder.
+Handlers that keep aggregates (WayAggregateHandler, RankingHandler, ...) are saved by every
+process on its own, leave them out of the MatchHandler of the workers and rebuild them afterwards.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence
+
+import pandas as pd
+
+from .process import from_track_match, summarize_track
+from .storage import atomic_path
+
+logger = logging.getLogger(__name__)
+
+KINDS = ["fetch", "match", "analyze"]
+
+# a task gets an item (activity_id, user_id, start_date) and returns False if it was already done
+Task = Callable[[list], bool]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    items TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    done TEXT NOT NULL DEFAULT '[]',
+    result TEXT,
+    error TEXT,
+    created TEXT NOT NULL,
+    finished TEXT,
+    UNIQUE (kind, shard)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (kind, status, lease_until);
+"""
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    shard: int
+    items: List[list]
+    worker: str
+    attempts: int
+    # activity ids finished by this or an earlier attempt
+    done: List[int] = field(default_factory=list)
+
+
+class JobQueue:
+    """
+    Sharded jobs in a SQLite file. Every operation opens its own connection, so the queue can be used
+    from several threads and processes at once. Claims run in an immediate transaction, two workers
+    never lease the same shard. The default rollback journal is used because WAL doesn't work on network volumes.
+    """
+
+    def __init__(self, path: Path, lease_seconds: float = 300., max_attempts: int = 3, timeout: float = 60.):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        connection = self._connect()
+        try:
+            connection.executescript(_SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def submit(self, kind: str, items: Iterable[Sequence], shard_size: int = 50) -> int:
+        """
+        Splits the items into shards of shard_size and adds the shards that aren't queued yet.
+        Submitting the same items again adds nothing, the shard numbers continue after the last shard of the kind.
+        Returns the number of new shards.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"unknown kind {kind}, use one of {KINDS}")
+        items = [[value.isoformat() if isinstance(value, datetime) else value for value in item] for item in items]
+        created = datetime.now().isoformat(timespec="seconds")
+        with self._transaction(immediate=True) as connection:
+            queued = {
+                activity_id
+                for (shard_items,) in connection.execute("SELECT items FROM jobs WHERE kind = ?", (kind,))
+                for activity_id, *_ in json.loads(shard_items)
+            }
+            items = [item for item in items if item[0] not in queued]
+            (last_shard,) = connection.execute(
+                "SELECT COALESCE(MAX(shard), -1) FROM jobs WHERE kind = ?", (kind,)).fetchone()
+            shards = [items[start:start + shard_size] for start in range(0, len(items), shard_size)]
+            connection.executemany(
+                "INSERT INTO jobs (kind, shard, items, created) VALUES (?, ?, ?, ?)",
+                [(kind, last_shard + 1 + index, json.dumps(shard), created) for index, shard in enumerate(shards)]
+            )
+        return len(shards)
+
+    def claim(self, worker: str, kinds: List[str] = None) -> (Job, None):
+        """
+        Leases the next pending shard, or one whose lease ran out, of the first kind in kinds that has any.
+        """
+        now = time.time()
+        with self._transaction(immediate=True) as connection:
+            # shards of crashed workers that already used up their attempts are given up
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired', finished = ? "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (datetime.now().isoformat(timespec="seconds"), now, self.max_attempts)
+            )
+            for kind in kinds or KINDS:
+                row = connection.execute(
+                    "SELECT id, kind, shard, items, attempts, done FROM jobs "
+                    "WHERE kind = ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) "
+                    "ORDER BY shard LIMIT 1",
+                    (kind, now)
+                ).fetchone()
+                if row is None:
+                    continue
+                job_id, kind, shard, items, attempts, done = row
+                connection.execute(
+                    "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE id = ?",
+                    (worker, now + self.lease_seconds, job_id)
+                )
+                return Job(job_id, kind, shard, json.loads(items), worker, attempts + 1, json.loads(done))
+        return None
+
+    def heartbeat(self, job: Job) -> bool:
+        # renews the lease and records the progress, False if the lease was lost to another worker
+        with self._transaction() as connection:
+            updated = connection.execute(
+                "UPDATE jobs SET lease_until = ?, done = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, json.dumps(job.done), job.id, job.worker)
+            ).rowcount
+        return bool(updated)
+
+    def complete(self, job: Job, result: Dict = None) -> bool:
+        """
+        Marks the shard as done. Completing a shard twice, e.g. by a worker that lost its lease
+        but finished anyway, changes nothing. Returns False if the shard was already done.
+        """
+        with self._transaction() as connection:
+            updated = connection.execute(
+                "UPDATE jobs SET status = 'done', worker = ?, done = ?, result = ?, error = NULL, finished = ? "
+                "WHERE id = ? AND status != 'done'",
+                (job.worker, json.dumps(job.done), json.dumps(result),
+                 datetime.now().isoformat(timespec="seconds"), job.id)
+            ).rowcount
+        return bool(updated)
+
+    def fail(self, job: Job, error: str):
+        # the shard goes back to the queue until it used up its attempts
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL, done = ?, error = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, json.dumps(job.done), error, job.id, job.worker)
+            )
+
+    def outstanding(self, kinds: List[str] = None) -> int:
+        # shards that are pending or leased, including leases that ran out
+        kinds = kinds or KINDS
+        with self._transaction() as connection:
+            (count,) = connection.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased') "
+                f"AND kind IN ({', '.join('?' * len(kinds))})",
+                kinds
+            ).fetchone()
+        return count
+
+    def retry_failed(self, kind: str = None) -> int:
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, worker = NULL, lease_until = NULL "
+                "WHERE status = 'failed' AND (? IS NULL OR kind = ?)",
+                (kind, kind)
+            ).rowcount
+
+    def progress(self) -> pd.DataFrame:
+        # number of shards by kind and status
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status").fetchall()
+        return pd.DataFrame(rows, columns=["kind", "status", "shards"]).pivot(
+            index="kind", columns="status", values="shards").fillna(0).astype(int)
+
+
+class Worker:
+    """
+    Claims shards from the queue and runs the task of their kind on every activity.
+    A background thread sends the heartbeats, if the lease gets lost the worker stops after the current activity.
+    A shard is only completed once every activity went through, a failed activity fails the shard after the others ran.
+    """
+
+    def __init__(self, queue: JobQueue, tasks: Dict[str, Task], worker_id: str = None, heartbeat_interval: float = None):
+        self.queue = queue
+        self.tasks = tasks
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat_interval = heartbeat_interval or queue.lease_seconds / 3
+
+    def _heartbeats(self, job: Job, stop: threading.Event, lost: threading.Event):
+        while not stop.wait(self.heartbeat_interval):
+            if not self.queue.heartbeat(job):
+                lost.set()
+                return
+
+    def process(self, job: Job) -> (Dict, None):
+        task = self.tasks[job.kind]
+        stop, lost = threading.Event(), threading.Event()
+        heartbeats = threading.Thread(target=self._heartbeats, args=(job, stop, lost), daemon=True)
+        heartbeats.start()
+
+        result = {"done": 0, "skipped": 0}
+        failed = {}
+        finished = set(job.done)
+        try:
+            for item in job.items:
+                if lost.is_set():
+                    break
+                activity_id = item[0]
+                if activity_id in finished:
+                    result["skipped"] += 1
+                    continue
+                try:
+                    result["done" if task(item) else "skipped"] += 1
+                    job.done.append(activity_id)
+                except Exception as e:
+                    # a single broken activity should not hold up the whole shard
+                    logger.exception("%s of %s failed", job.kind, activity_id)
+                    failed[activity_id] = repr(e)
+        except BaseException as e:
+            self.queue.fail(job, repr(e))
+            raise
+        finally:
+            stop.set()
+            heartbeats.join()
+
+        if lost.is_set():
+            logger.warning("lost the lease of %s shard %s, another worker takes over", job.kind, job.shard)
+            return None
+        if failed:
+            # the finished activities are recorded in done, the next attempt skips them
+            logger.warning("%s of %s shard %s failed", len(failed), job.kind, job.shard)
+            self.queue.fail(job, json.dumps(failed))
+            return None
+        self.queue.complete(job, result)
+        return result
+
+    def run(self, kinds: List[str] = None, max_jobs: int = None, wait: bool = False, poll_interval: float = 5.) -> int:
+        """
+        Works through the shards of the given kinds (all kinds with a task by default).
+        Stops once no shard is left, leased shards are waited for since their worker might have died.
+        With wait=True it keeps polling for new shards.
+        Returns the number of processed shards.
+        """
+        kinds = kinds or [kind for kind in KINDS if kind in self.tasks]
+        processed = 0
+        while max_jobs is None or processed < max_jobs:
+            job = self.queue.claim(self.worker_id, kinds)
+            if job is None:
+                if not wait and not self.queue.outstanding(kinds):
+                    break
+                time.sleep(poll_interval)
+                continue
+            logger.info("%s: %s shard %s, attempt %s", self.worker_id, job.kind, job.shard, job.attempts)
+            self.process(job)
+            processed += 1
+        return processed
+
+
+def _start_time(start_date: (str, None)) -> (datetime, None):
+    return datetime.fromisoformat(start_date) if start_date else None
+
+
+def fetch_task(track_handler) -> Task:
+    def fetch(item: list) -> bool:
+        activity_id, user_id, start_date = item
+        if track_handler.exists(activity_id):
+            return False
+        track_handler.get(activity_id=activity_id, user_id=user_id, start_time=_start_time(start_date))
+        return True
+
+    return fetch
+
+
+def match_task(track_handler, match_handler, matcher, rematch: bool = False) -> Task:
+    # with rematch=True every activity is matched again, the heartbeats make sure it only happens once
+    def match(item: list) -> bool:
+        activity_id, user_id, start_date = item
+        if not rematch and match_handler.exists(activity_id):
+            return False
+        if track_handler.exists(activity_id):
+            # stored by a fetch worker, maybe after this process listed the folder
+            track = track_handler.get(activity_id)
+        else:
+            # not fetched yet, the match shard fetches the track itself
+            track = track_handler.get(activity_id=activity_id, user_id=user_id, start_time=_start_time(start_date))
+        matched = matcher.match(track)
+        if matched is None:
+            raise ValueError(f"nothing of {activity_id} could be matched")
+        match_handler.add(activity_id, matched, user_id=user_id)
+        return True
+
+    return match
+
+
+def analyze_task(match_handler, summary_path: Path) -> Task:
+    # summaries of process.summarize_track as json, one file per activity
+    Path(summary_path).mkdir(parents=True, exist_ok=True)
+
+    def analyze(item: list) -> bool:
+        activity_id = item[0]
+        file_path = Path(summary_path, f"{activity_id}.json")
+        if file_path.exists():
+            return False
+        if not match_handler.exists(activity_id):
+            raise KeyError(f"no match of {activity_id}")
+        summary = summarize_track(from_track_match(match_handler.get(activity_id)), track_name=str(activity_id))
+        # nobody ever reads half a summary
+        with atomic_path(file_path) as temporary_path:
+            temporary_path.write_text(json.dumps(summary.as_dict()))
+        return True
+
+    return analyze
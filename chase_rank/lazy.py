@@ -0,0 +1,22 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for a module that is only imported on first attribute access.
+    Unlike importlib.util.LazyLoader this also works for submodules like geopy.distance
+    without importing their parent packages up front.
+    """
+
+    def __getattr__(self, attribute: str):
+        module = importlib.import_module(self.__name__)
+        # later lookups find everything in __dict__ and never end up here again
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    # modules that are already loaded are returned as they are
+    return sys.modules.get(name) or LazyModule(name)
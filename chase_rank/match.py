@@ -1,30 +1,205 @@
-import gpxpy
-import geopandas as gpd
+from __future__ import annotations
+
+import io
+from pathlib import Path
+from typing import Dict, Union
+from xml.etree import ElementTree
+
+import numpy as np
 import pandas as pd
-from shapely.geometry import Point
+
+from .lazy import lazy_import
+
+gpd = lazy_import("geopandas")
+
+GpxSource = Union[str, Path, io.IOBase]
+
+
+def _local_name(tag: str) -> str:
+    # strip the namespace, GPX 1.0 and 1.1 files only differ in it
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parse_time(value: str) -> np.datetime64:
+    # clear tzinfo until it can be handled for the match query
+    # TODO: is this still causing issues with valhalla?
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1]
+    elif len(value) > 19 and value[-6] in "+-" and value[-3] == ":":
+        value = value[:-6]
+    return np.datetime64(value, "ns")
+
+
+def _open(source: GpxSource):
+    if isinstance(source, (str, Path)):
+        return open(source, "rb")
+    return source
+
+
+def count_gpx_points(source: GpxSource) -> int:
+    file_pointer = _open(source)
+    try:
+        count = 0
+        for _, element in ElementTree.iterparse(file_pointer, events=("end",)):
+            if _local_name(element.tag) == "trkpt":
+                count += 1
+            element.clear()
+        return count
+    finally:
+        if file_pointer is not source:
+            file_pointer.close()
+
+
+def read_gpx(source: GpxSource) -> Dict[str, np.ndarray]:
+    """
+    Streams the track points of all tracks and segments of a gpx file into numpy arrays.
+    Parsed elements are dropped right away, so apart from the output memory stays constant.
+    Seekable sources are counted first to allocate the arrays once,
+    other sources grow the arrays by doubling.
+    """
+    file_pointer = _open(source)
+    try:
+        seekable = file_pointer.seekable()
+        if seekable:
+            start = file_pointer.tell()
+            size = count_gpx_points(file_pointer)
+            file_pointer.seek(start)
+        else:
+            size = 1024
+
+        arrays = {
+            "time": np.full(size, np.datetime64("NaT"), dtype="datetime64[ns]"),
+            "latitude": np.empty(size, dtype=np.float64),
+            "longitude": np.empty(size, dtype=np.float64),
+            "elevation": np.full(size, np.nan, dtype=np.float64),
+            # running index over all segments of all tracks
+            "segment": np.empty(size, dtype=np.int32),
+        }
+
+        index = 0
+        segment = -1
+        parent = None
+        for event, element in ElementTree.iterparse(file_pointer, events=("start", "end")):
+            name = _local_name(element.tag)
+            if event == "start":
+                if name == "trkseg":
+                    segment += 1
+                    parent = element
+                continue
+            if name != "trkpt":
+                if name == "trkseg":
+                    parent = None
+                    element.clear()
+                continue
+
+            if index == size:
+                size *= 2
+                for key, array in arrays.items():
+                    grown = np.empty(size, dtype=array.dtype)
+                    grown[:index] = array[:index]
+                    arrays[key] = grown
+                arrays["time"][index:] = np.datetime64("NaT")
+                arrays["elevation"][index:] = np.nan
+
+            arrays["latitude"][index] = float(element.get("lat"))
+            arrays["longitude"][index] = float(element.get("lon"))
+            arrays["segment"][index] = segment
+            for child in element:
+                child_name = _local_name(child.tag)
+                if child_name == "ele" and child.text:
+                    arrays["elevation"][index] = float(child.text)
+                elif child_name == "time" and child.text:
+                    arrays["time"][index] = _parse_time(child.text)
+            index += 1
+
+            # drop the parsed point so the tree never grows
+            element.clear()
+            if parent is not None:
+                parent.remove(element)
+    finally:
+        if file_pointer is not source:
+            file_pointer.close()
+
+    return {key: array[:index] for key, array in arrays.items()}
+
+
+def read_tcx(source: GpxSource) -> Dict[str, np.ndarray]:
+    """
+    Streams the trackpoints of a tcx file into the same arrays as read_gpx.
+    Every Track element of every Lap is a segment, points without a position are skipped.
+    """
+    file_pointer = _open(source)
+    columns = {"time": [], "latitude": [], "longitude": [], "elevation": [], "segment": []}
+    try:
+        segment = -1
+        parent = None
+        for event, element in ElementTree.iterparse(file_pointer, events=("start", "end")):
+            name = _local_name(element.tag)
+            if event == "start":
+                if name == "Track":
+                    segment += 1
+                    parent = element
+                continue
+            if name != "Trackpoint":
+                if name == "Track":
+                    parent = None
+                    element.clear()
+                continue
+
+            point = {"time": None, "latitude": None, "longitude": None, "elevation": np.nan}
+            for child in element.iter():
+                child_name = _local_name(child.tag)
+                if child_name == "Time" and child.text:
+                    point["time"] = _parse_time(child.text)
+                elif child_name == "LatitudeDegrees":
+                    point["latitude"] = float(child.text)
+                elif child_name == "LongitudeDegrees":
+                    point["longitude"] = float(child.text)
+                elif child_name == "AltitudeMeters" and child.text:
+                    point["elevation"] = float(child.text)
+
+            if point["latitude"] is not None and point["longitude"] is not None:
+                for key, value in point.items():
+                    columns[key].append(value)
+                columns["segment"].append(segment)
+
+            element.clear()
+            if parent is not None:
+                parent.remove(element)
+    finally:
+        if file_pointer is not source:
+            file_pointer.close()
+
+    return {
+        "time": np.array(
+            [np.datetime64("NaT") if t is None else t for t in columns["time"]], dtype="datetime64[ns]"),
+        "latitude": np.array(columns["latitude"], dtype=np.float64),
+        "longitude": np.array(columns["longitude"], dtype=np.float64),
+        "elevation": np.array(columns["elevation"], dtype=np.float64),
+        "segment": np.array(columns["segment"], dtype=np.int32),
+    }
 
 
 def load_gpx(path: str) -> gpd.GeoDataFrame:
-    with open(path) as file_pointer:
-        gpx_content = gpxpy.parse(file_pointer)
-
-    gpx_data = []
-    gpx_geometry = []
-    for point in gpx_content.tracks[0].segments[0].points:
-        gpx_geometry.append(Point(point.longitude, point.latitude))
-        gpx_data.append({
-            # clear tzinfo until it can be handled for the match query
-            # TODO: is this still causing issues with valhalla?
-            "time": point.time.replace(tzinfo=None),
-            "elev": point.elevation,
-            "longitude": point.longitude,
-            "latitude": point.latitude
-        })
+    gpx_arrays = read_gpx(path)
 
     gpx_frame = gpd.GeoDataFrame(
-        gpx_data, geometry=gpx_geometry, crs="EPSG:4326").to_crs("EPSG:3857")
+        {
+            "time": gpx_arrays["time"],
+            "elev": gpx_arrays["elevation"],
+            "longitude": gpx_arrays["longitude"],
+            "latitude": gpx_arrays["latitude"],
+        },
+        geometry=gpd.points_from_xy(gpx_arrays["longitude"], gpx_arrays["latitude"]),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3857")
     # search for splits in the trace bigger than 1s and label consecutive sections
+    # a new track or segment always starts a new section
     # TODO: automatically determine default interval; it can't be 1s for every track right?
-    gpx_frame["section"] = (gpx_frame["time"].diff() != pd.Timedelta("1 second")).cumsum()
+    gpx_frame["section"] = (
+            (gpx_frame["time"].diff() != pd.Timedelta("1 second")) |
+            (pd.Series(gpx_arrays["segment"]).diff() != 0)
+    ).cumsum()
 
     return gpx_frame
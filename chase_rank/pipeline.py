@@ -0,0 +1,294 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+import pandas as pd
+
+from .elevation import ElevationCorrector
+from .instrumentation import record_cache
+from .process import from_track_match, get_section_analytics, surface_stats
+
+# marks the end of the stream in a stage queue
+_DONE = object()
+# how often blocked threads check whether the consumer stopped the run
+_POLL_SECONDS = 0.1
+
+
+@dataclass
+class Stage:
+    name: str
+    # the function gets a single item and returns the item for the next stage
+    # returning None drops the item from the stream
+    function: Callable[[Any], Any]
+    concurrency: int = 1
+    # size of the queue in front of the stage, a full queue blocks the previous stage
+    buffer_size: int = 4
+
+
+@dataclass
+class StageStats:
+    name: str
+    concurrency: int
+    items_in: int = 0
+    items_out: int = 0
+    items_dropped: int = 0
+    items_failed: int = 0
+    busy_seconds: float = 0.
+    started: float = None
+    finished: float = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def wall_seconds(self) -> float:
+        if self.started is None:
+            return 0.
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        # items per second of wall time the stage was running
+        return self.items_out / self.wall_seconds if self.wall_seconds else 0.
+
+    @property
+    def utilization(self) -> float:
+        # share of the available worker time spent inside the stage function
+        available = self.wall_seconds * self.concurrency
+        return self.busy_seconds / available if available else 0.
+
+    def as_dict(self) -> Dict:
+        return {
+            "stage": self.name,
+            "concurrency": self.concurrency,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "items_dropped": self.items_dropped,
+            "items_failed": self.items_failed,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "busy_seconds": round(self.busy_seconds, 3),
+            "throughput": round(self.throughput, 3),
+            "utilization": round(self.utilization, 3),
+        }
+
+
+class Pipeline:
+    """
+    Runs a chain of stages concurrently, every stage with its own worker threads.
+    Stages are connected by bounded queues, so a slow stage blocks the ones before it
+    instead of letting unprocessed items pile up in memory.
+    """
+
+    def __init__(self, stages: List[Stage]):
+        if not stages:
+            raise ValueError("a pipeline needs at least one stage")
+        self.stages = stages
+        self.stats = [StageStats(stage.name, stage.concurrency) for stage in stages]
+        self.errors: List[tuple] = []
+
+    @staticmethod
+    def _put(output: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        # blocks while the queue is full, gives up once the run was stopped
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, source: Iterable, output: queue.Queue, consumers: int, stop: threading.Event):
+        try:
+            for item in source:
+                if not self._put(output, item, stop):
+                    break
+        except Exception as e:
+            # a failing source ends the stream, everything fetched so far still gets processed
+            self.errors.append(("source", None, e))
+        finally:
+            for _ in range(consumers):
+                self._put(output, _DONE, stop)
+
+    def _work(self,
+              stage: Stage,
+              stats: StageStats,
+              input_queue: queue.Queue,
+              output_queue: queue.Queue,
+              running: List[int],
+              consumers: int,
+              stop: threading.Event):
+        while not stop.is_set():
+            try:
+                item = input_queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+
+            with stats.lock:
+                stats.items_in += 1
+            start = time.perf_counter()
+            failed = False
+            try:
+                result = stage.function(item)
+            except Exception as e:
+                # a single broken activity should not stop the whole run
+                result = None
+                failed = True
+                self.errors.append((stage.name, item, e))
+            with stats.lock:
+                stats.busy_seconds += time.perf_counter() - start
+                # failed items are counted once, only items the function returned None for are dropped
+                if failed:
+                    stats.items_failed += 1
+                elif result is None:
+                    stats.items_dropped += 1
+
+            if result is None:
+                continue
+            if not self._put(output_queue, result, stop):
+                break
+            with stats.lock:
+                stats.items_out += 1
+
+        # the last worker of a stage closes the stream for the next stage
+        with stats.lock:
+            running[0] -= 1
+            last_worker = running[0] == 0
+            if last_worker:
+                stats.finished = time.perf_counter()
+        if last_worker:
+            for _ in range(consumers):
+                self._put(output_queue, _DONE, stop)
+
+    def run(self, source: Iterable) -> Iterator:
+        """
+        Streams the items of source through all stages and yields the results of the last stage.
+        Results are yielded in completion order, not in the order of the source.
+        Stopping the iteration early stops all stages, the items they are working on are finished first.
+        """
+        queues = [queue.Queue(maxsize=stage.buffer_size) for stage in self.stages]
+        # the consumer of the last stage is this generator
+        queues.append(queue.Queue(maxsize=self.stages[-1].buffer_size))
+        stop = threading.Event()
+
+        threads = [threading.Thread(
+            target=self._feed,
+            args=(source, queues[0], self.stages[0].concurrency, stop),
+            name="pipeline-source",
+            daemon=True
+        )]
+        for index, (stage, stats) in enumerate(zip(self.stages, self.stats)):
+            consumers = self.stages[index + 1].concurrency if index + 1 < len(self.stages) else 1
+            running = [stage.concurrency]
+            stats.started = time.perf_counter()
+            for worker in range(stage.concurrency):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, stats, queues[index], queues[index + 1], running, consumers, stop),
+                    name=f"pipeline-{stage.name}-{worker}",
+                    daemon=True
+                ))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # also reached when the caller stops iterating, the threads must not block on full queues forever
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def report(self) -> pd.DataFrame:
+        return pd.DataFrame([stats.as_dict() for stats in self.stats]).set_index("stage")
+
+
+@dataclass
+class PipelineResult:
+    activity_id: int
+    user_id: int
+    match: Any
+    sections: pd.DataFrame
+    surfaces: Dict
+
+
+def activity_source(activity_handler,
+                    user_ids: List[int],
+                    before: datetime = None,
+                    after: datetime = None,
+                    refresh: bool = False,
+                    sport_types: List[str] = None
+                    ) -> Iterator[tuple]:
+    # yields (activity_id, user_id, start_date) as soon as the activities of a user are available
+    # so tracks of the first user are already downloading while the next user is refreshed
+    for user_id in user_ids:
+        user_activities = activity_handler.get_user_activities(
+            user_id=user_id, before=before, after=after, refresh=refresh)
+        # only activities with a start and end point have a track we can match
+        user_activities = user_activities[
+            (~user_activities["start_lat"].isna()) &
+            (~user_activities["end_lat"].isna())]
+        if sport_types:
+            user_activities = user_activities[user_activities["sport_type"].isin(sport_types)]
+        for activity_id, activity_user_id, start_date in user_activities[
+                ["strava_id", "user_id", "start_date"]].values:
+            yield int(activity_id), int(activity_user_id), start_date
+
+
+def build_pipeline(track_handler,
+                   match_handler,
+                   matcher,
+                   fetch_concurrency: int = 2,
+                   match_concurrency: int = 2,
+                   analyze_concurrency: int = 1,
+                   buffer_size: int = 4,
+                   rematch: bool = False,
+                   elevation_corrector: ElevationCorrector = None
+                   ) -> Pipeline:
+    """
+    Chains TrackHandler, a Matcher (ValhallaHandler, OSRMHandler or RouteIndexHandler) with MatchHandler and the analytics of process.
+    Feed it with activity_source(...) and iterate over Pipeline.run to get PipelineResults.
+    """
+
+    def fetch(item: tuple) -> tuple:
+        activity_id, user_id, start_date = item
+        track = track_handler.get(activity_id=activity_id, user_id=user_id, start_time=start_date)
+        return activity_id, user_id, track
+
+    def match(item: tuple) -> (tuple, None):
+        activity_id, user_id, track = item
+        if not rematch and activity_id in match_handler.match_id_list:
+            record_cache("match", hit=True)
+            return activity_id, user_id, match_handler.get(activity_id)
+        record_cache("match", hit=False)
+        matched = matcher.match(track)
+        if matched is None:
+            return None
+        match_handler.add(activity_id, matched, user_id=user_id)
+        return activity_id, user_id, matched
+
+    def analyze(item: tuple) -> PipelineResult:
+        activity_id, user_id, matched = item
+        points_df = from_track_match(matched)
+        if elevation_corrector is not None:
+            points_df = elevation_corrector.correct(points_df)
+        return PipelineResult(
+            activity_id=activity_id,
+            user_id=user_id,
+            match=matched,
+            sections=get_section_analytics(points_df),
+            surfaces=surface_stats(points_df)
+        )
+
+    return Pipeline([
+        Stage("fetch", fetch, concurrency=fetch_concurrency, buffer_size=buffer_size),
+        Stage("match", match, concurrency=match_concurrency, buffer_size=buffer_size),
+        Stage("analyze", analyze, concurrency=analyze_concurrency, buffer_size=buffer_size),
+    ])
@@ -1,37 +1,45 @@
+from __future__ import annotations
+
 import json
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from datetime import timedelta
+from typing import Dict
 
-import geopy.distance
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 
 import collections
 import time
 
+from .elevation import ElevationCorrector
+from .lazy import lazy_import
+
+gpd = lazy_import("geopandas")
+geopy_distance = lazy_import("geopy.distance")
+
 # TODO: könnte schon etwas dynamischer sein
 DATA_PATH = Path("../data")
 TEST_TRACK_PATH = Path(DATA_PATH, "routes/test_track.gpx")
 
 
 def combine_data(gpx_df, trace_df, edges_df):
-    trace_data_df = trace_df.apply(
-        lambda row: edges_df.iloc[row["edge_index"]]
-        if isinstance(row["edge_index"], int) else None, axis=1)[
-        ["length", "speed", "use", "unpaved", "surface", "travel_mode", "osm_way_id",
-         "geometry"]]
+    # same lookup as ValhallaHandler._combine_data, keeps the categorical dtypes of the edges
+    edge_positions = pd.to_numeric(trace_df["edge_index"]).fillna(-1).astype(np.int64).values
+    trace_data_df = pd.DataFrame(edges_df[
+        ["length", "speed", "use", "unpaved", "surface", "travel_mode", "osm_way_id"]
+    ].reset_index(drop=True).reindex(edge_positions))
+    trace_data_df.index = gpx_df.index
     trace_data_df["surface_section"] = (trace_data_df["surface"] != trace_data_df.shift()["surface"]).cumsum()
     gpx_df_copy = gpx_df.copy()
-    gpx_df_copy[["surface", "surface_section", "use", "osm_way_id"]] = trace_data_df[
-        ["surface", "surface_section", "use", "osm_way_id"]]
+    for column in ["surface", "surface_section", "use", "osm_way_id"]:
+        gpx_df_copy[column] = trace_data_df[column]
 
     # get distance
     shift_frame = gpx_df_copy.shift(-1).drop("geometry", axis=1).rename(
         columns={"longitude": "longitude_2", "latitude": "latitude_2"})
 
     def dist(row: pd.core.series.Series) -> np.float64:
-        return geopy.distance.geodesic(
+        return geopy_distance.geodesic(
             (row["latitude"], row["longitude"]), (row["latitude_2"], row["longitude_2"])
         ).meters
 
@@ -43,53 +51,72 @@ def combine_data(gpx_df, trace_df, edges_df):
     return gpx_df_copy
 
 
-def get_section_analytics(gpx_frame: gpd.GeoDataFrame) -> pd.DataFrame:
-    last_time = None
-    section_dict = {
-        "section": [],
-        "paused_time": [],
-        "total_asc": [],
-        "total_desc": [],
-        "total_distance": [],
-        "arg_kph": [],
-        "distance_between_stops": []
-    }
-
-    # Pause TIME
-    for index, group in gpx_frame.groupby(gpx_frame["section"]):
-        paused_time = group.iloc[0]["time"] - last_time if last_time else timedelta(days=0)
-        last_time = group.iloc[-1]["time"]
-
-        # print(index,paused_time)
-        section_dict["section"].append(index)
-        section_dict["paused_time"].append(paused_time)
+def from_track_match(match: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    # matches of TrackHandler tracks use other column names than the frames of match.load_gpx
+    points_df = match.rename(columns={"timestamp": "time", "altitude": "elev"})
+    # label consecutive sections the same way match.load_gpx does
+    points_df["section"] = (points_df["time"].diff() != pd.Timedelta("1 second")).cumsum()
+    return points_df
 
-        # Asc Desc
-        total_asc = 0
-        total_desc = 0
-        for i in range(0, len(group) - 1):
-            a = i + 1
-            diff = group.iloc[a]["elev"] - group.iloc[i]["elev"]
 
-            if diff >= 0:
-                total_asc = total_asc + diff
-            elif diff <= 0:
-                total_desc = total_desc + diff
-
-        section_dict["total_asc"].append(round(total_asc, 2))
-        section_dict["total_desc"].append(round(total_desc, 2))
-
-        # Km and Kph
-        distance = group["distance"].sum()
-
-        avrg_kph = distance / len(group) * 3.6
-        section_dict["total_distance"].append(round(distance, 2))
-        section_dict["arg_kph"].append(round(avrg_kph, 2))
+def get_section_analytics(gpx_frame: gpd.GeoDataFrame) -> pd.DataFrame:
+    if not len(gpx_frame):
+        # no sections, the positions of first and last points below would be out of bounds
+        return pd.DataFrame({
+            "section": pd.Series(dtype=gpx_frame["section"].dtype),
+            "paused_time": pd.Series(dtype="timedelta64[ns]"),
+            "total_asc": pd.Series(dtype=np.float64),
+            "total_desc": pd.Series(dtype=np.float64),
+            "total_distance": pd.Series(dtype=np.float64),
+            "arg_kph": pd.Series(dtype=np.float64),
+            "distance_between_stops": pd.Series(dtype=np.float64),
+        })
+
+    # order points by section without changing the order inside a section, like groupby does
+    sections = gpx_frame["section"].values
+    order = np.argsort(sections, kind="stable")
+    sections = sections[order]
+    times = gpx_frame["time"].values[order]
+    elevations = gpx_frame["elev"].values[order].astype(np.float64)
+    distances = gpx_frame["distance"].values[order].astype(np.float64)
+
+    # position of every point's section and of the first and last point of every section
+    new_section = np.empty(len(sections), dtype=bool)
+    new_section[:1] = True
+    new_section[1:] = sections[1:] != sections[:-1]
+    section_index = np.cumsum(new_section) - 1
+    starts = np.flatnonzero(new_section)
+    ends = np.append(starts[1:], len(sections)) - 1
+    section_count = len(starts)
 
+    # Pause TIME
+    paused_time = np.zeros(section_count, dtype="timedelta64[ns]")
+    paused_time[1:] = times[starts[1:]] - times[ends[:-1]]
+
+    # Asc Desc, only between points of the same section
+    diffs = np.diff(elevations)
+    same_section = ~new_section[1:]
+    with np.errstate(invalid="ignore"):
+        ascents = np.where(same_section & (diffs >= 0), diffs, 0.)
+        descents = np.where(same_section & (diffs <= 0), diffs, 0.)
+    total_asc = np.bincount(section_index[1:], weights=ascents, minlength=section_count)
+    total_desc = np.bincount(section_index[1:], weights=descents, minlength=section_count)
+
+    # Km and Kph
+    distance = np.bincount(section_index, weights=np.nan_to_num(distances), minlength=section_count)
+    avrg_kph = distance / np.bincount(section_index, minlength=section_count) * 3.6
+
+    section_df = pd.DataFrame(data={
+        "section": sections[starts],
+        "paused_time": pd.to_timedelta(paused_time),
+        # round like python does, numpy rounds halves to even
+        "total_asc": [round(value, 2) for value in total_asc.tolist()],
+        "total_desc": [round(value, 2) for value in total_desc.tolist()],
+        "total_distance": [round(value, 2) for value in distance.tolist()],
+        "arg_kph": [round(value, 2) for value in avrg_kph.tolist()],
         # Distance between Stops
-        section_dict["distance_between_stops"].append(group.iloc[-1]["distance"])
-
-    section_df = pd.DataFrame(data=section_dict)
+        "distance_between_stops": distances[ends],
+    })
     return section_df
 
 
@@ -99,11 +126,16 @@ def get_duration(points_df):
     return time_as_time
 
 
+def _count_paused_points(points_df) -> int:
+    # points that repeat the coordinate of the point before are counted as paused,
+    # crossing an earlier part of the track is no pause
+    coordinates = points_df[["latitude", "longitude"]]
+    return int((coordinates == coordinates.shift()).all(axis=1).sum())
+
+
 # TODO: Paused Time ist noch nicht korrekt. Diff zu SUM(Section Paused time), ebenso die Duration
 def get_pause_duration(points_df):
-    points_df['coordinates'] = points_df.apply(lambda row: (row['latitude'], row['longitude']), axis=1)
-    driving_time = points_df['coordinates'].nunique()
-    time_as_int = len(points_df) - driving_time
+    time_as_int = _count_paused_points(points_df)
     time_as_time = time.strftime('%H:%M:%S', time.gmtime(time_as_int))
     return time_as_time
 
@@ -115,71 +147,259 @@ def get_elevation_info(points_df):
     return total_asc, total_desc
 
 
-def checkKey(dic, key):
-    if key in dic.keys():
-        result = dic[key]
+def surface_stats(gpx_frame: gpd.GeoDataFrame) -> dict:
+    # points without a matched surface are collected as "null"
+    surfaces = gpx_frame["surface"]
+    if isinstance(surfaces.dtype, pd.CategoricalDtype):
+        codes, names = surfaces.cat.codes.values, surfaces.cat.categories
     else:
-        result = 0
-    return result
+        codes, names = pd.factorize(surfaces)
+    # shift the codes so "null" (-1) becomes the first bin
+    bins = codes.astype(np.int64) + 1
+    distances = gpx_frame["distance"].values.astype(np.float64)
+
+    # remove distances travelled during pauses, the last point of a section leads into the next one
+    sections = gpx_frame["section"].values
+    last_points = np.append(sections[1:] != sections[:-1], True)
+    moving_distances = np.where(last_points, 0., distances)
+    surface_distances = np.bincount(bins, weights=moving_distances, minlength=len(names) + 1)
+
+    # surfaces in the order they appear in the track
+    present, first_index = np.unique(bins, return_index=True)
+    names = np.append("null", np.asarray(names, dtype=object))
+    return {names[b]: surface_distances[b] for b in present[np.argsort(first_index)]}
+
+
+@dataclass
+class TrackSummary:
+    track_name: str
+    date: str
+    # distance without travel during pauses
+    distance: float
+    surfaces: Dict[str, float]
+    total_ascend: float
+    total_descend: float
+    # durations in seconds
+    duration: int
+    paused_time: int
+    average_kph: float
+
+    def as_dict(self) -> Dict:
+        track_info = asdict(self)
+        # flat surface columns make it easy to put summaries of many tracks in a single frame
+        for surface in SUMMARY_SURFACES:
+            track_info[surface] = self.surfaces.get(surface, 0.)
+        return track_info
+
+    @classmethod
+    def from_dict(cls, track_info: Dict) -> "TrackSummary":
+        return cls(**{key: track_info[key] for key in cls.__dataclass_fields__})
+
+
+# surfaces of valhalla and the "null" of unmatched points, see surface_stats
+SUMMARY_SURFACES = ["paved_smooth", "paved", "paved_rough", "compacted", "dirt", "gravel", "path", "null"]
+
+
+def summarize_track(points_df: gpd.GeoDataFrame,
+                    section_analytics_df: pd.DataFrame = None,
+                    track_name: str = None) -> TrackSummary:
+    if section_analytics_df is None:
+        section_analytics_df = get_section_analytics(points_df)
+
+    distance = float(
+        section_analytics_df["total_distance"].sum() - section_analytics_df["distance_between_stops"].sum())
+    total_ascend, total_descend = get_elevation_info(points_df)
+    duration = len(points_df)
+    paused_time = _count_paused_points(points_df)
+    moving_time = duration - paused_time
+
+    summary = TrackSummary(
+        track_name=track_name or TEST_TRACK_PATH.stem,
+        date=points_df["time"].iloc[0].isoformat().replace(":", "-"),
+        distance=distance,
+        surfaces={surface: float(value) for surface, value in surface_stats(points_df).items()},
+        total_ascend=float(total_ascend),
+        total_descend=float(total_descend),
+        duration=duration,
+        paused_time=paused_time,
+        average_kph=distance / moving_time * 3.6 if moving_time else 0.,
+    )
+    return summary
+
+
+def load_track_summary(folder_path: Path) -> TrackSummary:
+    with open(Path(folder_path, "track_info.json")) as file_pointer:
+        return TrackSummary.from_dict(json.load(file_pointer))
 
 
 # TODO: mach so als funktion auch keinen Sinn
-def save_match(points_df, section_analytics_df):
+def save_match(points_df, section_analytics_df, track_name: str = None) -> TrackSummary:
     PROCESSED_TRACKS_PATH = Path(DATA_PATH, "processed")
 
-    source_track_name = TEST_TRACK_PATH.stem
-    start_date = points_df["time"][0].isoformat().replace(":", "-")
-    distance = section_analytics_df["total_distance"].sum() - section_analytics_df["distance_between_stops"].sum()
-
-    folder_path = Path(PROCESSED_TRACKS_PATH, f"{start_date}_{source_track_name}")
+    summary = summarize_track(points_df, section_analytics_df, track_name=track_name)
+    folder_path = Path(PROCESSED_TRACKS_PATH, f"{summary.date}_{summary.track_name}")
     folder_path.mkdir(parents=True, exist_ok=True)
 
-    track_info = {
-        "track_name": source_track_name,
-        "date": start_date,
-        # store distance without taking travel during pauses into account
-        "distance": distance,
-        "surfaces": surface_stats(points_df),
-        "total_ascend": get_elevation_info(points_df)[0],
-        "total_descend": get_elevation_info(points_df)[1],
-        "duration": get_duration(points_df),
-        "paused_time": get_pause_duration(points_df),
-        'paved_smooth': checkKey(surface_stats(points_df), 'paved_smooth'),
-        'compacted': checkKey(surface_stats(points_df), 'compacted'),
-        'path': checkKey(surface_stats(points_df), 'path'),
-        'paved': checkKey(surface_stats(points_df), 'paved'),
-        'paved_rough': checkKey(surface_stats(points_df), 'paved_rought'),
-        'gravel': checkKey(surface_stats(points_df), 'gravel'),
-        'dirt': checkKey(surface_stats(points_df), 'dirt'),
-        'null': checkKey(surface_stats(points_df), 'null'),
-        # "average_kph":
-    }
-
     with open(Path(folder_path, "track_info.json"), "w") as file_pointer:
-        json.dump(track_info, file_pointer)
-
-    points_df.to_csv(Path(folder_path, "points.csv"))
-    section_analytics_df.to_csv(Path(folder_path, "sections.csv"))
-
-
-def surface_stats(gpx_frame: gpd.GeoDataFrame) -> dict:
-    surfaces = collections.defaultdict(lambda: 0.)  # Distance(kilometers=0))
-    for index, surface_group in gpx_frame.groupby("surface_section"):
-        surface = surface_group["surface"].values[0]
-        # distance = group["distance"].dropna(axis=0).sum()
-        distance = surface_group["distance"].sum()
-        surfaces[surface] += distance
-
-    # remove distances travelled during pauses
-    for index, section_group in gpx_frame.groupby("section"):
-        surface = section_group["surface"].values[-1]
-        surfaces[surface] -= section_group["distance"].values[-1]
-
-    return dict(surfaces)
-
-
-def process_match(gpx_df, trace_df, edges_df):
+        json.dump(summary.as_dict(), file_pointer)
+
+    points_df.to_parquet(Path(folder_path, "points.parquet"))
+    section_analytics_df.to_parquet(Path(folder_path, "sections.parquet"))
+    return summary
+
+
+class TrackAccumulator:
+    """
+    Builds the analytics of a track point by point, e.g. for live group rides.
+    Every point costs O(1), the results are the same as the batch functions give for the
+    complete track after combine_data: get_section_analytics, get_elevation_info, surface_stats
+    and summarize_track.
+    Like in combine_data the distance of a point is the distance to the next point,
+    so the latest point is only final once the next one arrives.
+    """
+
+    def __init__(self, section_interval: pd.Timedelta = pd.Timedelta("1 second")):
+        # points further apart than this start a new section, same as match.load_gpx
+        self.section_interval = section_interval
+
+        self.point_count = 0
+        self.first_time = None
+        self.total_ascend = 0.
+        self.total_descend = 0.
+        self.closed_sections = []
+        self._section = None
+        self._surfaces = collections.defaultdict(float)
+        self._paused_points = 0
+        # the latest point, waiting for its distance
+        self._pending = None
+
+    @staticmethod
+    def _surface(surface) -> str:
+        return "null" if surface is None or pd.isnull(surface) else surface
+
+    def _new_section(self, timestamp: pd.Timestamp) -> Dict:
+        index = self._section["section"] + 1 if self._section else 1
+        paused_time = timestamp - self._section["last_time"] if self._section else pd.Timedelta(0)
+        return {
+            "section": index,
+            "paused_time": paused_time,
+            "total_asc": 0.,
+            "total_desc": 0.,
+            "total_distance": 0.,
+            "points": 0,
+            "distance_between_stops": 0.,
+            "last_time": timestamp,
+            "last_elev": None,
+        }
+
+    def _finalize_pending(self, distance: float, closes_section: bool):
+        surface = self._pending["surface"]
+        self._surfaces[surface] += distance
+        self._section["total_distance"] += distance
+        if closes_section:
+            # distance travelled during the pause
+            self._surfaces[surface] -= distance
+            self._section["distance_between_stops"] = distance
+
+    def add_point(self, timestamp: pd.Timestamp, latitude: float, longitude: float, elev: float = None,
+                  surface=None):
+        timestamp = pd.Timestamp(timestamp)
+        elev = np.nan if elev is None else float(elev)
+        starts_section = self._section is None or timestamp - self._section["last_time"] != self.section_interval
+
+        if self._pending is not None:
+            distance = geopy_distance.geodesic(
+                (self._pending["latitude"], self._pending["longitude"]), (latitude, longitude)).meters
+            self._finalize_pending(distance, starts_section)
+            if (latitude, longitude) == (self._pending["latitude"], self._pending["longitude"]):
+                self._paused_points += 1
+
+            # elevation of the whole track, see get_elevation_info
+            diff = elev - self._pending["elev"]
+            if diff > 0:
+                self.total_ascend += diff
+            elif diff < 0:
+                self.total_descend += diff
+
+        if starts_section:
+            if self._section is not None:
+                self.closed_sections.append(self._section)
+            self._section = self._new_section(timestamp)
+        else:
+            # elevation inside a section, see get_section_analytics
+            diff = elev - self._section["last_elev"]
+            if diff >= 0:
+                self._section["total_asc"] += diff
+            elif diff <= 0:
+                self._section["total_desc"] += diff
+        self._section["points"] += 1
+        self._section["last_time"] = timestamp
+        self._section["last_elev"] = elev
+
+        self.first_time = self.first_time if self.first_time is not None else timestamp
+        self.point_count += 1
+        self._pending = {"latitude": latitude, "longitude": longitude, "elev": elev, "surface": self._surface(surface)}
+
+    def add_points(self, points_df: pd.DataFrame):
+        # accepts frames of match.load_gpx as well as matches of TrackHandler tracks
+        points_df = points_df.rename(columns={"timestamp": "time", "altitude": "elev"})
+        surfaces = points_df["surface"] if "surface" in points_df else [None] * len(points_df)
+        for timestamp, latitude, longitude, elev, surface in zip(
+                points_df["time"], points_df["latitude"], points_df["longitude"], points_df["elev"], surfaces):
+            self.add_point(timestamp, latitude, longitude, elev, surface)
+
+    def _state(self) -> (list, Dict):
+        # closes the pending point on copies, the last point of a track has no distance
+        sections = self.closed_sections + ([dict(self._section)] if self._section else [])
+        surfaces = dict(self._surfaces)
+        if self._pending is not None:
+            surfaces.setdefault(self._pending["surface"], 0.)
+        return sections, surfaces
+
+    @property
+    def distance(self) -> float:
+        sections, _ = self._state()
+        return sum(section["total_distance"] for section in sections)
+
+    def section_analytics(self) -> pd.DataFrame:
+        sections, _ = self._state()
+        return pd.DataFrame(data={
+            "section": [section["section"] for section in sections],
+            "paused_time": pd.to_timedelta([section["paused_time"] for section in sections]),
+            "total_asc": [round(section["total_asc"], 2) for section in sections],
+            "total_desc": [round(section["total_desc"], 2) for section in sections],
+            "total_distance": [round(section["total_distance"], 2) for section in sections],
+            "arg_kph": [round(section["total_distance"] / section["points"] * 3.6, 2) for section in sections],
+            "distance_between_stops": [section["distance_between_stops"] for section in sections],
+        })
+
+    def surface_stats(self) -> dict:
+        _, surfaces = self._state()
+        return surfaces
+
+    def summary(self, track_name: str = None) -> TrackSummary:
+        section_analytics_df = self.section_analytics()
+        distance = float(
+            section_analytics_df["total_distance"].sum() - section_analytics_df["distance_between_stops"].sum())
+        moving_time = self.point_count - self._paused_points
+        return TrackSummary(
+            track_name=track_name or TEST_TRACK_PATH.stem,
+            date=self.first_time.isoformat().replace(":", "-"),
+            distance=distance,
+            surfaces={surface: float(value) for surface, value in self.surface_stats().items()},
+            total_ascend=float(self.total_ascend),
+            total_descend=float(self.total_descend),
+            duration=self.point_count,
+            paused_time=self._paused_points,
+            average_kph=distance / moving_time * 3.6 if moving_time else 0.,
+        )
+
+
+def process_match(gpx_df, trace_df, edges_df, elevation_corrector: ElevationCorrector = None):
     points_df = combine_data(gpx_df, trace_df, edges_df)
+    if elevation_corrector is not None:
+        # replace the recorded altitude before it goes into any analytics
+        points_df = elevation_corrector.correct(points_df)
     sections_df = get_section_analytics(points_df)
 
     save_match(points_df, sections_df)
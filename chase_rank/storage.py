@@ -0,0 +1,61 @@
+"""
+Helpers for files that several processes share, e.g. a match folder on a network volume.
+"""
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+
+def temporary_path(path: Path, suffix: str = ".tmp") -> Path:
+    # hidden and next to the final file, a rename within the same folder is atomic
+    return Path(path.parent, f".{path.name}.{os.getpid()}.{threading.get_ident()}{suffix}")
+
+
+@contextmanager
+def atomic_path(path: Path, suffix: str = ".tmp") -> Iterator[Path]:
+    """
+    Yields a temporary path to write to, it replaces path once the block finished without an error.
+    Readers see either the old or the new file, never half of one.
+    """
+    temporary = temporary_path(path, suffix)
+    try:
+        yield temporary
+    except BaseException:
+        temporary.unlink(missing_ok=True)
+        raise
+    os.replace(temporary, path)
+
+
+@contextmanager
+def file_lock(path: Path, timeout: float = 60., stale_seconds: float = 600.) -> Iterator[None]:
+    """
+    Exclusive lock on path between processes and machines, the lock file next to it is created with O_EXCL.
+    Lock files older than stale_seconds were left behind by a crashed process and are broken.
+    """
+    lock_path = Path(path.parent, f"{path.name}.lock")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            descriptor = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime > stale_seconds:
+                    lock_path.unlink(missing_ok=True)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{lock_path} is held by another process")
+            time.sleep(0.05)
+            continue
+        os.write(descriptor, f"{socket.gethostname()} {os.getpid()}".encode())
+        os.close(descriptor)
+        break
+    try:
+        yield
+    finally:
+        lock_path.unlink(missing_ok=True)
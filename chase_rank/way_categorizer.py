@@ -1,12 +1,33 @@
-import overpy
+from __future__ import annotations
+
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from .lazy import lazy_import
+
+osmium = lazy_import("osmium")
+overpy = lazy_import("overpy")
 
 WAY_CATEGORIES = [
     "street",
     "gravel",
+    "dirt",
     "trail",
     "stairs",
     "unknown"
 ]
+WAY_CATEGORY_CODES = {category: code for code, category in enumerate(WAY_CATEGORIES)}
+
+# the offline index built from the .osm.pbf extracts by build_way_category_index
+WAY_CATEGORY_INDEX_PATH = Path("../data/osm/way_categories")
+# the way of every pair of consecutive nodes, built by build_way_node_index for matchers that only return nodes
+WAY_NODE_INDEX_PATH = Path("../data/osm/way_nodes")
+NODE_PAIR_DTYPE = np.dtype([("first", "<i8"), ("second", "<i8")])
 
 # https://taginfo.openstreetmap.org/keys/surface
 # surface is the most common tag we can use to determine a ways type
@@ -94,6 +115,113 @@ LANDUSE_WAY_MAP = {
 }
 
 
+# https://valhalla.github.io/valhalla/api/map-matching/api-reference/#edge-items
+# valhalla already reduces the surface tags of a way to a few values
+WAY_VALHALLA_SURFACE_MAP = {
+    "street": [
+        "paved_smooth",
+        "paved",
+        "paved_rough"
+    ],
+    "gravel": [
+        "compacted",
+        "gravel"
+    ],
+    "dirt": [
+        "dirt"
+    ],
+    "trail": [
+        "path"
+    ],
+    "unknown": [
+        "impassable"
+    ]
+}
+VALHALLA_SURFACE_WAY_MAP = {
+    surface: way
+    for way, surface_list in WAY_VALHALLA_SURFACE_MAP.items()
+    for surface in surface_list
+}
+
+# fixed categories for the string columns of matches
+# every row only stores a small integer code, parquet writes them dictionary encoded
+VALHALLA_SURFACES = ["paved_smooth", "paved", "paved_rough", "compacted", "dirt", "gravel", "path", "impassable"]
+VALHALLA_USES = [
+    "tram", "road", "ramp", "turn_channel", "track", "driveway", "alley", "parking_aisle", "emergency_access",
+    "drive_through", "culdesac", "living_street", "service_road", "cycleway", "mountain_bike", "sidewalk",
+    "footway", "elevator", "steps", "escalator", "path", "pedestrian", "bridleway", "pedestrian_crossing",
+    "rest_area", "service_area", "other", "ferry", "rail-ferry", "rail", "bus", "egress_connection",
+    "platform_connection", "transit_connection", "construction"
+]
+VALHALLA_TRAVEL_MODES = ["drive", "pedestrian", "bicycle", "transit"]
+
+WAY_CATEGORY_DTYPE = pd.CategoricalDtype(WAY_CATEGORIES)
+SURFACE_DTYPE = pd.CategoricalDtype(VALHALLA_SURFACES)
+USE_DTYPE = pd.CategoricalDtype(VALHALLA_USES)
+TRAVEL_MODE_DTYPE = pd.CategoricalDtype(VALHALLA_TRAVEL_MODES)
+MATCH_DTYPES = {
+    "surface": SURFACE_DTYPE,
+    "use": USE_DTYPE,
+    "travel_mode": TRAVEL_MODE_DTYPE,
+}
+
+# way category code of every surface code, the last entry takes missing and unexpected surfaces
+_SURFACE_CATEGORY_CODES = np.array(
+    [WAY_CATEGORY_CODES[VALHALLA_SURFACE_WAY_MAP[surface]] for surface in VALHALLA_SURFACES] +
+    [WAY_CATEGORY_CODES["unknown"]],
+    dtype=np.int8
+)
+
+
+def as_categorical(values: pd.Series, dtype: pd.CategoricalDtype) -> pd.Series:
+    """
+    Casts values to the fixed categories of dtype.
+    Values outside of the categories are appended to them instead of silently turning into NaN.
+    """
+    if values.dtype == dtype:
+        return values
+    unique = pd.Index(np.asarray(values.dropna().unique(), dtype=object))
+    extra = unique.difference(dtype.categories, sort=False)
+    if len(extra):
+        dtype = pd.CategoricalDtype(dtype.categories.append(extra))
+    return values.astype(dtype)
+
+
+def with_match_dtypes(frame: pd.DataFrame) -> pd.DataFrame:
+    # applies MATCH_DTYPES to all of its columns the frame has
+    for column, dtype in MATCH_DTYPES.items():
+        if column in frame:
+            frame[column] = as_categorical(frame[column], dtype)
+    return frame
+
+
+def categorize_surfaces(surfaces: pd.Series) -> pd.Series:
+    """
+    Maps the valhalla surfaces of a match to way categories, missing surfaces are unknown.
+    Works on the category codes, no string is hashed per row.
+    """
+    codes = as_categorical(surfaces, SURFACE_DTYPE).cat.codes.values
+    unknown = len(VALHALLA_SURFACES)
+    codes = np.where((codes < 0) | (codes >= unknown), unknown, codes)
+    return pd.Series(
+        pd.Categorical.from_codes(_SURFACE_CATEGORY_CODES[codes], dtype=WAY_CATEGORY_DTYPE),
+        index=surfaces.index
+    )
+
+
+def categorize_tags(tags: Dict[str, str]) -> str:
+    """
+    Determines the category of a way from its tags.
+    Tag values we don't know fall through to the next tag instead of raising a KeyError.
+    """
+    for key, tag_map in (("surface", SURFACE_WAY_MAP), ("highway", HIGHWAY_WAY_MAP), ("landuse", LANDUSE_WAY_MAP)):
+        category = tag_map.get(tags.get(key))
+        if category:
+            return category
+
+    return "unknown"
+
+
 def categorize_way(way: overpy.Way) -> str:
     """
     Determines the category of a way and returns it as a string.
@@ -101,12 +229,164 @@ def categorize_way(way: overpy.Way) -> str:
     if not way:
         return "unknown"
 
-    tags = way.tags
-    if "surface" in tags:
-        return SURFACE_WAY_MAP[tags["surface"]]
-    elif "highway" in tags:
-        return HIGHWAY_WAY_MAP[tags["highway"]]
-    elif "landuse" in tags:
-        return LANDUSE_WAY_MAP[tags["landuse"]]
+    return categorize_tags(way.tags)
 
-    return "unknown"
+
+def _way_category_collector() -> osmium.SimpleHandler:
+    # defined on demand, deriving from osmium.SimpleHandler at import time would import osmium
+
+    class WayCategoryCollector(osmium.SimpleHandler):
+
+        def __init__(self):
+            super().__init__()
+            # arrays keep the ids of a whole region compact until they are sorted
+            self.way_ids = array("q")
+            self.codes = array("B")
+
+        def way(self, way):
+            tags = {key: way.tags.get(key) for key in ("surface", "highway", "landuse") if key in way.tags}
+            category = categorize_tags(tags)
+            # ways missing from the index are unknown anyway, most buildings and boundaries never need to be stored
+            if category != "unknown":
+                self.way_ids.append(way.id)
+                self.codes.append(WAY_CATEGORY_CODES[category])
+
+    return WayCategoryCollector()
+
+
+def build_way_category_index(pbf_paths: List[Path], index_path: Path = WAY_CATEGORY_INDEX_PATH):
+    """
+    Categorizes every way of the given .osm.pbf extracts once and stores the result as two sorted arrays,
+    osm way ids and category codes (positions in WAY_CATEGORIES).
+    """
+    collector = _way_category_collector()
+    for pbf_path in pbf_paths:
+        collector.apply_file(str(pbf_path), locations=False)
+
+    way_ids = np.frombuffer(collector.way_ids, dtype=np.int64)
+    codes = np.frombuffer(collector.codes, dtype=np.uint8)
+    # overlapping extracts contain the same ways more than once
+    way_ids, first_index = np.unique(way_ids, return_index=True)
+
+    index_path.mkdir(parents=True, exist_ok=True)
+    np.save(Path(index_path, "way_ids.npy"), way_ids)
+    np.save(Path(index_path, "categories.npy"), codes[first_index])
+
+
+class WayCategoryIndex:
+    """
+    Memory maps an index written by build_way_category_index and categorizes many ways at once.
+    """
+
+    def __init__(self, index_path: Path = WAY_CATEGORY_INDEX_PATH):
+        self.index_path = index_path
+        self.way_ids = np.load(Path(index_path, "way_ids.npy"), mmap_mode="r")
+        self.codes = np.load(Path(index_path, "categories.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.way_ids)
+
+    def category_codes(self, way_ids: np.ndarray) -> np.ndarray:
+        # missing or unknown way ids (including NaN of unmatched points) get the code of "unknown"
+        way_ids = np.asarray(way_ids, dtype=np.float64)
+        valid = ~np.isnan(way_ids)
+        lookup_ids = np.where(valid, way_ids, -1).astype(np.int64)
+
+        positions = np.searchsorted(self.way_ids, lookup_ids)
+        positions = np.minimum(positions, max(len(self.way_ids) - 1, 0))
+        found = valid & (len(self.way_ids) > 0)
+        if len(self.way_ids):
+            found &= np.asarray(self.way_ids[positions]) == lookup_ids
+
+        codes = np.full(len(lookup_ids), WAY_CATEGORY_CODES["unknown"], dtype=np.uint8)
+        codes[found] = self.codes[positions[found]]
+        return codes
+
+    def categorize_ways(self, way_ids: np.ndarray) -> pd.Categorical:
+        return pd.Categorical.from_codes(self.category_codes(way_ids), dtype=WAY_CATEGORY_DTYPE)
+
+
+@lru_cache(maxsize=4)
+def _load_index(index_path: Path) -> WayCategoryIndex:
+    return WayCategoryIndex(index_path)
+
+
+def categorize_ways(way_ids: np.ndarray, index_path: Path = WAY_CATEGORY_INDEX_PATH) -> pd.Categorical:
+    """
+    Categorizes all given osm way ids with a single lookup in the offline index, e.g. a whole match frame:
+    categorize_ways(match["osm_way_id"].values)
+    """
+    return _load_index(index_path).categorize_ways(way_ids)
+
+
+def _way_node_collector() -> osmium.SimpleHandler:
+
+    class WayNodeCollector(osmium.SimpleHandler):
+
+        def __init__(self):
+            super().__init__()
+            self.first = array("q")
+            self.second = array("q")
+            self.way_ids = array("q")
+
+        def way(self, way):
+            # only ways a matcher can route on
+            if "highway" not in way.tags:
+                return
+            nodes = [node.ref for node in way.nodes]
+            for first, second in zip(nodes[:-1], nodes[1:]):
+                # the direction a way is ridden in doesn't matter
+                self.first.append(min(first, second))
+                self.second.append(max(first, second))
+                self.way_ids.append(way.id)
+
+    return WayNodeCollector()
+
+
+def build_way_node_index(pbf_paths: List[Path], index_path: Path = WAY_NODE_INDEX_PATH):
+    """
+    Stores the osm way id of every pair of consecutive nodes of the highways in the given .osm.pbf extracts
+    as two arrays, the sorted node pairs (NODE_PAIR_DTYPE) and their way ids.
+    """
+    collector = _way_node_collector()
+    for pbf_path in pbf_paths:
+        collector.apply_file(str(pbf_path), locations=False)
+
+    pairs = np.empty(len(collector.way_ids), dtype=NODE_PAIR_DTYPE)
+    pairs["first"] = np.frombuffer(collector.first, dtype=np.int64)
+    pairs["second"] = np.frombuffer(collector.second, dtype=np.int64)
+    way_ids = np.frombuffer(collector.way_ids, dtype=np.int64)
+    # overlapping extracts contain the same ways more than once
+    pairs, first_index = np.unique(pairs, return_index=True)
+
+    index_path.mkdir(parents=True, exist_ok=True)
+    np.save(Path(index_path, "node_pairs.npy"), pairs)
+    np.save(Path(index_path, "way_ids.npy"), way_ids[first_index])
+
+
+class WayNodeIndex:
+    """
+    Memory maps an index written by build_way_node_index and finds the ways of many node pairs at once.
+    """
+
+    def __init__(self, index_path: Path = WAY_NODE_INDEX_PATH):
+        self.index_path = index_path
+        self.pairs = np.load(Path(index_path, "node_pairs.npy"), mmap_mode="r")
+        self.way_ids = np.load(Path(index_path, "way_ids.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.way_ids)
+
+    def way_ids_of(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        # way ids as float like in the matches, NaN for unknown pairs
+        pairs = np.empty(len(first), dtype=NODE_PAIR_DTYPE)
+        pairs["first"] = np.minimum(first, second)
+        pairs["second"] = np.maximum(first, second)
+
+        way_ids = np.full(len(pairs), np.nan)
+        if not len(self.pairs):
+            return way_ids
+        positions = np.minimum(np.searchsorted(self.pairs, pairs), len(self.pairs) - 1)
+        found = np.asarray(self.pairs[positions]) == pairs
+        way_ids[found] = self.way_ids[positions[found]]
+        return way_ids
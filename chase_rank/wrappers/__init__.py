@@ -1,6 +1,54 @@
-from .activity_handler import ActivityHandler
-from .user_handler import StravaUserHandler, StravaUser
-from .track_handler import TrackHandler
-from .match_handler import MatchHandler
-from .strava_handler import StravaHandler
-from .valhalla_handler import ValhallaHandler
\ No newline at end of file
+import importlib
+from typing import TYPE_CHECKING
+
+# handlers are only imported when they are first used, so a cron job that refreshes strava tokens
+# doesn't pay for geopandas, shapely and pyproj (PEP 562)
+_HANDLER_MODULES = {
+    "ActivityHandler": ".activity_handler",
+    "StravaUserHandler": ".user_handler",
+    "StravaUser": ".user_handler",
+    "TrackHandler": ".track_handler",
+    "MatchHandler": ".match_handler",
+    "WayAggregateHandler": ".way_aggregate_handler",
+    "RankingHandler": ".ranking_handler",
+    "SpatialIndexHandler": ".spatial_index_handler",
+    "RouteIndexHandler": ".route_index_handler",
+    "HeatmapHandler": ".heatmap_handler",
+    "StravaHandler": ".strava_handler",
+    "ValhallaHandler": ".valhalla_handler",
+    "OSRMHandler": ".osrm_handler",
+    "Matcher": ".matcher",
+    "StravaExportHandler": ".export_handler",
+}
+
+__all__ = list(_HANDLER_MODULES)
+
+if TYPE_CHECKING:
+    from .activity_handler import ActivityHandler
+    from .user_handler import StravaUserHandler, StravaUser
+    from .track_handler import TrackHandler
+    from .match_handler import MatchHandler
+    from .way_aggregate_handler import WayAggregateHandler
+    from .ranking_handler import RankingHandler
+    from .spatial_index_handler import SpatialIndexHandler
+    from .route_index_handler import RouteIndexHandler
+    from .heatmap_handler import HeatmapHandler
+    from .strava_handler import StravaHandler
+    from .valhalla_handler import ValhallaHandler
+    from .osrm_handler import OSRMHandler
+    from .matcher import Matcher
+    from .export_handler import StravaExportHandler
+
+
+def __getattr__(name: str):
+    module_name = _HANDLER_MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    # cache it, later lookups don't go through __getattr__ anymore
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
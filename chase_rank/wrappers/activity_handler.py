@@ -1,18 +1,44 @@
+from __future__ import annotations
+
+import logging
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, List
 
 import pandas as pd
-import geopandas as gpd
-from routingpy import utils as routingpy_utils
-from shapely.geometry import LineString
 
+from .ranking_handler import RankingHandler
+from .spatial_index_handler import SpatialIndexHandler
 from .strava_handler import StravaHandler
+from ..lazy import lazy_import
+from ..way_categorizer import as_categorical
+
+gpd = lazy_import("geopandas")
+routingpy_utils = lazy_import("routingpy.utils")
+shapely_geometry = lazy_import("shapely.geometry")
+
+# https://developers.strava.com/docs/reference/#api-models-SportType
+SPORT_TYPES = [
+    "AlpineSki", "BackcountrySki", "Badminton", "Canoeing", "Crossfit", "EBikeRide", "Elliptical",
+    "EMountainBikeRide", "Golf", "GravelRide", "Handcycle", "HighIntensityIntervalTraining", "Hike", "IceSkate",
+    "InlineSkate", "Kayaking", "Kitesurf", "MountainBikeRide", "NordicSki", "Pickleball", "Pilates", "Racquetball",
+    "Ride", "RockClimbing", "RollerSki", "Rowing", "Run", "Sail", "Skateboard", "Snowboard", "Snowshoe", "Soccer",
+    "Squash", "StairStepper", "StandUpPaddling", "Surfing", "Swim", "TableTennis", "Tennis", "TrailRun",
+    "Velomobile", "VirtualRide", "VirtualRow", "VirtualRun", "Walk", "WeightTraining", "Wheelchair", "Windsurf",
+    "Workout", "Yoga"
+]
+SPORT_TYPE_DTYPE = pd.CategoricalDtype(SPORT_TYPES)
+
+logger = logging.getLogger(__name__)
 
 
 class ActivityHandler:
 
-    def __init__(self, activities_path: Path, strava_handler: StravaHandler = None):
+    def __init__(self,
+                 activities_path: Path,
+                 strava_handler: StravaHandler = None,
+                 ranking_handler: RankingHandler = None,
+                 spatial_index: SpatialIndexHandler = None):
         self.activities_path = activities_path
         self.activities: gpd.GeoDataFrame = gpd.GeoDataFrame({
             "strava_id": pd.Series(dtype="str"),  # should be int, but parquet can't handle that yet?
@@ -22,7 +48,7 @@ class ActivityHandler:
             "moving_time": pd.Series(dtype="float"),
             "elapsed_time": pd.Series(dtype="float"),
             "total_elevation_gain": pd.Series(dtype="float"),
-            "sport_type": pd.Series(dtype="str"),
+            "sport_type": pd.Series(dtype=SPORT_TYPE_DTYPE),
             "start_date": pd.Series(dtype="datetime64[ns]"),
             "timezone": pd.Series(dtype="str"),
             "start_lat": pd.Series(dtype="float"),
@@ -38,6 +64,8 @@ class ActivityHandler:
         self._load_activities()
 
         self.strava = strava_handler
+        self.ranking = ranking_handler
+        self.spatial_index = spatial_index
 
     def __getitem__(self, key: int) -> gpd.GeoSeries:
         return self.get(key)
@@ -76,9 +104,9 @@ class ActivityHandler:
     def _load_activities(self):
         if self.activities_path.exists():
             self.activities = gpd.read_parquet(self.activities_path)
+            self.activities["sport_type"] = as_categorical(self.activities["sport_type"], SPORT_TYPE_DTYPE)
         else:
-            print("No stored activities found!")
-            # TODO: log / error
+            logger.info("No stored activities found at %s", self.activities_path)
 
     def _save_activities(self):
         self.activities.to_parquet(self.activities_path)
@@ -92,18 +120,30 @@ class ActivityHandler:
             index=[act["id"] for act in activities],
             data=[self._parse_activity(activity) for activity in activities],
             geometry=[
-                LineString(routingpy_utils.decode_polyline5(act["map"]["summary_polyline"]))
+                shapely_geometry.LineString(routingpy_utils.decode_polyline5(act["map"]["summary_polyline"]))
                 for act in activities
             ],
             crs="EPSG:4326"
         ).to_crs("EPSG:3857")
-        self.activities = pd.concat([self.activities, new_activity])
-        self._save_activities()
+        self._append_activities(new_activity)
 
-    def add(self, activities: (Dict, List[Dict])):
-        if isinstance(activities, Dict):
+    def _append_activities(self, new_activities: gpd.GeoDataFrame):
+        # frames need the activity id as index and the columns of _parse_activity
+        new_activities = new_activities[~new_activities.index.isin(self.activities.index)]
+        self.activities = pd.concat([self.activities, new_activities.to_crs("EPSG:3857")])
+        self.activities["sport_type"] = as_categorical(self.activities["sport_type"], SPORT_TYPE_DTYPE)
+        self._save_activities()
+        if self.ranking is not None:
+            self.ranking.add_activities(new_activities)
+        if self.spatial_index is not None:
+            self.spatial_index.add_activities(new_activities)
+
+    def add(self, activities: (Dict, List[Dict], gpd.GeoDataFrame)):
+        if isinstance(activities, gpd.GeoDataFrame):
+            self._append_activities(activities)
+        elif isinstance(activities, Dict):
             self._add_activities([activities])
-        if isinstance(activities, List):
+        elif isinstance(activities, List):
             self._add_activities(activities)
 
     def get(self, activity_id: int, user_id: int = None) -> gpd.GeoSeries:
@@ -135,8 +175,8 @@ class ActivityHandler:
                 activities = self.strava.get_logged_in_athlete_activities(user_id=user_id, before=before, after=after)
                 self.add(activities)
             else:
-                print("lol no strava")
-                # TODO: log & raise
+                # TODO: raise
+                logger.warning("Can't refresh activities of %s without a StravaHandler", user_id)
 
         return self.activities[
             (self.activities.user_id == str(user_id)) &  # user_id should be int, but parquet can't handle that yet?
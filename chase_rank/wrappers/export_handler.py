@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import logging
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from ..fit import read_fit
+from ..lazy import lazy_import
+from ..match import read_gpx, read_tcx
+from .activity_handler import ActivityHandler
+from .track_handler import TrackHandler
+
+gpd = lazy_import("geopandas")
+shapely_geometry = lazy_import("shapely.geometry")
+
+logger = logging.getLogger(__name__)
+
+DECODERS = {
+    ".gpx": read_gpx,
+    ".tcx": read_tcx,
+    ".fit": read_fit,
+}
+
+# the export opens the zip once per worker process instead of once per file
+_worker_archive: zipfile.ZipFile = None
+
+
+def _init_worker(export_path: str):
+    global _worker_archive
+    _worker_archive = zipfile.ZipFile(export_path)
+
+
+def _decode_member(activity_id: int, member: str) -> (int, Dict[str, np.ndarray]):
+    # runs in the worker processes, only numpy arrays travel back to the parent
+    path = Path(member)
+    compressed = path.suffix == ".gz"
+    suffix = path.with_suffix("").suffix if compressed else path.suffix
+    decoder = DECODERS.get(suffix.lower())
+    if decoder is None:
+        raise ValueError(f"unknown activity file type: {member}")
+
+    content = _worker_archive.read(member)
+    if compressed:
+        content = gzip.decompress(content)
+    # strava pads some tcx files with whitespace before the xml declaration
+    if suffix.lower() == ".tcx":
+        content = content.lstrip()
+    return activity_id, decoder(io.BytesIO(content))
+
+
+def _parse_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%b %d, %Y, %I:%M:%S %p")
+    except ValueError:
+        return pd.to_datetime(value).to_pydatetime().replace(tzinfo=None)
+
+
+def _parse_float(value: str) -> (float, None):
+    try:
+        return float(value.replace(",", "")) if value else None
+    except ValueError:
+        return None
+
+
+class StravaExportHandler:
+    """
+    Imports the zip of a strava bulk account export into TrackHandler and ActivityHandler.
+    Activity files are decoded across a process pool and mapped to activities through activities.csv,
+    so no strava api requests are needed.
+    """
+
+    def __init__(self, export_path: Path, activity_handler: ActivityHandler, track_handler: TrackHandler):
+        self.export_path = export_path
+        self.activities = activity_handler
+        self.tracks = track_handler
+
+    def _read_activity_list(self) -> List[Dict]:
+        with zipfile.ZipFile(self.export_path) as archive:
+            with archive.open("activities.csv") as file_pointer:
+                reader = csv.reader(io.TextIOWrapper(file_pointer, encoding="utf-8"))
+                header = next(reader)
+                rows = list(reader)
+
+        # some column names appear twice, the later columns hold the unformatted values
+        # e.g. Distance in km and then in m
+        columns = {name: index for index, name in enumerate(header)}
+        return [{name: row[index] if index < len(row) else "" for name, index in columns.items()}
+                for row in rows]
+
+    @staticmethod
+    def _parse_activity(row: Dict, user_id: int, track: gpd.GeoDataFrame) -> pd.Series:
+        # mirrors ActivityHandler._parse_activity for the columns available in the export
+        return pd.Series({
+            "strava_id": str(row["Activity ID"]),  # should be int, but parquet can't handle that yet?
+            "user_id": str(user_id),  # should be int, but parquet can't handle that yet?
+            "strava_name": row.get("Activity Name"),
+            "distance": _parse_float(row.get("Distance")),
+            "moving_time": _parse_float(row.get("Moving Time")),
+            "elapsed_time": _parse_float(row.get("Elapsed Time")),
+            "total_elevation_gain": _parse_float(row.get("Elevation Gain")),
+            "sport_type": row.get("Activity Type"),
+            "start_date": _parse_date(row["Activity Date"]),
+            "timezone": None,
+            "start_lat": track["latitude"].iloc[0],
+            "start_lng": track["longitude"].iloc[0],
+            "end_lat": track["latitude"].iloc[-1],
+            "end_lng": track["longitude"].iloc[-1],
+            "average_speed": _parse_float(row.get("Average Speed")),
+            "max_speed": _parse_float(row.get("Max Speed")),
+            "elev_high": _parse_float(row.get("Elevation High")),
+            "elev_low": _parse_float(row.get("Elevation Low")),
+            "external_id": row.get("Filename"),
+            "private": False,
+            "trainer": False,
+            "manual": False,
+            "commute": row.get("Commute", "").lower() in ("true", "1"),
+        })
+
+    @staticmethod
+    def _build_track(arrays: Dict[str, np.ndarray]) -> gpd.GeoDataFrame:
+        # same schema as the tracks TrackHandler builds from strava streams
+        return gpd.GeoDataFrame(
+            data={
+                "latitude": arrays["latitude"],
+                "longitude": arrays["longitude"],
+                "altitude": arrays["elevation"],
+                "timestamp": arrays["time"],
+            },
+            # x is longitude, y is latitude
+            geometry=gpd.points_from_xy(arrays["longitude"], arrays["latitude"]),
+            crs="EPSG:4326"
+        ).to_crs("EPSG:3857")
+
+    def import_export(self,
+                      user_id: int,
+                      processes: int = None,
+                      sport_types: List[str] = None,
+                      simplify_tolerance: float = 10.
+                      ) -> List[int]:
+        """
+        Decodes every activity file of the export that is not stored yet and adds the tracks
+        and activities of user_id. Returns the ids of the imported activities.
+        """
+        rows = {
+            int(row["Activity ID"]): row
+            for row in self._read_activity_list()
+            # manual activities have no file
+            if row.get("Filename")
+            and (not sport_types or row.get("Activity Type") in sport_types)
+            and int(row["Activity ID"]) not in self.tracks.track_id_list
+        }
+        if not rows:
+            return []
+
+        imported = []
+        new_activities = []
+        with ProcessPoolExecutor(
+                max_workers=processes or os.cpu_count(),
+                initializer=_init_worker,
+                initargs=(str(self.export_path),)
+        ) as executor:
+            futures = [executor.submit(_decode_member, activity_id, row["Filename"])
+                       for activity_id, row in rows.items()]
+            for future in as_completed(futures):
+                try:
+                    activity_id, arrays = future.result()
+                except Exception as e:
+                    logger.warning("Can't decode activity file: %s", e)
+                    continue
+                if len(arrays["latitude"]) < 2:
+                    continue
+
+                track = self._build_track(arrays)
+                self.tracks.add(activity_id, track)
+
+                activity = self._parse_activity(rows[activity_id], user_id, track)
+                # the api only gives us a simplified summary line as well
+                activity["geometry"] = shapely_geometry.LineString(
+                    np.column_stack([track.geometry.x, track.geometry.y])).simplify(simplify_tolerance)
+                activity.name = activity_id
+                new_activities.append(activity)
+                imported.append(activity_id)
+
+        if new_activities:
+            # a single write of the activities parquet for the whole export
+            self.activities.add(gpd.GeoDataFrame(new_activities, geometry="geometry", crs="EPSG:3857"))
+        return imported
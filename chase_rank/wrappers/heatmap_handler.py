@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import io
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from ..lazy import lazy_import
+from ..storage import atomic_path
+from ..way_categorizer import WAY_CATEGORY_CODES, categorize_surfaces
+
+gpd = lazy_import("geopandas")
+mercantile = lazy_import("mercantile")
+Image = lazy_import("PIL.Image")
+
+TILE_SIZE = 256
+# half the width of the web mercator world in EPSG:3857 meters
+ORIGIN = 20037508.342789244
+
+# way category and global pixel coordinates at max_zoom are packed into one integer, enough up to zoom 18
+_PIXEL_BITS = 26
+_PIXEL_MASK = (1 << _PIXEL_BITS) - 1
+_CATEGORY_SHIFT = 2 * _PIXEL_BITS
+
+Layer = Tuple[str, int]  # user_id, way category code
+Tile = Tuple[int, int, int]  # z, x, y
+
+
+def _merge(pixels: np.ndarray, counts: np.ndarray, new_pixels: np.ndarray, sign: int) -> (np.ndarray, np.ndarray):
+    # adds (or takes away) one to the counts of new_pixels, pixels without any count left are dropped
+    merged, inverse = np.unique(np.concatenate([pixels, new_pixels]), return_inverse=True)
+    weights = np.concatenate([counts.astype(np.int64), np.full(len(new_pixels), sign, dtype=np.int64)])
+    summed = np.bincount(inverse, weights=weights, minlength=len(merged)).astype(np.int64)
+    kept = summed > 0
+    return merged[kept].astype(np.uint16), summed[kept].astype(np.uint32)
+
+
+class HeatmapHandler:
+    """
+    Web mercator tile pyramid counting the activities that passed every pixel, per user and way category.
+    Every activity is rasterized once at max_zoom, the lower zoom levels are derived from those pixels.
+    Tiles are stored sparse (pixel, count) as one file per z/x/y and only the tiles an activity touches
+    are read and rewritten, so adding a match costs the same no matter how many are stored.
+    Rendering only reads the tiles in view. The pixels of every activity are kept to take it out again
+    on deletes and rematches.
+    At most max_tiles tiles are kept in memory, the least recently used go first and are written if changed.
+    """
+
+    def __init__(self,
+                 path: Path,
+                 min_zoom: int = 0,
+                 max_zoom: int = 16,
+                 max_gap: float = 200.,
+                 max_tiles: int = 4096,
+                 autosave: bool = True):
+        if max_zoom + 8 > _PIXEL_BITS or min_zoom > max_zoom:
+            raise ValueError(f"zoom levels {min_zoom} to {max_zoom} are not supported")
+        if max_tiles < 1:
+            raise ValueError("max_tiles has to be at least 1")
+        self.path = path
+        self.tiles_path = Path(self.path, "heatmap")
+        self.contributions_path = Path(self.path, "heatmap", "contributions")
+        self.contributions_path.mkdir(parents=True, exist_ok=True)
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        # consecutive points further apart (in EPSG:3857 meters) are not connected, e.g. after a signal loss
+        self.max_gap = max_gap
+        self.max_tiles = max_tiles
+        self.autosave = autosave
+
+        self.activity_id_list = [int(file.stem)
+                                 for file in self.contributions_path.iterdir()
+                                 if file.suffix == ".npz" and file.stem.isdigit()]
+        # tiles are read when they are first needed
+        self._tiles: OrderedDict[Tile, Dict[Layer, Tuple[np.ndarray, np.ndarray]]] = OrderedDict()
+        self._dirty = set()
+
+    def _tile_path(self, tile: Tile) -> Path:
+        z, x, y = tile
+        return Path(self.tiles_path, str(z), str(x), f"{y}.npz")
+
+    def _tile(self, tile: Tile) -> Dict[Layer, Tuple[np.ndarray, np.ndarray]]:
+        layers = self._tiles.get(tile)
+        if layers is not None:
+            self._tiles.move_to_end(tile)
+            return layers
+        layers = {}
+        tile_path = self._tile_path(tile)
+        if tile_path.exists():
+            with np.load(tile_path) as stored:
+                users, categories, pixels, counts = (
+                    stored["user_id"], stored["category"], stored["pixel"], stored["count"])
+            # rows are sorted by layer, every layer is a contiguous run
+            boundaries = np.flatnonzero((users[1:] != users[:-1]) | (categories[1:] != categories[:-1])) + 1
+            for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(users)]):
+                if end > start:
+                    layers[(str(users[start]), int(categories[start]))] = (pixels[start:end], counts[start:end])
+        self._tiles[tile] = layers
+        while len(self._tiles) > self.max_tiles:
+            self._evict()
+        return layers
+
+    def _evict(self):
+        # the least recently used tile, its changes must not get lost
+        tile = next(iter(self._tiles))
+        if tile in self._dirty:
+            self._save_tile(tile)
+            self._dirty.discard(tile)
+        del self._tiles[tile]
+
+    def _save_tile(self, tile: Tile):
+        layers = self._tiles[tile]
+        tile_path = self._tile_path(tile)
+        if not layers:
+            if tile_path.exists():
+                tile_path.unlink()
+            return
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        keys = sorted(layers)
+        sizes = [len(layers[key][0]) for key in keys]
+        # savez_compressed appends .npz to paths, the temporary file is handed over opened
+        with atomic_path(tile_path) as temporary_path, open(temporary_path, "wb") as file_pointer:
+            np.savez_compressed(
+                file_pointer,
+                user_id=np.repeat([user_id for user_id, _ in keys], sizes),
+                category=np.repeat(np.array([category for _, category in keys], dtype=np.uint8), sizes),
+                pixel=np.concatenate([layers[key][0] for key in keys]),
+                count=np.concatenate([layers[key][1] for key in keys]),
+            )
+
+    def save(self):
+        for tile in self._dirty:
+            self._save_tile(tile)
+        self._dirty.clear()
+
+    def _pixel_coordinates(self, x: np.ndarray, y: np.ndarray, zoom: int) -> (np.ndarray, np.ndarray):
+        # EPSG:3857 to global pixel coordinates, y grows to the south like in the tiles
+        scale = TILE_SIZE * 2 ** zoom / (2 * ORIGIN)
+        return (x + ORIGIN) * scale, (ORIGIN - y) * scale
+
+    def _rasterize(self, track: gpd.GeoDataFrame) -> np.ndarray:
+        """
+        Pixels at max_zoom covered by the lines between consecutive points, each packed with the way category
+        of the segment. Segments are sampled every half pixel so fast rides don't leave holes.
+        """
+        if track.empty:
+            return np.empty(0, dtype=np.int64)
+        pixel_x, pixel_y = self._pixel_coordinates(track.geometry.x.values, track.geometry.y.values, self.max_zoom)
+        if "surface" in track:
+            categories = categorize_surfaces(track["surface"]).cat.codes.values.astype(np.int64)
+        else:
+            categories = np.full(len(track), WAY_CATEGORY_CODES["unknown"], dtype=np.int64)
+
+        delta_x = np.diff(pixel_x)
+        delta_y = np.diff(pixel_y)
+        connected = np.hypot(delta_x, delta_y) <= self.max_gap * TILE_SIZE * 2 ** self.max_zoom / (2 * ORIGIN)
+        if "match_section" in track:
+            sections = track["match_section"].values
+            connected &= sections[1:] == sections[:-1]
+        steps = np.where(connected, np.ceil(2 * np.hypot(delta_x, delta_y)).astype(np.int64), 0)
+
+        segment = np.repeat(np.arange(len(steps)), steps)
+        fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+        sample_x = np.concatenate([pixel_x, pixel_x[segment] + delta_x[segment] * fraction])
+        sample_y = np.concatenate([pixel_y, pixel_y[segment] + delta_y[segment] * fraction])
+        sample_categories = np.concatenate([categories, categories[segment]])
+
+        limit = TILE_SIZE * 2 ** self.max_zoom - 1
+        packed = (
+            (sample_categories << _CATEGORY_SHIFT)
+            | (np.clip(sample_x, 0, limit).astype(np.int64) << _PIXEL_BITS)
+            | np.clip(sample_y, 0, limit).astype(np.int64)
+        )
+        # an activity counts once per pixel and category
+        return np.unique(packed)
+
+    def _apply(self, user_id: str, packed: np.ndarray, sign: int):
+        categories = packed >> _CATEGORY_SHIFT
+        pixel_x = (packed >> _PIXEL_BITS) & _PIXEL_MASK
+        pixel_y = packed & _PIXEL_MASK
+        for zoom in range(self.max_zoom, self.min_zoom - 1, -1):
+            shift = self.max_zoom - zoom
+            # pixels merging at lower zoom levels still count the activity once
+            keys = np.unique((categories << _CATEGORY_SHIFT) | ((pixel_x >> shift) << _PIXEL_BITS) | (pixel_y >> shift))
+            key_categories = keys >> _CATEGORY_SHIFT
+            key_x = (keys >> _PIXEL_BITS) & _PIXEL_MASK
+            key_y = keys & _PIXEL_MASK
+            tile_x, tile_y = key_x // TILE_SIZE, key_y // TILE_SIZE
+            local = ((key_y % TILE_SIZE) * TILE_SIZE + key_x % TILE_SIZE).astype(np.uint16)
+
+            order = np.lexsort((key_categories, tile_y, tile_x))
+            group = np.stack([tile_x, tile_y, key_categories])[:, order]
+            boundaries = np.flatnonzero((group[:, 1:] != group[:, :-1]).any(axis=0)) + 1
+            for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(order)]):
+                tile = (zoom, int(group[0, start]), int(group[1, start]))
+                layer = (user_id, int(group[2, start]))
+                layers = self._tile(tile)
+                pixels, counts = layers.get(layer, (np.empty(0, np.uint16), np.empty(0, np.uint32)))
+                pixels, counts = _merge(pixels, counts, np.sort(local[order[start:end]]), sign)
+                if len(pixels):
+                    layers[layer] = (pixels, counts)
+                else:
+                    layers.pop(layer, None)
+                self._dirty.add(tile)
+
+    def _contribution_path(self, activity_id: int) -> Path:
+        return Path(self.contributions_path, f"{activity_id}.npz")
+
+    def _take_out(self, activity_id: int):
+        contribution_path = self._contribution_path(activity_id)
+        with np.load(contribution_path) as contribution:
+            self._apply(str(contribution["user_id"]), contribution["pixels"], -1)
+        contribution_path.unlink()
+        self.activity_id_list.remove(activity_id)
+
+    def add(self, activity_id: int, user_id: int, track: gpd.GeoDataFrame):
+        """
+        Adds a track or match in EPSG:3857. Matches are split by way category, tracks count as unknown.
+        Adding an activity again replaces its previous pixels, e.g. after a rematch.
+        """
+        packed = self._rasterize(track)
+        if activity_id in self.activity_id_list:
+            self._take_out(activity_id)
+        # stored before any tile changes, saved tiles never count pixels that can't be taken out again
+        contribution_path = self._contribution_path(activity_id)
+        with atomic_path(contribution_path) as temporary_path, open(temporary_path, "wb") as file_pointer:
+            np.savez(file_pointer, pixels=packed, user_id=np.array(str(user_id)))
+        self._apply(str(user_id), packed, 1)
+        self.activity_id_list.append(activity_id)
+        if self.autosave:
+            self.save()
+
+    def remove(self, activity_id: int):
+        if activity_id not in self.activity_id_list:
+            raise KeyError
+        self._take_out(activity_id)
+        if self.autosave:
+            self.save()
+
+    def tile(self, z: int, x: int, y: int, user_id: int = None, categories: Iterable[str] = None) -> np.ndarray:
+        """
+        Activity counts of a tile as TILE_SIZE x TILE_SIZE array, rows from north to south.
+        Without user_id or categories all of them are summed up. Tiles beyond max_zoom are cut out
+        of their max_zoom ancestor and scaled up.
+        """
+        if z > self.max_zoom:
+            shift = z - self.max_zoom
+            parent = self.tile(self.max_zoom, x >> shift, y >> shift, user_id, categories)
+            size = TILE_SIZE >> shift
+            row, column = (y % (1 << shift)) * size, (x % (1 << shift)) * size
+            part = parent[row:row + size, column:column + size]
+            return np.repeat(np.repeat(part, 1 << shift, axis=0), 1 << shift, axis=1)
+
+        category_codes = None if categories is None else {WAY_CATEGORY_CODES[category] for category in categories}
+        counts = np.zeros(TILE_SIZE * TILE_SIZE, dtype=np.uint32)
+        if z >= self.min_zoom:
+            for (layer_user, layer_category), (pixels, layer_counts) in self._tile((z, x, y)).items():
+                if user_id is not None and layer_user != str(user_id):
+                    continue
+                if category_codes is not None and layer_category not in category_codes:
+                    continue
+                counts[pixels] += layer_counts
+        return counts.reshape(TILE_SIZE, TILE_SIZE)
+
+    def render(self,
+               bounds: Tuple[float, float, float, float],
+               zoom: int,
+               user_id: int = None,
+               categories: Iterable[str] = None) -> (np.ndarray, Tuple[float, float, float, float]):
+        """
+        Mosaic of the tiles covering bounds (west, south, east, north in degrees) at zoom.
+        Returns the counts together with their bounds in EPSG:3857 (left, bottom, right, top),
+        e.g. for folium.raster_layers.ImageOverlay after to_image.
+        """
+        tiles: List = list(mercantile.tiles(*bounds, zooms=zoom))
+        min_x, max_x = min(tile.x for tile in tiles), max(tile.x for tile in tiles)
+        min_y, max_y = min(tile.y for tile in tiles), max(tile.y for tile in tiles)
+        mosaic = np.zeros(((max_y - min_y + 1) * TILE_SIZE, (max_x - min_x + 1) * TILE_SIZE), dtype=np.uint32)
+        for tile in tiles:
+            row, column = (tile.y - min_y) * TILE_SIZE, (tile.x - min_x) * TILE_SIZE
+            mosaic[row:row + TILE_SIZE, column:column + TILE_SIZE] = self.tile(
+                zoom, tile.x, tile.y, user_id, categories)
+        top_left = mercantile.xy_bounds(min_x, min_y, zoom)
+        bottom_right = mercantile.xy_bounds(max_x, max_y, zoom)
+        return mosaic, (top_left.left, bottom_right.bottom, bottom_right.right, top_left.top)
+
+    @staticmethod
+    def to_image(counts: np.ndarray, color: Tuple[int, int, int] = (255, 64, 0), saturation: int = 50) -> np.ndarray:
+        # RGBA with a logarithmic alpha, pixels passed saturation times or more are fully opaque
+        alpha = np.log1p(counts.astype(np.float64)) / np.log1p(saturation)
+        image = np.zeros(counts.shape + (4,), dtype=np.uint8)
+        image[..., :3] = color
+        image[..., 3] = (np.clip(alpha, 0., 1.) * 255).astype(np.uint8)
+        return image
+
+    def tile_png(self, z: int, x: int, y: int, user_id: int = None, categories: Iterable[str] = None, **kwargs) -> bytes:
+        # for a tile server, e.g. behind a folium TileLayer
+        buffer = io.BytesIO()
+        Image.fromarray(self.to_image(self.tile(z, x, y, user_id, categories), **kwargs)).save(buffer, format="PNG")
+        return buffer.getvalue()
@@ -1,37 +1,302 @@
+from __future__ import annotations
+
+import threading
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+from .heatmap_handler import HeatmapHandler
+from .ranking_handler import RankingHandler
+from .spatial_index_handler import SpatialIndexHandler
+from ..instrumentation import span
+from ..lazy import lazy_import
+from ..storage import atomic_path, file_lock
+from .way_aggregate_handler import WayAggregateHandler
+from ..way_categorizer import SURFACE_DTYPE, USE_DTYPE, with_match_dtypes
+
+if TYPE_CHECKING:
+    from .valhalla_handler import ValhallaHandler
 
-import geopandas as gpd
+gpd = lazy_import("geopandas")
+pq = lazy_import("pyarrow.parquet")
+
+# attributes of the matched edge that every point of a match repeats
+EDGE_COLUMNS = ["osm_way_id", "surface", "use"]
 
 
 class MatchHandler:
+    """
+    Stores matches as one parquet file per activity.
+    With normalized=True the edge attributes are moved to a single edge table shared by all matches
+    and every point only keeps an integer reference into it. Both formats can be read at any time.
+    The edge table only grows, new edges are appended under a lock file after reloading it,
+    so several processes can add normalized matches to the same folder.
+    If a WayAggregateHandler, RankingHandler, SpatialIndexHandler or HeatmapHandler is given
+    it is kept up to date with every added or removed match.
+    """
 
-    def __init__(self, path: Path):
+    def __init__(self,
+                 path: Path,
+                 normalized: bool = False,
+                 way_aggregates: WayAggregateHandler = None,
+                 ranking: RankingHandler = None,
+                 spatial_index: SpatialIndexHandler = None,
+                 heatmap: HeatmapHandler = None):
         self.path = path
+        self.normalized = normalized
+        self.way_aggregates = way_aggregates
+        self.ranking = ranking
+        self.spatial_index = spatial_index
+        self.heatmap = heatmap
         self.match_id_list = []
         self._load_match_ids()
 
+        self.edges_path = Path(self.path, "edges.parquet")
+        self.edges: pd.DataFrame = pd.DataFrame({
+            "osm_way_id": pd.Series(dtype="float"),
+            "surface": pd.Series(dtype=SURFACE_DTYPE),
+            "use": pd.Series(dtype=USE_DTYPE),
+        })
+        self._edge_ids = {}
+        self._edge_arrays = None
+        # modification time and size of the edge table when it was read
+        self._edges_version = None
+        self._edges_lock = threading.Lock()
+        self._load_edges()
+
     def __getitem__(self, key: int) -> gpd.GeoDataFrame:
         return self.get(key)
 
     def _load_match_ids(self):
         self.match_id_list = [int(file.stem)
                               for file in self.path.iterdir()
-                              if file.is_file() and file.suffix == ".parquet"]
+                              if file.is_file() and file.suffix == ".parquet" and file.stem.isdigit()]
+
+    def _stored_edges_version(self) -> (tuple, None):
+        try:
+            stat = self.edges_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_edges(self):
+        self._edges_version = self._stored_edges_version()
+        if self._edges_version is not None:
+            # edge tables written before the categorical columns still hold plain strings
+            self.edges = with_match_dtypes(pd.read_parquet(self.edges_path))
+        self._edge_ids = {
+            self._edge_key(edge): edge_id
+            for edge_id, edge in enumerate(self.edges[EDGE_COLUMNS].itertuples(index=False, name=None))
+        }
+        self._edge_arrays = None
+
+    def _refresh_edges(self):
+        # picks up edges other processes appended since the table was read
+        if self._stored_edges_version() != self._edges_version:
+            self._load_edges()
+
+    def _save_edges(self):
+        with atomic_path(self.edges_path) as temporary_path:
+            self.edges.to_parquet(temporary_path)
+        self._edges_version = self._stored_edges_version()
+
+    @staticmethod
+    def _edge_key(edge: tuple) -> tuple:
+        # NaN never equals itself, use None so missing attributes still produce the same key
+        return tuple(None if pd.isnull(value) else value for value in edge)
+
+    def _edge_references(self, match: gpd.GeoDataFrame) -> np.ndarray:
+        keys = match[EDGE_COLUMNS]
+        # points without any edge attribute reference no edge at all
+        unmatched = keys.isnull().all(axis=1).values
+
+        # combine the factorized columns into one code per distinct edge, missing values get code 0
+        combined = np.zeros(len(keys), dtype=np.int64)
+        for column in EDGE_COLUMNS:
+            codes = pd.factorize(keys[column])[0] + 1
+            combined = combined * (codes.max(initial=0) + 1) + codes
+        _, first_index, group_index = np.unique(combined, return_index=True, return_inverse=True)
+
+        # the distinct edges of a match are few, only those go through python
+        group_keys = [self._edge_key(edge) for edge in keys.iloc[first_index].itertuples(index=False, name=None)]
+        with self._edges_lock:
+            if any(key not in self._edge_ids for key in group_keys):
+                # ids are positions in the shared table, they are only handed out while holding its lock
+                with file_lock(self.edges_path):
+                    self._refresh_edges()
+                    new_edges = []
+                    for key in group_keys:
+                        if key not in self._edge_ids:
+                            self._edge_ids[key] = len(self._edge_ids)
+                            new_edges.append(key)
+                    if new_edges:
+                        self.edges = pd.concat(
+                            [self.edges, pd.DataFrame(new_edges, columns=EDGE_COLUMNS)], ignore_index=True)
+                        self.edges["osm_way_id"] = self.edges["osm_way_id"].astype("float")
+                        self.edges = with_match_dtypes(self.edges)
+                        self._edge_arrays = None
+                        self._save_edges()
+            group_edge_ids = np.array([self._edge_ids[key] for key in group_keys], dtype=np.int32)
+
+        edge_ids = group_edge_ids[group_index]
+        edge_ids[unmatched] = -1
+        return edge_ids
+
+    def _normalize(self, match: gpd.GeoDataFrame) -> pd.DataFrame:
+        normalized = pd.DataFrame(match.drop(columns=EDGE_COLUMNS + ["surface_section", "geometry"]))
+        normalized["edge_id"] = self._edge_references(match)
+        if "match_section" in normalized:
+            normalized["match_section"] = normalized["match_section"].astype(np.int32)
+        return normalized
+
+    def _get_edge_arrays(self, max_edge_id: int = -1) -> dict:
+        with self._edges_lock:
+            if max_edge_id >= len(self.edges):
+                # the match references edges another process added after the table was read
+                self._refresh_edges()
+            if self._edge_arrays is None:
+                # an extra empty edge at the end takes all unmatched points
+                # categorical columns are kept as codes (-1 is missing) together with their dtype
+                self._edge_arrays = {}
+                for column in EDGE_COLUMNS:
+                    values = self.edges[column]
+                    if isinstance(values.dtype, pd.CategoricalDtype):
+                        self._edge_arrays[column] = (np.append(values.cat.codes.values, -1), values.dtype)
+                    else:
+                        self._edge_arrays[column] = (np.append(values.values.astype("float"), np.nan), None)
+            return self._edge_arrays
+
+    def _rehydrate(self, normalized: pd.DataFrame) -> gpd.GeoDataFrame:
+        edge_ids = normalized.pop("edge_id").values
+        edge_arrays = self._get_edge_arrays(edge_ids.max(initial=-1))
+        # the last entry of the arrays is the empty edge
+        edge_ids = np.where(edge_ids < 0, len(edge_arrays[EDGE_COLUMNS[0]][0]) - 1, edge_ids)
+        for column in EDGE_COLUMNS:
+            values, dtype = edge_arrays[column]
+            values = values.take(edge_ids)
+            normalized[column] = values if dtype is None else pd.Categorical.from_codes(values, dtype=dtype)
+        # same labels as ValhallaHandler._combine_data
+        normalized["surface_section"] = (normalized["surface"] != normalized["surface"].shift()).cumsum()
+        if "match_section" in normalized:
+            normalized["match_section"] = normalized["match_section"].astype(np.int64)
+
+        return gpd.GeoDataFrame(
+            normalized,
+            # x is longitude, y is latitude
+            geometry=gpd.points_from_xy(normalized["longitude"], normalized["latitude"]),
+            crs="EPSG:4326"
+        ).to_crs("EPSG:3857")
 
     def _load_match(self, activity_id: int) -> gpd.GeoDataFrame:
         match_path = Path(self.path, f"{activity_id}.parquet")
-        return gpd.read_parquet(match_path)
+        if "edge_id" in pq.read_schema(match_path).names:
+            return self._rehydrate(pd.read_parquet(match_path))
+        return with_match_dtypes(gpd.read_parquet(match_path))
 
     def _save_match(self, activity_id: int, match: gpd.GeoDataFrame):
         match_path = Path(self.path, f"{activity_id}.parquet")
-        match.to_parquet(match_path)
+        # a shared match folder never holds half a match
+        with span("match", "save"), atomic_path(match_path) as temporary_path:
+            if self.normalized:
+                self._normalize(match).to_parquet(temporary_path)
+            else:
+                # categorical columns are written dictionary encoded
+                with_match_dtypes(match.copy(deep=False)).to_parquet(temporary_path)
 
-    def add(self, activity_id: int, track: gpd.GeoDataFrame):
+    def _check_handlers(self, activity_id: int, user_id: int = None):
+        # raises before any handler changed, a handler failing halfway would leave the others updated
+        if user_id is None and self.way_aggregates is not None:
+            raise ValueError("user_id is needed to update the way aggregates")
+        if user_id is None and self.heatmap is not None:
+            raise ValueError("user_id is needed to update the heatmap")
+        if self.ranking is not None and activity_id not in self.ranking.activity_info:
+            # the activity has to be known to the ranking to place the match
+            raise KeyError(activity_id)
+
+    def _update_handlers(self, activity_id: int, track: gpd.GeoDataFrame, user_id: int = None):
+        self._check_handlers(activity_id, user_id)
+        if self.way_aggregates is not None:
+            self.way_aggregates.add(activity_id, user_id, track)
+        if self.ranking is not None:
+            self.ranking.add_match(activity_id, track)
+        if self.spatial_index is not None:
+            self.spatial_index.add_match(activity_id, track)
+        if self.heatmap is not None:
+            self.heatmap.add(activity_id, user_id, track)
+
+    def add(self, activity_id: int, track: gpd.GeoDataFrame, user_id: int = None):
+        self._update_handlers(activity_id, track, user_id)
         self._save_match(activity_id, track)
-        self.match_id_list.append(activity_id)
+        if activity_id not in self.match_id_list:
+            self.match_id_list.append(activity_id)
+
+    def add_chunked(self,
+                    activity_id: int,
+                    track_path: Path,
+                    matcher: ValhallaHandler,
+                    user_id: int = None,
+                    batch_size: int = 10000) -> bool:
+        """
+        Matches a stored track straight into the match folder with ValhallaHandler.match_chunked,
+        for tracks too long to be matched in memory. The match is always stored in the wide format.
+        Attached handlers need the whole match and load it once it is written.
+        """
+        match_path = Path(self.path, f"{activity_id}.parquet")
+        # checked before matching, a long track shouldn't be matched for nothing
+        self._check_handlers(activity_id, user_id)
+        if matcher.match_chunked(track_path, match_path, batch_size=batch_size) is None:
+            return False
+        if any(handler is not None
+               for handler in (self.way_aggregates, self.ranking, self.spatial_index, self.heatmap)):
+            self._update_handlers(activity_id, self._load_match(activity_id), user_id)
+        if activity_id not in self.match_id_list:
+            self.match_id_list.append(activity_id)
+        return True
+
+    def remove(self, activity_id: int):
+        if activity_id not in self.match_id_list:
+            raise KeyError
+        if self.way_aggregates is not None and activity_id in self.way_aggregates.activity_ids:
+            self.way_aggregates.remove(activity_id)
+        if self.ranking is not None:
+            self.ranking.remove_match(activity_id)
+        if self.spatial_index is not None:
+            self.spatial_index.remove(activity_id, source="match")
+        if self.heatmap is not None and activity_id in self.heatmap.activity_id_list:
+            self.heatmap.remove(activity_id)
+        Path(self.path, f"{activity_id}.parquet").unlink()
+        self.match_id_list.remove(activity_id)
+
+    def exists(self, activity_id: int) -> bool:
+        # also finds matches stored by other processes since the folder was listed
+        if activity_id in self.match_id_list:
+            return True
+        if Path(self.path, f"{activity_id}.parquet").exists():
+            self.match_id_list.append(activity_id)
+            return True
+        return False
+
+    def version(self, activity_id: int) -> (tuple, None):
+        # modification time and size of the stored match, changes whenever the activity is matched again
+        try:
+            stat = Path(self.path, f"{activity_id}.parquet").stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
     def get(self, activity_id: int) -> gpd.GeoDataFrame:
         if activity_id in self.match_id_list:
             return self._load_match(activity_id)
         else:
             raise KeyError
+
+    def normalize(self):
+        # rewrites all matches stored in the wide format
+        for activity_id in self.match_id_list:
+            match_path = Path(self.path, f"{activity_id}.parquet")
+            if "edge_id" not in pq.read_schema(match_path).names:
+                normalized = self._normalize(gpd.read_parquet(match_path))
+                with atomic_path(match_path) as temporary_path:
+                    normalized.to_parquet(temporary_path)
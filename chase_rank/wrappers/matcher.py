@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from typing import Protocol, runtime_checkable
+
+from ..lazy import lazy_import
+
+gpd = lazy_import("geopandas")
+
+# columns every matcher adds to a track, in this order, as ValhallaHandler._combine_data does
+MATCH_COLUMNS = ["match_section", "distance", "surface", "surface_section", "use", "osm_way_id"]
+
+
+@runtime_checkable
+class Matcher(Protocol):
+    """
+    Matches a track of TrackHandler to the road network.
+    match returns the track with MATCH_COLUMNS added, unmatched points keep empty attributes,
+    or None if nothing at all could be matched.
+    Implemented by ValhallaHandler, OSRMHandler and RouteIndexHandler.
+    """
+
+    def match(self, track: gpd.GeoDataFrame) -> (gpd.GeoDataFrame, None):
+        ...
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from ..backends import Backend, BackendPool
+from ..gps_filter import clean_points, reindex_points
+from ..instrumentation import span
+from ..lazy import lazy_import
+from ..way_categorizer import WAY_NODE_INDEX_PATH, WayNodeIndex, with_match_dtypes
+from .valhalla_handler import ValhallaHandler
+
+gpd = lazy_import("geopandas")
+requests = lazy_import("requests")
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4)
+def _load_way_node_index(index_path: Path) -> (WayNodeIndex, None):
+    if not Path(index_path, "node_pairs.npy").exists():
+        logger.warning("no way node index in %s, matches of OSRM get no osm_way_id", index_path)
+        return None
+    return WayNodeIndex(index_path)
+
+
+class OSRMHandler:
+    """
+    Matches tracks with the match service of OSRM (bin/run_osrm.ps1) into the same frame as ValhallaHandler.match.
+    OSRM only returns the OSM nodes along the match: the osm_way_id of a point is looked up by the pair of nodes
+    it was snapped between in the index of way_categorizer.build_way_node_index. OSRM knows nothing about
+    surfaces or uses, they stay empty.
+    base_url can be a list of OSRM instances, see ValhallaHandler.
+    """
+
+    def __init__(self,
+                 base_url: (str, List[str]) = "http://127.0.0.1:5000",
+                 profile: str = "bike",
+                 radius: float = 10.,
+                 max_matching_size: int = 100,
+                 way_node_index_path: Path = WAY_NODE_INDEX_PATH,
+                 timeout: float = None,
+                 probe_interval: float = 10.,
+                 max_failures: int = 3,
+                 eject_seconds: float = 30.,
+                 filter_points: bool = True):
+        urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        self.base_url = urls[0]
+        # osrm-routed serves the profile it was prepared with, whatever the url says
+        self.profile = profile
+        # standard deviation of the gps positions in meters
+        self.radius = radius
+        # --max-matching-size of osrm-routed, 100 unless it was started with another one
+        self.max_matching_size = max_matching_size
+        self.way_node_index_path = way_node_index_path
+        self.timeout = timeout
+        # same pre-filter as ValhallaHandler
+        self.filter_points = filter_points
+        self.backends = BackendPool(
+            urls,
+            probe=self._probe if len(urls) > 1 else None,
+            probe_interval=probe_interval,
+            max_failures=max_failures,
+            eject_seconds=eject_seconds
+        )
+
+    def _probe(self, backend: Backend) -> bool:
+        # OSRM has no status endpoint, any answer that isn't a server error will do
+        return requests.get(f"{backend.url}/nearest/v1/{self.profile}/0,0", timeout=2).status_code < 500
+
+    def backend_report(self) -> pd.DataFrame:
+        return self.backends.report()
+
+    def close(self):
+        self.backends.stop()
+
+    def _request(self, path: str, params: Dict) -> (Dict, None):
+        response = self.backends.request("osrm", method="get", path=path, timeout=self.timeout, params=params)
+        # b'{"code":"NoMatch","message":"Could not match the trace."}'
+        if not response.ok:
+            logger.warning("osrm request failed: %s %s", response, response.content)
+            return None
+        return response.json()
+
+    @staticmethod
+    def _node_pairs(result: Dict, tracepoints: np.ndarray, fractions: np.ndarray) -> np.ndarray:
+        """
+        The nodes of the road segment every point was snapped to, -1 for unmatched points.
+        A point lies on the leg of the tracepoint at or before it, fractions tell how far along the leg (0..1).
+        Legs run over several segments, often of different ways, the segment is found by the distances along it.
+        """
+        matchings = result.get("matchings", [])
+        legs = []
+        for tracepoint in result.get("tracepoints", []):
+            if tracepoint is None:
+                legs.append(None)
+                continue
+            matching_legs = matchings[tracepoint["matchings_index"]]["legs"]
+            waypoint = tracepoint["waypoint_index"]
+            if waypoint < len(matching_legs):
+                annotation = matching_legs[waypoint]["annotation"]
+                legs.append((annotation["nodes"], np.cumsum(annotation.get("distance", []))))
+            elif matching_legs:
+                # the last waypoint ends its matching on the last segment
+                legs.append((matching_legs[-1]["annotation"]["nodes"][-2:], None))
+            else:
+                legs.append(None)
+
+        pairs = np.full((len(tracepoints), 2), -1, dtype=np.int64)
+        for row, (tracepoint, fraction) in enumerate(zip(tracepoints.tolist(), fractions.tolist())):
+            leg = legs[tracepoint] if tracepoint < len(legs) else None
+            if leg is None:
+                continue
+            nodes, ends = leg
+            segment = 0
+            if ends is not None and len(ends) and ends[-1] > 0:
+                # side right skips segments of length 0, a waypoint snapped onto a node takes the segment it leaves on
+                segment = int(np.searchsorted(ends / ends[-1], fraction, side="right"))
+            segment = max(min(segment, len(nodes) - 2), 0)
+            if len(nodes) >= 2:
+                pairs[row] = nodes[segment:segment + 2]
+        return pairs
+
+    def _match_section(self, section: gpd.GeoDataFrame) -> np.ndarray:
+        kept = np.arange(len(section))
+        if self.filter_points:
+            with span("osrm", "filter"):
+                kept = clean_points(
+                    section["longitude"].values, section["latitude"].values, section["timestamp"].values)
+        pairs = np.full((len(section), 2), -1, dtype=np.int64)
+        if len(kept) <= 1:
+            # if we got less than two points it's not a proper shape
+            return pairs
+
+        # dropped points lie on the leg of the kept point before them, as far along as the track says
+        tracepoints = reindex_points(kept, len(section))
+        along = np.concatenate([[0.], np.cumsum(section["distance"].values[:-1])])
+        leg_starts = along[kept][tracepoints]
+        leg_lengths = along[kept][np.minimum(tracepoints + 1, len(kept) - 1)] - leg_starts
+        fractions = np.clip(
+            np.divide(along - leg_starts, leg_lengths, out=np.zeros(len(section)), where=leg_lengths > 0), 0., 1.)
+
+        # osrm-routed refuses traces longer than its --max-matching-size, urls of long traces get too long anyway
+        # chunks share their last point with the next one, which takes it over with the leg leaving it
+        for start in range(0, len(kept) - 1, self.max_matching_size - 1):
+            chunk = kept[start:start + self.max_matching_size]
+            result = self._request_match(section.iloc[chunk])
+            if result is None:
+                continue
+            rows = (tracepoints >= start) & (tracepoints < start + len(chunk))
+            pairs[rows] = self._node_pairs(result, tracepoints[rows] - start, fractions[rows])
+        return pairs
+
+    def _request_match(self, points: gpd.GeoDataFrame) -> (Dict, None):
+        if len(points) <= 1:
+            return None
+        coordinates = ";".join(f"{lon:.6f},{lat:.6f}" for lon, lat in points[["longitude", "latitude"]].values)
+        timestamps = points["timestamp"].values.astype("datetime64[s]").astype(np.int64)
+        return self._request(
+            path=f"/match/v1/{self.profile}/{coordinates}",
+            params={
+                "timestamps": ";".join(map(str, timestamps)),
+                "radiuses": ";".join([str(self.radius)] * len(points)),
+                # distances place the points between two waypoints on the right segment of a leg
+                "annotations": "nodes,distance",
+                "overview": "false",
+                # split at gaps instead of routing over them, never drop points to tidy up the trace
+                "gaps": "split",
+                "tidy": "false",
+            }
+        )
+
+    def match(self, track: gpd.GeoDataFrame) -> (gpd.GeoDataFrame, None):
+        # same sections as valhalla, so both engines see the same requests
+        with span("osrm", "split"):
+            track = ValhallaHandler.split_track(track)
+
+        pairs = np.vstack([self._match_section(section)
+                           for _, section in track.groupby(track["match_section"])])
+        matched = pairs[:, 0] >= 0
+        if not matched.any():
+            return None
+
+        way_node_index = _load_way_node_index(self.way_node_index_path)
+        way_ids = np.full(len(pairs), np.nan)
+        if way_node_index is not None:
+            way_ids[matched] = way_node_index.way_ids_of(pairs[matched, 0], pairs[matched, 1])
+
+        # every matched point gets its own edge, so the frame is built exactly like the one of valhalla
+        edges_df = with_match_dtypes(pd.DataFrame({
+            "length": np.nan,
+            "speed": np.nan,
+            "use": pd.Series([None] * len(pairs), dtype=object),
+            "unpaved": None,
+            "surface": pd.Series([None] * len(pairs), dtype=object),
+            "travel_mode": pd.Series([None] * len(pairs), dtype=object),
+            "osm_way_id": way_ids,
+        }))
+        trace_df = pd.DataFrame({"edge_index": np.where(matched, np.arange(len(pairs)), np.nan)})
+        with span("osrm", "combine"):
+            return ValhallaHandler._combine_data(track, trace_df, edges_df)
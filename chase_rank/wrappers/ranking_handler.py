@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+import json
+from bisect import bisect_left, insort
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ..lazy import lazy_import
+from ..storage import atomic_path
+from ..way_categorizer import categorize_surfaces
+
+gpd = lazy_import("geopandas")
+
+METRICS = ["distance", "elevation", "moving_time"]
+ROW_COLUMNS = ["user_id", "sport_type", "category", "month"] + METRICS
+# value of a dimension that sums over all of its values
+ALL = "all"
+
+BoardKey = Tuple[str, str, str, str]  # period, sport_type, category, metric
+
+
+class _Board:
+    """
+    Values of all users for a single ranking, kept in order so top-N and
+    rank lookups never need to look at more than the requested entries.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, float] = {}
+        # sorted by descending value, ties by user_id
+        self.order: List[Tuple[float, str]] = []
+
+    def update(self, user_id: str, delta: float):
+        value = self.values.get(user_id)
+        if value is not None:
+            del self.order[bisect_left(self.order, (-value, user_id))]
+            value += delta
+        else:
+            value = delta
+        # floating point leftovers of removed activities
+        if abs(value) < 1e-9:
+            self.values.pop(user_id, None)
+            return
+        self.values[user_id] = value
+        insort(self.order, (-value, user_id))
+
+    def top(self, n: int) -> List[Tuple[str, float]]:
+        return [(user_id, -value) for value, user_id in self.order[:n]]
+
+    def rank(self, user_id: str) -> (int, None):
+        value = self.values.get(user_id)
+        if value is None:
+            return None
+        # users with the same value share a rank
+        return bisect_left(self.order, (-value,)) + 1
+
+
+class RankingHandler:
+    """
+    Materialized per-user totals of distance, elevation and moving time
+    by period (all, YYYY, YYYY-MM), sport_type and surface category.
+    Activities fill the category "all", matches split their distance by surface category.
+    Totals are updated with every added activity or match, queries never rescan them.
+    With autosave every change is appended to a journal next to path, all contributions are only
+    written every save_interval changes. Loading replays the journal on top of the last save.
+    """
+
+    def __init__(self, path: Path, autosave: bool = True, save_interval: int = 100):
+        self.path = path
+        self.journal_path = self.path.with_suffix(".journal")
+        self.autosave = autosave
+        self.save_interval = save_interval
+        self._unsaved = 0
+        self.boards: Dict[BoardKey, _Board] = defaultdict(_Board)
+        # rows of every activity and match, needed to take them back out on updates and deletes
+        self.contributions: Dict[Tuple[int, str], pd.DataFrame] = {}
+        # user_id, sport_type and start_date of added activities, needed to place their matches
+        self.activity_info: Dict[int, Tuple[str, str, str]] = {}
+        self._load()
+
+    def _restore(self, activity_id: int, source: str, rows: (pd.DataFrame, None)):
+        self._replace(activity_id, source, rows)
+        if source == "activity":
+            if rows is None or not len(rows):
+                self.activity_info.pop(activity_id, None)
+            else:
+                first = rows.iloc[0]
+                self.activity_info[activity_id] = (first["user_id"], first["sport_type"], first["month"])
+
+    def _load(self):
+        if self.path.exists():
+            contributions = pd.read_parquet(self.path)
+            for (activity_id, source), rows in contributions.groupby(["activity_id", "source"]):
+                rows = rows.drop(columns=["activity_id", "source"]).reset_index(drop=True)
+                self._restore(int(activity_id), source, rows)
+        if self.journal_path.exists():
+            with open(self.journal_path) as file_pointer:
+                for line in file_pointer:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a crashed process may be cut short
+                        break
+                    rows = pd.DataFrame(entry["rows"], columns=ROW_COLUMNS) if entry["rows"] else None
+                    self._restore(entry["activity_id"], entry["source"], rows)
+                    self._unsaved += 1
+
+    def save(self):
+        if self.contributions:
+            with atomic_path(self.path) as temporary_path:
+                pd.concat(
+                    [rows.assign(activity_id=activity_id, source=source)
+                     for (activity_id, source), rows in self.contributions.items()],
+                    ignore_index=True
+                ).to_parquet(temporary_path)
+        elif self.path.exists():
+            self.path.unlink()
+        # replaying the journal again would change nothing, it only goes once everything is saved
+        self.journal_path.unlink(missing_ok=True)
+        self._unsaved = 0
+
+    def _log(self, activity_id: int, source: str, rows: pd.DataFrame = None):
+        if not self.autosave:
+            return
+        entry = {
+            "activity_id": activity_id,
+            "source": source,
+            "rows": [] if rows is None else rows[ROW_COLUMNS].astype({"category": str}).to_dict("records"),
+        }
+        with open(self.journal_path, "a") as file_pointer:
+            file_pointer.write(json.dumps(entry) + "\n")
+        self._unsaved += 1
+
+    def _changed(self):
+        if self.autosave and self._unsaved >= self.save_interval:
+            self.save()
+
+    def _apply(self, rows: pd.DataFrame, sign: int):
+        for user_id, sport_type, category, month, *values in rows[
+                ["user_id", "sport_type", "category", "month"] + METRICS].itertuples(index=False, name=None):
+            for period in (ALL, month[:4], month):
+                for sport in (ALL, sport_type):
+                    for metric, value in zip(METRICS, values):
+                        if value:
+                            self.boards[(period, sport, category, metric)].update(user_id, sign * value)
+
+    def _replace(self, activity_id: int, source: str, rows: pd.DataFrame = None):
+        previous = self.contributions.pop((activity_id, source), None)
+        if previous is not None:
+            self._apply(previous, -1)
+        if rows is not None and len(rows):
+            self._apply(rows, 1)
+            self.contributions[(activity_id, source)] = rows
+
+    def add_activities(self, activities: gpd.GeoDataFrame):
+        # activities as stored by ActivityHandler, the index holds the activity ids
+        for activity_id, activity in activities.iterrows():
+            user_id = str(activity["user_id"])
+            month = pd.Timestamp(activity["start_date"]).strftime("%Y-%m")
+            rows = pd.DataFrame([{
+                "user_id": user_id,
+                "sport_type": activity["sport_type"],
+                "category": ALL,
+                "month": month,
+                "distance": float(np.nan_to_num(activity["distance"])),
+                "elevation": float(np.nan_to_num(activity["total_elevation_gain"])),
+                "moving_time": float(np.nan_to_num(activity["moving_time"])),
+            }])
+            self._restore(int(activity_id), "activity", rows)
+            self._log(int(activity_id), "activity", rows)
+        self._changed()
+
+    def add_match(self, activity_id: int, match: gpd.GeoDataFrame):
+        if activity_id not in self.activity_info:
+            # we need user, sport_type and date of the activity
+            raise KeyError(activity_id)
+        user_id, sport_type, month = self.activity_info[activity_id]
+
+        # every point carries the way to the next point, like the distance column
+        time = np.zeros(len(match), dtype=np.float64)
+        elevation = np.zeros(len(match), dtype=np.float64)
+        timestamps = match["timestamp"].values
+        altitude = match["altitude"].values.astype(np.float64)
+        time[:-1] = (timestamps[1:] - timestamps[:-1]) / np.timedelta64(1, "s")
+        elevation[:-1] = np.clip(np.nan_to_num(altitude[1:] - altitude[:-1]), 0, None)
+        new_section = match["match_section"].values[1:] != match["match_section"].values[:-1]
+        time[:-1][new_section] = 0.
+        elevation[:-1][new_section] = 0.
+
+        rows = pd.DataFrame({
+            "category": categorize_surfaces(match["surface"]).values,
+            "distance": match["distance"].values,
+            "elevation": elevation,
+            "moving_time": time,
+        }).groupby("category").sum().reset_index()
+        rows.insert(0, "user_id", user_id)
+        rows.insert(1, "sport_type", sport_type)
+        rows.insert(3, "month", month)
+        self._replace(activity_id, "match", rows)
+        self._log(activity_id, "match", rows)
+        self._changed()
+
+    def remove_match(self, activity_id: int):
+        self._replace(activity_id, "match")
+        self._log(activity_id, "match")
+        self._changed()
+
+    def remove(self, activity_id: int):
+        self._restore(activity_id, "activity", None)
+        self._replace(activity_id, "match")
+        self._log(activity_id, "activity")
+        self._log(activity_id, "match")
+        self._changed()
+
+    def top(self,
+            n: int = 10,
+            metric: str = "distance",
+            period: str = ALL,
+            sport_type: str = ALL,
+            category: str = ALL
+            ) -> pd.DataFrame:
+        board = self.boards.get((period, sport_type, category, metric))
+        top = board.top(n) if board else []
+        frame = pd.DataFrame(top, columns=["user_id", metric])
+        # users with the same value share a rank
+        frame.insert(0, "rank", frame[metric].rank(method="min", ascending=False).astype(int))
+        return frame
+
+    def rank(self,
+             user_id: int,
+             metric: str = "distance",
+             period: str = ALL,
+             sport_type: str = ALL,
+             category: str = ALL
+             ) -> Dict:
+        board = self.boards.get((period, sport_type, category, metric))
+        if not board or str(user_id) not in board.values:
+            return {"rank": None, metric: 0., "users": len(board.values) if board else 0}
+        return {
+            "rank": board.rank(str(user_id)),
+            metric: board.values[str(user_id)],
+            "users": len(board.values)
+        }
+
+    @property
+    def totals(self) -> pd.DataFrame:
+        # all materialized totals as a single frame, e.g. for charts
+        rows = [
+            (period, sport_type, category, metric, user_id, value)
+            for (period, sport_type, category, metric), board in self.boards.items()
+            for user_id, value in board.values.items()
+        ]
+        frame = pd.DataFrame(rows, columns=["period", "sport_type", "category", "metric", "user_id", "value"])
+        return frame.pivot_table(
+            index=["period", "sport_type", "category", "user_id"], columns="metric", values="value", fill_value=0.)
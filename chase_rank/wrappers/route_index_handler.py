@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .match_handler import EDGE_COLUMNS, MatchHandler
+from .valhalla_handler import ValhallaHandler
+from ..instrumentation import record_cache, span
+from ..lazy import lazy_import
+from ..storage import atomic_path
+from ..way_categorizer import with_match_dtypes
+
+gpd = lazy_import("geopandas")
+
+logger = logging.getLogger(__name__)
+
+# cell coordinates are packed into a single code, mercator cells of a few meters stay far below the stride
+_CELL_STRIDE = np.int64(2 ** 32)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer, uint64 arrays wrap around on overflow
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _points(track: gpd.GeoDataFrame) -> np.ndarray:
+    if track.crs is not None and track.crs != "EPSG:3857":
+        track = track.to_crs("EPSG:3857")
+    return np.column_stack([track.geometry.x.values, track.geometry.y.values])
+
+
+def _cell_codes(points: np.ndarray, cell_size: float) -> np.ndarray:
+    cells = np.floor(points / cell_size).astype(np.int64)
+    return cells[:, 0] * _CELL_STRIDE + cells[:, 1]
+
+
+def _nearest(points: np.ndarray, reference: np.ndarray, max_distance: float) -> np.ndarray:
+    """
+    Position of the nearest reference point within max_distance of every point, -1 if there is none.
+    Both are bucketed into cells of max_distance, so only the 3x3 cells around a point are compared.
+    """
+    nearest = np.full(len(points), -1, dtype=np.int64)
+    if not len(points) or not len(reference):
+        return nearest
+    best = np.full(len(points), np.inf)
+
+    reference_codes = _cell_codes(reference, max_distance)
+    order = np.argsort(reference_codes, kind="stable")
+    sorted_codes = reference_codes[order]
+    point_codes = _cell_codes(points, max_distance)
+
+    for offset in [dx * _CELL_STRIDE + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)]:
+        codes = point_codes + offset
+        low = np.searchsorted(sorted_codes, codes, side="left")
+        counts = np.searchsorted(sorted_codes, codes, side="right") - low
+        if not counts.any():
+            continue
+        # every pair of a point and a reference point in the neighbouring cell
+        point_index = np.repeat(np.arange(len(points)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = order[np.repeat(low, counts) + within]
+        distances = np.hypot(*(points[point_index] - reference[candidates]).T)
+
+        # closest candidate of every point in this cell
+        by_distance = np.lexsort((distances, point_index))
+        point_index, first = np.unique(point_index[by_distance], return_index=True)
+        distances = distances[by_distance][first]
+        candidates = candidates[by_distance][first]
+
+        closer = (distances < best[point_index]) & (distances <= max_distance)
+        best[point_index[closer]] = distances[closer]
+        nearest[point_index[closer]] = candidates[closer]
+    return nearest
+
+
+class RouteIndexHandler:
+    """
+    MinHash fingerprints of all stored matches to match repeated routes without valhalla.
+    A route is the set of grid cells its points fall into, the signatures estimate the Jaccard similarity
+    of these sets and LSH on bands of the signatures finds similar routes without comparing against every match.
+    match() can replace ValhallaHandler.match: a track similar to a stored match takes the edge attributes
+    of the nearest matched point, only the parts ridden differently are sent to valhalla.
+    Tracks that differ in more than max_unshared of their points or in more than max_parts parts
+    are matched as a whole, many small requests cost more than a single one.
+    The index follows the matches of the MatchHandler, new, rematched and removed matches are picked up
+    on every lookup.
+    """
+
+    def __init__(self,
+                 path: Path,
+                 match_handler: MatchHandler,
+                 valhalla: ValhallaHandler,
+                 cell_size: float = 100.,
+                 num_perm: int = 64,
+                 bands: int = 16,
+                 min_similarity: float = 0.6,
+                 max_distance: float = 15.,
+                 context: int = 5,
+                 max_unshared: float = 0.5,
+                 max_parts: int = 10,
+                 autosave: bool = True):
+        if num_perm % bands:
+            raise ValueError("num_perm has to be a multiple of bands")
+        self.path = path
+        self.signatures_path = Path(self.path, "route_index.parquet")
+        self.matches = match_handler
+        self.valhalla = valhalla
+        self.cell_size = cell_size
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.min_similarity = min_similarity
+        # meters a point may be away from the matched point it takes the edge from
+        self.max_distance = max_distance
+        # points before and after a differing part sent along to valhalla to find its way onto the road
+        self.context = context
+        self.max_unshared = max_unshared
+        self.max_parts = max_parts
+        self.autosave = autosave
+
+        self._seeds = np.random.default_rng(0).integers(
+            np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64)
+        self.signatures: Dict[int, np.ndarray] = {}
+        self.buckets: Dict[Tuple[int, bytes], Set[int]] = defaultdict(set)
+        # MatchHandler.version of the match every signature was taken from
+        self.versions: Dict[int, tuple] = {}
+        # matches without a single matched point can't serve as reference, until they are matched again
+        self._unusable: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def _load(self):
+        if not self.signatures_path.exists():
+            return
+        stored = pd.read_parquet(self.signatures_path)
+        # signatures saved without a version are taken again on the next lookup
+        versions = (zip(stored["mtime_ns"], stored["size"]) if "mtime_ns" in stored
+                    else [None] * len(stored))
+        for activity_id, signature, version in zip(stored["activity_id"], stored["signature"], versions):
+            self._index(int(activity_id), np.asarray(signature, dtype=np.uint64))
+            if version is not None:
+                self.versions[int(activity_id)] = tuple(int(value) for value in version)
+
+    def save(self):
+        activity_ids = list(self.signatures)
+        versions = [self.versions.get(activity_id, (-1, -1)) for activity_id in activity_ids]
+        with atomic_path(self.signatures_path) as temporary_path:
+            pd.DataFrame({
+                "activity_id": np.array(activity_ids, dtype=np.int64),
+                "signature": [self.signatures[activity_id].tolist() for activity_id in activity_ids],
+                "mtime_ns": np.array([mtime_ns for mtime_ns, _ in versions], dtype=np.int64),
+                "size": np.array([size for _, size in versions], dtype=np.int64),
+            }).to_parquet(temporary_path)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _index(self, activity_id: int, signature: np.ndarray):
+        self.signatures[activity_id] = signature
+        for key in self._band_keys(signature):
+            self.buckets[key].add(activity_id)
+
+    def _unindex(self, activity_id: int):
+        self.versions.pop(activity_id, None)
+        signature = self.signatures.pop(activity_id, None)
+        if signature is None:
+            return
+        for key in self._band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(activity_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    def signature(self, points: np.ndarray) -> (np.ndarray, None):
+        cells = np.unique(_cell_codes(points, self.cell_size))
+        if not len(cells):
+            return None
+        hashes = _mix(cells.astype(np.uint64))
+        # every seed acts as its own hash function, the signature is the minimum of each
+        return _mix(hashes[None, :] ^ self._seeds[:, None]).min(axis=1)
+
+    def _sync(self):
+        with self._lock:
+            match_ids = list(self.matches.match_id_list)
+            removed = set(self.signatures) - set(match_ids)
+            for activity_id in removed:
+                self._unindex(activity_id)
+            # new matches and matches stored again since their signature was taken
+            versions = {activity_id: self.matches.version(activity_id) for activity_id in match_ids}
+            changed = [activity_id for activity_id, version in versions.items()
+                       if version is not None and version != self.versions.get(activity_id)
+                       and version != self._unusable.get(activity_id)]
+            for activity_id in changed:
+                # the stale signature must not find the new route
+                self._unindex(activity_id)
+                self._unusable.pop(activity_id, None)
+                match = self.matches.get(activity_id)
+                signature = self.signature(_points(match[match["osm_way_id"].notnull()]))
+                if signature is None:
+                    self._unusable[activity_id] = versions[activity_id]
+                else:
+                    self._index(activity_id, signature)
+                    self.versions[activity_id] = versions[activity_id]
+            if (removed or changed) and self.autosave:
+                self.save()
+
+    def _similar(self, signature: (np.ndarray, None), min_similarity: float) -> List[Tuple[int, float]]:
+        if signature is None:
+            return []
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates |= self.buckets.get(key, set())
+        similar = [
+            (activity_id, float(np.mean(self.signatures[activity_id] == signature)))
+            for activity_id in candidates
+        ]
+        return sorted(
+            [(activity_id, similarity) for activity_id, similarity in similar if similarity >= min_similarity],
+            key=lambda item: (-item[1], item[0])
+        )
+
+    def similar(self, track: gpd.GeoDataFrame, min_similarity: float = None) -> List[Tuple[int, float]]:
+        """
+        Ids of stored matches along the same route with their estimated similarity, the most similar first.
+        """
+        self._sync()
+        if min_similarity is None:
+            min_similarity = self.min_similarity
+        return self._similar(self.signature(_points(track)), min_similarity)
+
+    def _unshared_parts(self, unshared: np.ndarray) -> (np.ndarray, None):
+        """
+        Start and end of the parts of the track to match with valhalla, None if the whole track should be.
+        Runs of unshared points closer than two contexts share their request, their contexts would overlap anyway.
+        """
+        runs = np.flatnonzero(np.diff(np.concatenate([[0], unshared.astype(np.int8), [0]]))).reshape(-1, 2)
+        if len(runs) > 1:
+            separate = runs[1:, 0] - runs[:-1, 1] > 2 * self.context
+            runs = np.column_stack([runs[np.append(True, separate), 0], runs[np.append(separate, True), 1]])
+        if unshared.mean() > self.max_unshared or len(runs) > self.max_parts:
+            return None
+        return runs
+
+    def _transfer(self, track: gpd.GeoDataFrame, points: np.ndarray, reference: gpd.GeoDataFrame
+                  ) -> (pd.DataFrame, None):
+        reference = reference[reference["osm_way_id"].notnull()]
+        # distances in web mercator are stretched by 1 / cos(latitude)
+        scale = 1 / np.cos(np.radians(track["latitude"].mean()))
+        nearest = _nearest(points, _points(reference), self.max_distance * scale)
+
+        runs = self._unshared_parts(nearest < 0)
+        if runs is None:
+            logger.debug("%s of %s points differ from the earlier match", int((nearest < 0).sum()), len(track))
+            return None
+
+        # unshared points get an empty row that is filled by valhalla below
+        attributes = reference[EDGE_COLUMNS].reset_index(drop=True).reindex(nearest).astype(object)
+        attributes.index = track.index
+
+        for start, end in runs.tolist():
+            part_start, part_end = max(start - self.context, 0), min(end + self.context, len(track))
+            matched = self.valhalla.match(track.iloc[part_start:part_end])
+            if matched is not None:
+                attributes.iloc[start:end] = matched[EDGE_COLUMNS].iloc[
+                    start - part_start:end - part_start].astype(object).values
+
+        logger.debug("took %s of %s points from an earlier match, %s parts sent to valhalla",
+                     int((nearest >= 0).sum()), len(track), len(runs))
+        attributes["osm_way_id"] = pd.to_numeric(attributes["osm_way_id"]).astype("float")
+        return with_match_dtypes(attributes)
+
+    def match(self, track: gpd.GeoDataFrame) -> (gpd.GeoDataFrame, None):
+        self._sync()
+        with span("route_index", "lookup"):
+            points = _points(track)
+            similar = self._similar(self.signature(points), self.min_similarity)
+        record_cache("route", hit=bool(similar))
+        if not similar:
+            return self.valhalla.match(track)
+
+        reference_id, similarity = similar[0]
+        logger.debug("reusing match %s with similarity %.2f", reference_id, similarity)
+        reference = self.matches.get(reference_id)
+        with span("route_index", "transfer"):
+            attributes = self._transfer(track, points, reference)
+            if attributes is not None:
+                # same columns in the same order as ValhallaHandler.match
+                matched = self.valhalla.split_track(track)
+                matched["surface"] = attributes["surface"]
+                matched["surface_section"] = (attributes["surface"] != attributes["surface"].shift()).cumsum()
+                matched["use"] = attributes["use"]
+                matched["osm_way_id"] = attributes["osm_way_id"]
+        if attributes is None:
+            # too different to patch, valhalla does better with the whole track
+            return self.valhalla.match(track)
+        return matched
@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+from ..lazy import lazy_import
+from ..storage import atomic_path
+
+gpd = lazy_import("geopandas")
+pyproj = lazy_import("pyproj")
+shapely_geometry = lazy_import("shapely.geometry")
+shapely_wkb = lazy_import("shapely.wkb")
+
+# geometries of the same activity are indexed once per source
+SOURCES = ["activity", "match"]
+
+GeometryKey = Tuple[str, int]  # source, activity_id
+Cell = Tuple[int, int]
+
+
+def _geometry_parts(geometry) -> List[np.ndarray]:
+    # coordinates of every line of a (multi) geometry, points count as lines of a single coordinate
+    if geometry is None or geometry.is_empty:
+        return []
+    if hasattr(geometry, "geoms"):
+        return [coords for part in geometry.geoms for coords in _geometry_parts(part)]
+    return [np.asarray(geometry.coords)[:, :2]]
+
+
+def _segments(geometries: List) -> (np.ndarray, np.ndarray):
+    # start and end of every segment as rows of x0, y0, x1, y1 together with the position of its geometry
+    segments = []
+    owners = []
+    for owner, geometry in enumerate(geometries):
+        for coords in _geometry_parts(geometry):
+            if len(coords) == 1:
+                coords = np.repeat(coords, 2, axis=0)
+            segments.append(np.hstack([coords[:-1], coords[1:]]))
+            owners.append(np.full(len(coords) - 1, owner))
+    if not segments:
+        return np.empty((0, 4)), np.empty(0, dtype=np.int64)
+    return np.vstack(segments), np.concatenate(owners)
+
+
+def _grid_crossings(starts: np.ndarray, ends: np.ndarray) -> (np.ndarray, np.ndarray):
+    # position along every segment (0 at the start, 1 at the end) where it crosses a grid line of one axis
+    start_cells = np.floor(starts)
+    counts = np.abs(np.floor(ends) - start_cells).astype(np.int64)
+    segment_index = np.repeat(np.arange(len(starts)), counts)
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    forward = ends[segment_index] > starts[segment_index]
+    lines = np.where(forward, start_cells[segment_index] + 1 + steps, start_cells[segment_index] - steps)
+    return segment_index, (lines - starts[segment_index]) / (ends[segment_index] - starts[segment_index])
+
+
+def _covered_cells(segments: np.ndarray, cell_size: float) -> (np.ndarray, np.ndarray, np.ndarray):
+    # the cells a segment passes through, between two crossings of grid lines it stays inside a single cell
+    # a long segment only gets the cells along it instead of all cells of its bounding box
+    x_0, y_0, x_1, y_1 = (segments[:, column] / cell_size for column in range(4))
+    crossing_x_index, crossing_x = _grid_crossings(x_0, x_1)
+    crossing_y_index, crossing_y = _grid_crossings(y_0, y_1)
+
+    segment_numbers = np.arange(len(segments))
+    owners = np.concatenate([segment_numbers, crossing_x_index, crossing_y_index, segment_numbers])
+    positions = np.concatenate([np.zeros(len(segments)), crossing_x, crossing_y, np.ones(len(segments))])
+    order = np.lexsort((positions, owners))
+    owners, positions = owners[order], positions[order]
+
+    # the middle of every piece between two consecutive positions of the same segment
+    pieces = owners[:-1] == owners[1:]
+    segment_index = owners[:-1][pieces]
+    middles = ((positions[:-1] + positions[1:]) / 2)[pieces]
+    cell_x = np.floor(x_0[segment_index] + middles * (x_1 - x_0)[segment_index]).astype(np.int64)
+    cell_y = np.floor(y_0[segment_index] + middles * (y_1 - y_0)[segment_index]).astype(np.int64)
+    return segment_index, cell_x, cell_y
+
+
+class SpatialIndexHandler:
+    """
+    Grid index in EPSG:3857 over the summary lines of activities and the matched parts of matches.
+    Every cell knows the geometries passing through it, so bbox, radius and intersection queries
+    only look at the cells they cover and check the exact geometries of the few candidates in there.
+    Only the geometries are stored, the cells are rebuilt from them when the index is loaded.
+    With autosave every changed geometry is appended to a journal, all geometries are only
+    written every save_interval changes. Loading replays the journal on top of the last save.
+    """
+
+    def __init__(self, path: Path, cell_size: float = 500., autosave: bool = True, save_interval: int = 100):
+        self.path = path
+        self.geometries_path = Path(self.path, "spatial_index.parquet")
+        self.journal_path = Path(self.path, "spatial_index.journal")
+        self.cell_size = cell_size
+        self.autosave = autosave
+        self.save_interval = save_interval
+        self._unsaved = 0
+
+        self.geometries: Dict[GeometryKey, object] = {}
+        self.cells: Dict[Cell, Set[GeometryKey]] = defaultdict(set)
+        self._geometry_cells: Dict[GeometryKey, List[Cell]] = {}
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.geometries)
+
+    def _load(self):
+        if self.geometries_path.exists():
+            stored = gpd.read_parquet(self.geometries_path)
+            self._index(
+                list(zip(stored["source"], stored["activity_id"].astype(int))),
+                list(stored.geometry.values)
+            )
+        if self.journal_path.exists():
+            # the latest state of every key in the journal, indexed in a single batch
+            changes: Dict[GeometryKey, object] = {}
+            with open(self.journal_path) as file_pointer:
+                for line in file_pointer:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a crashed process may be cut short
+                        break
+                    key = (entry["source"], entry["activity_id"])
+                    changes[key] = shapely_wkb.loads(entry["geometry"], hex=True) if entry["geometry"] else None
+                    self._unsaved += 1
+            self._index(list(changes), list(changes.values()))
+
+    def save(self):
+        if self.geometries:
+            keys = list(self.geometries)
+            with atomic_path(self.geometries_path) as temporary_path:
+                gpd.GeoDataFrame(
+                    {
+                        "source": [source for source, _ in keys],
+                        "activity_id": np.array([activity_id for _, activity_id in keys], dtype=np.int64),
+                    },
+                    geometry=list(self.geometries.values()),
+                    crs="EPSG:3857"
+                ).to_parquet(temporary_path)
+        elif self.geometries_path.exists():
+            self.geometries_path.unlink()
+        # replaying the journal again would change nothing, it only goes once everything is saved
+        self.journal_path.unlink(missing_ok=True)
+        self._unsaved = 0
+
+    def _log(self, keys: List[GeometryKey]):
+        if not self.autosave:
+            return
+        with open(self.journal_path, "a") as file_pointer:
+            for source, activity_id in keys:
+                geometry = self.geometries.get((source, activity_id))
+                file_pointer.write(json.dumps({
+                    "source": source,
+                    "activity_id": activity_id,
+                    "geometry": geometry.wkb_hex if geometry is not None else None,
+                }) + "\n")
+        self._unsaved += len(keys)
+
+    def _unindex(self, key: GeometryKey):
+        self.geometries.pop(key, None)
+        for cell in self._geometry_cells.pop(key, []):
+            keys = self.cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.cells[cell]
+
+    def _index(self, keys: List[GeometryKey], geometries: List):
+        for key in keys:
+            self._unindex(key)
+
+        segments, owners = _segments(geometries)
+        segment_index, cell_x, cell_y = _covered_cells(segments, self.cell_size)
+        # a geometry usually runs through the same cell with many segments
+        entries = np.unique(np.column_stack([owners[segment_index], cell_x, cell_y]), axis=0)
+
+        for key, geometry in zip(keys, geometries):
+            if geometry is not None and not geometry.is_empty:
+                self.geometries[key] = geometry
+                self._geometry_cells[key] = []
+        for owner, x, y in entries.tolist():
+            key = keys[owner]
+            self.cells[(x, y)].add(key)
+            self._geometry_cells[key].append((x, y))
+
+    def _changed(self):
+        if self.autosave and self._unsaved >= self.save_interval:
+            self.save()
+
+    def add_activities(self, activities: gpd.GeoDataFrame):
+        # activities as stored by ActivityHandler, the index holds the activity ids
+        activities = activities.to_crs("EPSG:3857")
+        keys = [("activity", int(activity_id)) for activity_id in activities.index]
+        self._index(keys, list(activities.geometry))
+        self._log(keys)
+        self._changed()
+
+    def add_match(self, activity_id: int, match: gpd.GeoDataFrame):
+        # only the matched points of a match section form a line, unmatched gaps are left out
+        match = match.to_crs("EPSG:3857")
+        matched = match[match["osm_way_id"].notnull()]
+        lines = [
+            np.column_stack([section.geometry.x.values, section.geometry.y.values])
+            for _, section in matched.groupby("match_section", sort=False)
+            if len(section) > 1
+        ]
+        geometry = shapely_geometry.MultiLineString(lines) if lines else None
+        self._index([("match", int(activity_id))], [geometry])
+        self._log([("match", int(activity_id))])
+        self._changed()
+
+    def remove(self, activity_id: int, source: str = None):
+        keys = [(key_source, int(activity_id)) for key_source in ([source] if source else SOURCES)]
+        for key in keys:
+            self._unindex(key)
+        self._log(keys)
+        self._changed()
+
+    def _cells_in(self, min_x: float, min_y: float, max_x: float, max_y: float) -> Iterable[Cell]:
+        cell_min_x, cell_min_y = int(np.floor(min_x / self.cell_size)), int(np.floor(min_y / self.cell_size))
+        cell_max_x, cell_max_y = int(np.floor(max_x / self.cell_size)), int(np.floor(max_y / self.cell_size))
+        cell_count = (cell_max_x - cell_min_x + 1) * (cell_max_y - cell_min_y + 1)
+        if cell_count > len(self.cells):
+            # huge areas are cheaper to answer from the occupied cells
+            return [(x, y) for x, y in self.cells
+                    if cell_min_x <= x <= cell_max_x and cell_min_y <= y <= cell_max_y]
+        return [(x, y)
+                for x in range(cell_min_x, cell_max_x + 1)
+                for y in range(cell_min_y, cell_max_y + 1)
+                if (x, y) in self.cells]
+
+    def _candidates(self, bounds: Tuple[float, float, float, float], source: str = None) -> List[GeometryKey]:
+        candidates = set()
+        for cell in self._cells_in(*bounds):
+            candidates |= self.cells[cell]
+        if source:
+            candidates = {key for key in candidates if key[0] == source}
+        return sorted(candidates)
+
+    def _refine(self, candidates: List[GeometryKey], geometry, distance: float = 0.) -> List[int]:
+        if not candidates:
+            return []
+        geometries = gpd.GeoSeries([self.geometries[key] for key in candidates], crs="EPSG:3857")
+        if distance:
+            hits = (geometries.distance(geometry) <= distance).values
+        else:
+            hits = geometries.intersects(geometry).values
+        return sorted({activity_id for (_, activity_id), hit in zip(candidates, hits) if hit})
+
+    def _to_mercator(self, x, y, crs: str) -> (np.ndarray, np.ndarray):
+        if crs == "EPSG:3857":
+            return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        transformer = pyproj.Transformer.from_crs(crs, "EPSG:3857", always_xy=True)
+        return transformer.transform(x, y)
+
+    def bbox(self,
+             min_x: float,
+             min_y: float,
+             max_x: float,
+             max_y: float,
+             crs: str = "EPSG:4326",
+             source: str = None
+             ) -> List[int]:
+        """
+        Ids of activities passing through the bounding box, coordinates are longitude / latitude by default.
+        """
+        xs, ys = self._to_mercator([min_x, max_x, min_x, max_x], [min_y, min_y, max_y, max_y], crs)
+        bounds = (min(xs), min(ys), max(xs), max(ys))
+        return self._refine(self._candidates(bounds, source), shapely_geometry.box(*bounds))
+
+    def radius(self, longitude: float, latitude: float, meters: float, source: str = None) -> List[int]:
+        """
+        Ids of activities that came within meters of the point.
+        """
+        (x,), (y,) = self._to_mercator([longitude], [latitude], "EPSG:4326")
+        # web mercator stretches distances by 1 / cos(latitude)
+        distance = meters / np.cos(np.radians(latitude))
+        bounds = (x - distance, y - distance, x + distance, y + distance)
+        return self._refine(self._candidates(bounds, source), shapely_geometry.Point(x, y), distance)
+
+    def intersecting(self, geometry, crs: str = "EPSG:4326", source: str = None) -> List[int]:
+        """
+        Ids of activities crossing or touching a geometry, e.g. a LineString of a segment.
+        """
+        geometry = gpd.GeoSeries([geometry], crs=crs).to_crs("EPSG:3857").iloc[0]
+        return self._refine(self._candidates(geometry.bounds, source), geometry)
@@ -1,10 +1,17 @@
+from __future__ import annotations
+
+import logging
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List
 
-import requests
-
 from .user_handler import StravaUserHandler
+from ..instrumentation import record_http, record_strava_rate_limit, request_size, span
+from ..lazy import lazy_import
+
+requests = lazy_import("requests")
+
+logger = logging.getLogger(__name__)
 
 
 def sleep_until_next_quarter():
@@ -41,8 +48,7 @@ class StravaHandler:
             self.user_handler[user_id].code = ""
             self.user_handler._save_users()
         else:
-            print(
-                f"AUTH ERROR: {user_id} has no auth code\ncode: {self.user_handler[user_id].code}")
+            logger.error("AUTH ERROR: %s has no auth code, code: %s", user_id, self.user_handler[user_id].code)
 
         # if token expired:
         #     self._refresh_token()
@@ -97,16 +103,16 @@ class StravaHandler:
             limit_15_min, limit_daily = limit.split(",")
             self.limit_15_min, self.limit_daily = int(limit_15_min), int(limit_daily)
         else:
-            # TODO: log
-            print("No Rate Limit In Headers")
+            logger.warning("No Rate Limit In Headers of %s", response.url)
 
         usage = response.headers.get("X-RateLimit-Usage")
         if usage:
             usage_15_min, usage_daily = usage.split(",")
             self.usage_15_min, self.usage_daily = int(usage_15_min), int(usage_daily)
         else:
-            # TODO: log
-            print("No Usage In Headers")
+            logger.warning("No Usage In Headers of %s", response.url)
+
+        record_strava_rate_limit(self.limit_15_min, self.limit_daily, self.usage_15_min, self.usage_daily)
 
     def _rate_limit(self):
         if self.usage_daily >= self.limit_daily:
@@ -114,8 +120,7 @@ class StravaHandler:
             raise Exception("Daily Rate Limit Exceeded")
 
         if self.usage_15_min >= self.limit_15_min:
-            # TODO: logging
-            print("15min Rate Limit Exceeded")
+            logger.warning("15min Rate Limit Exceeded, sleeping until the next quarter")
             sleep_until_next_quarter()
             self.usage_15_min = 0
 
@@ -129,13 +134,15 @@ class StravaHandler:
                  ):
         self._rate_limit()
         headers = {"Authorization": f"Bearer {self.user_handler[user_id].access_token}"}
-        response = requests.request(
-            method=method,
-            url=url,
-            headers=headers,
-            data=data,
-            params=params
-        )
+        with span("strava", "request"):
+            response = requests.request(
+                method=method,
+                url=url,
+                headers=headers,
+                data=data,
+                params=params
+            )
+        record_http("strava", response.status_code, request_size(response.request), len(response.content))
         self._track_rate_limit(response)
 
         if not response.ok:
@@ -164,17 +171,9 @@ class StravaHandler:
             if response.status_code == 500:
                 # Strava is having issues
                 return None
-            # TODO: richtiges logging wäre was feines
-            print()
-            print(f"request: {method} - {url}"
-                  f"\nrequest payload: {data}")
-            print("response:", response)
-            print("response usage:", response.headers.get("X-RateLimit-Usage"))
-            # TODO: richtig schlechter stil
-            try:
-                print("response content:", response.json())
-            except:
-                print(response.content)
+            logger.error(
+                "request: %s - %s, request payload: %s, response: %s, response usage: %s, response content: %s",
+                method, url, data, response, response.headers.get("X-RateLimit-Usage"), response.content)
 
         if response.ok:
             return response
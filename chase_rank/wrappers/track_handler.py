@@ -1,11 +1,19 @@
+from __future__ import annotations
+
+import logging
 from datetime import datetime, timedelta
 from pathlib import Path
 
-import gpxpy.gpx
-import geopandas as gpd
-from shapely.geometry import Point
-
 from .strava_handler import StravaHandler
+from ..instrumentation import record_cache, span
+from ..lazy import lazy_import
+from ..storage import atomic_path
+
+gpd = lazy_import("geopandas")
+gpxpy_gpx = lazy_import("gpxpy.gpx")
+shapely_geometry = lazy_import("shapely.geometry")
+
+logger = logging.getLogger(__name__)
 
 
 class TrackHandler:
@@ -34,17 +42,17 @@ class TrackHandler:
         # but having some gpx tracks for debugging is nice
         track_path = Path(self.track_folder_path, f"{activity_id}.gpx")
 
-        segment = gpxpy.gpx.GPXTrackSegment()
+        segment = gpxpy_gpx.GPXTrackSegment()
         segment.points = [
-            gpxpy.gpx.GPXTrackPoint(
+            gpxpy_gpx.GPXTrackPoint(
                 latitude=lat, longitude=long, elevation=alt, time=time)
             for lat, long, alt, time in
             track[["latitude", "longitude", "altitude", "timestamp"]].values.tolist()
         ]
         # TODO: find some better names that won't shadow everything else
-        track_ = gpxpy.gpx.GPXTrack()
+        track_ = gpxpy_gpx.GPXTrack()
         track_.segments.append(segment)
-        gpx_ = gpxpy.gpx.GPX()
+        gpx_ = gpxpy_gpx.GPX()
         gpx_.tracks.append(track_)
 
         with open(track_path, "w") as file_pointer:
@@ -52,9 +60,20 @@ class TrackHandler:
 
     def _save_track(self, activity_id: int, track: gpd.GeoDataFrame):
         track_path = Path(self.track_folder_path, f"{activity_id}.parquet")
-        track.to_parquet(track_path)
+        # workers sharing the folder never see half a track
+        with span("track", "save"), atomic_path(track_path) as temporary_path:
+            track.to_parquet(temporary_path)
         # self._save_track_as_gpx(activity_id, track)
 
+    def exists(self, activity_id: int) -> bool:
+        # also finds tracks stored by other processes since the folder was listed
+        if activity_id in self.track_id_list:
+            return True
+        if Path(self.track_folder_path, f"{activity_id}.parquet").exists():
+            self.track_id_list.append(activity_id)
+            return True
+        return False
+
     def add(self, activity_id: int, track: gpd.GeoDataFrame):
         self._save_track(activity_id, track)
         self.track_id_list.append(int(activity_id))
@@ -62,7 +81,9 @@ class TrackHandler:
     def get(self, activity_id: int, user_id: int = None, start_time: datetime = None) -> gpd.GeoDataFrame:
         # check if we already have the track of the activity stored
         if activity_id in self.track_id_list:
+            record_cache("track", hit=True)
             return self._load_track(activity_id)
+        record_cache("track", hit=False)
 
         # try to fetch the activity from strava
         if not user_id or not start_time or not self.strava:
@@ -75,25 +96,26 @@ class TrackHandler:
         time_stream = streams.get("time")
         if not all((latlng_stream, alt_stream, time_stream)):
             # TODO: proper Error
-            print(
-                f"Can't Build Track\nlatlng_stream: {bool(latlng_stream)}\nalt_stream: "
-                f"{bool(alt_stream)}\ntime_stream: {bool(time_stream)}")
+            logger.error(
+                "Can't Build Track %s, latlng_stream: %s, alt_stream: %s, time_stream: %s",
+                activity_id, bool(latlng_stream), bool(alt_stream), bool(time_stream))
             # TODO: proper logging
             raise KeyError
 
-        lat_stream, lng_stream = zip(*streams["latlng"]["data"])
-        track = gpd.GeoDataFrame(
-            data={
-                "latitude": lat_stream,
-                "longitude": lng_stream,
-                "altitude": alt_stream["data"],
-                "timestamp": [start_time + timedelta(seconds=seconds)
-                              for seconds in time_stream["data"]]
-            },
-            # x is longitude, y is latitude
-            geometry=[Point(lng, lat) for lat, lng in streams["latlng"]["data"]],
-            crs="EPSG:4326"
-        ).to_crs("EPSG:3857")
+        with span("track", "stream_decode"):
+            lat_stream, lng_stream = zip(*streams["latlng"]["data"])
+            track = gpd.GeoDataFrame(
+                data={
+                    "latitude": lat_stream,
+                    "longitude": lng_stream,
+                    "altitude": alt_stream["data"],
+                    "timestamp": [start_time + timedelta(seconds=seconds)
+                                  for seconds in time_stream["data"]]
+                },
+                # x is longitude, y is latitude
+                geometry=[shapely_geometry.Point(lng, lat) for lat, lng in streams["latlng"]["data"]],
+                crs="EPSG:4326"
+            ).to_crs("EPSG:3857")
 
         self.add(activity_id, track)
         return self._load_track(activity_id)
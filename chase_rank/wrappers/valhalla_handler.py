@@ -1,36 +1,220 @@
-from typing import Dict, List, Tuple
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 
-import requests
-import geopy.distance
-import geopandas as gpd
 import numpy as np
 import pandas as pd
-from routingpy import utils as routingpy_utils
-from shapely.geometry import Point, LineString
 
+from ..backends import Backend, BackendPool
+from ..gps_filter import clean_points, reindex_points
+from ..instrumentation import record_valhalla_error, span
+from ..lazy import lazy_import
+from ..storage import atomic_path
+from ..way_categorizer import with_match_dtypes
+
+gpd = lazy_import("geopandas")
+pa = lazy_import("pyarrow")
+pq = lazy_import("pyarrow.parquet")
+pyproj = lazy_import("pyproj")
+requests = lazy_import("requests")
+routingpy_utils = lazy_import("routingpy.utils")
+shapely_geometry = lazy_import("shapely.geometry")
+
+logger = logging.getLogger(__name__)
+
+# edge attributes taken over into the points of a match
+EDGE_ATTRIBUTES = ["length", "speed", "use", "unpaved", "surface", "travel_mode", "osm_way_id"]
+# sections longer than this are split into pieces of SECTION_PIECE meters, 20000 is the maximum of valhalla
+LONG_SECTION = 10000
+SECTION_PIECE = 5000
+# smartphones really mess up the interval, 5s seems to be safe
+# 10s and more confuse the matcher and 2~3 are still too short to catch all outliers
+SECTION_GAP = np.timedelta64(5, "s")
+
+
+def _next_distances(longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+    # geodesic distance of every point to the next one, the last point gets 0
+    distances = np.zeros(len(longitudes))
+    if len(longitudes) > 1:
+        _, _, distances[:-1] = pyproj.Geod(ellps="WGS84").inv(
+            longitudes[:-1], latitudes[:-1], longitudes[1:], latitudes[1:])
+    return distances
+
+
+def _stream_points(batches: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    # adds the distance to the next point, the last point of a batch waits for the first one of the next batch
+    pending = None
+    for batch in batches:
+        if pending is not None:
+            batch = pd.concat([pending, batch], ignore_index=True)
+        batch["distance"] = _next_distances(batch["longitude"].values, batch["latitude"].values)
+        pending = batch.iloc[-1:]
+        if len(batch) > 1:
+            yield batch.iloc[:-1]
+    if pending is not None:
+        yield pending.assign(distance=0.)
+
+
+class _SectionSplitter:
+    """
+    Labels match sections exactly like ValhallaHandler.split_track while the track streams through in batches.
+    Only the points of the open section are held back, of a long section only its open piece.
+    """
+
+    def __init__(self):
+        self.last_label = 0
+        self.previous_time = None
+        self.parts: List[pd.DataFrame] = []
+        self.distance = 0.
+        # label the pieces of an open long section start from and its distance already handed out
+        self.base: int = None
+        self.offset = 0.
+
+    def push(self, points: pd.DataFrame) -> List[Tuple[int, pd.DataFrame]]:
+        times = points["timestamp"].values
+        gaps = np.zeros(len(points), dtype=bool)
+        gaps[1:] = np.diff(times) > SECTION_GAP
+        if self.previous_time is not None:
+            gaps[0] = times[0] - self.previous_time > SECTION_GAP
+        self.previous_time = times[-1]
+
+        ready = []
+        bounds = np.unique(np.concatenate([[0], np.flatnonzero(gaps), [len(points)]]))
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if gaps[start]:
+                ready += self.close()
+            self.parts.append(points.iloc[start:end])
+            self.distance += points["distance"].values[start:end].sum()
+            if self.base is None and self.distance > LONG_SECTION:
+                self.base = self.last_label
+            if self.base is not None:
+                ready += self._split_long(final=False)
+        return ready
+
+    def _split_long(self, final: bool) -> List[Tuple[int, pd.DataFrame]]:
+        section = pd.concat(self.parts) if len(self.parts) > 1 else self.parts[0]
+        cumulative = self.offset + np.cumsum(section["distance"].values)
+        labels = self.base + (cumulative // SECTION_PIECE).astype(np.int64)
+        # the piece with the last label may still grow
+        done = len(section) if final else int(np.searchsorted(labels, labels[-1]))
+        starts = np.flatnonzero(np.diff(labels[:done], prepend=-1))
+        ends = np.append(starts[1:], done)
+        pieces = [(int(labels[start]), section.iloc[start:end]) for start, end in zip(starts, ends)]
+        if final:
+            self.last_label = int(labels[-1])
+        else:
+            self.offset = cumulative[done - 1] if done else self.offset
+            self.parts = [section.iloc[done:]]
+        return pieces
+
+    def close(self) -> List[Tuple[int, pd.DataFrame]]:
+        if not self.parts:
+            return []
+        if self.base is not None:
+            ready = self._split_long(final=True)
+        else:
+            self.last_label += 1
+            ready = [(self.last_label, pd.concat(self.parts) if len(self.parts) > 1 else self.parts[0])]
+        self.parts = []
+        self.distance = 0.
+        self.base = None
+        self.offset = 0.
+        return ready
+
+
+def _merge_labels(pieces: Iterator[Tuple[int, pd.DataFrame]]) -> Iterator[Tuple[int, pd.DataFrame]]:
+    # the first piece of a long section shares the label of the section before it, groupby matches them together
+    label, parts = None, []
+    for piece_label, piece in pieces:
+        if parts and piece_label != label:
+            yield label, pd.concat(parts) if len(parts) > 1 else parts[0]
+            parts = []
+        label = piece_label
+        parts.append(piece)
+    if parts:
+        yield label, pd.concat(parts) if len(parts) > 1 else parts[0]
+
+
+def _geo_table(frame: gpd.GeoDataFrame) -> pa.Table:
+    # GeoParquet metadata like GeoDataFrame.to_parquet writes, so every row group can be appended on its own
+    table = pa.Table.from_pandas(frame.to_wkb(), preserve_index=False)
+    geo = {
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "crs": frame.crs.to_json_dict(), "geometry_type": "Point"}},
+        "version": "0.4.0",
+        "creator": {"library": "geopandas", "version": gpd.__version__},
+    }
+    return table.replace_schema_metadata({**table.schema.metadata, b"geo": json.dumps(geo).encode()})
+
+
+class _NothingMatched(Exception):
+    pass
 
-class ValhallaHandler:
 
-    def __init__(self, base_url: str = "http://127.0.0.1:8002"):
-        self.base_url = base_url
+class ValhallaHandler:
+    """
+    Matches tracks with the trace_attributes endpoint of valhalla.
+    base_url can be a list of interchangeable valhalla instances, requests are balanced between them
+    and instances that stop answering are ejected until their /status probe succeeds again.
+    With filter_points only the points gps_filter.clean_points keeps are sent to valhalla,
+    the points dropped take over the match of the kept point before them.
+    """
+
+    def __init__(self,
+                 base_url: (str, List[str]) = "http://127.0.0.1:8002",
+                 timeout: float = None,
+                 probe_interval: float = 10.,
+                 max_failures: int = 3,
+                 eject_seconds: float = 30.,
+                 filter_points: bool = True):
+        urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        self.base_url = urls[0]
+        self.timeout = timeout
+        self.filter_points = filter_points
+        # a single instance is used no matter what, probing it would be pointless
+        self.backends = BackendPool(
+            urls,
+            probe=self._probe if len(urls) > 1 else None,
+            probe_interval=probe_interval,
+            max_failures=max_failures,
+            eject_seconds=eject_seconds
+        )
 
     @staticmethod
-    def _request(method: str, url: str, params: Dict = None, json: Dict = None):
+    def _probe(backend: Backend) -> bool:
+        return requests.get(f"{backend.url}/status", timeout=2).ok
+
+    def backend_report(self) -> pd.DataFrame:
+        return self.backends.report()
+
+    def close(self):
+        self.backends.stop()
+
+    def _request(self, method: str, path: str, params: Dict = None, json: Dict = None):
         headers = {}
-        response = requests.request(
+        response = self.backends.request(
+            "valhalla",
             method=method,
-            url=url,
+            path=path,
+            timeout=self.timeout,
             headers=headers,
             params=params,
             json=json
         )
         if not response.ok:
-            print("lol", response)
-            print(response.content)
+            # b'{"error_code":154,"error":"Path distance exceeds the max distance limit: 200000 meters",
+            # "status_code":400,"status":"Bad Request"}'
+            # b'{"error_code":171,"error":"No suitable edges near location","status_code":400,"status":"Bad Request"}'
+            try:
+                error = response.json()
+            except ValueError:
+                error = {}
+            record_valhalla_error(error.get("error_code", response.status_code))
+            logger.warning("valhalla request failed: %s %s", response, error or response.content)
             return None
-        # b'{"error_code":154,"error":"Path distance exceeds the max distance limit: 200000 meters",
-        # "status_code":400,"status":"Bad Request"}'
-        # b'{"error_code":171,"error":"No suitable edges near location","status_code":400,"status":"Bad Request"}'
 
         if response.ok:
             return response
@@ -43,7 +227,7 @@ class ValhallaHandler:
         trace_data = []
         trace_geometry = []
         for index, point in enumerate(matched_points):
-            trace_geometry.append(Point(point["lon"], point["lat"]))
+            trace_geometry.append(shapely_geometry.Point(point["lon"], point["lat"]))
             if point.get("edge_index") is not None:
                 # sometimes the edge_index seems to hold a super high number (maybe an id?)
                 # if this happens we set the edge_index to the same as the previous points
@@ -75,9 +259,9 @@ class ValhallaHandler:
         for edge in edges:
             edge_points = match_shape[edge["begin_shape_index"]:edge["end_shape_index"] + 1]
             if len(edge_points) > 1:
-                edge_geometry.append(LineString(edge_points))
+                edge_geometry.append(shapely_geometry.LineString(edge_points))
             else:
-                edge_geometry.append(Point(edge_points[0]))
+                edge_geometry.append(shapely_geometry.Point(edge_points[0]))
             # TODO: figure out what is most often available and what we really need
             edge_data.append({
                 "length": edge.get("length"),
@@ -101,39 +285,29 @@ class ValhallaHandler:
                 "indoor": edge.get("indoor"),
             })
 
-        return gpd.GeoDataFrame(
+        return with_match_dtypes(gpd.GeoDataFrame(
             edge_data,
             geometry=edge_geometry,
-            crs="EPSG:4326").to_crs("EPSG:3857")
+            crs="EPSG:4326").to_crs("EPSG:3857"))
 
     @staticmethod
-    def _combine_data(gpx_df, trace_df, edges_df):
-        empty_edge = edges_df.iloc[0].copy()
-        empty_edge.values[:] = None
-        trace_data_df = trace_df.apply(
-            lambda row: edges_df.iloc[int(row["edge_index"])]
-            if not pd.isnull(row["edge_index"]) else empty_edge, axis=1)
-        trace_data_df = trace_data_df[
-            ["length", "speed", "use", "unpaved", "surface", "travel_mode", "osm_way_id", "geometry"]]
-        trace_data_df["surface_section"] = (trace_data_df["surface"] != trace_data_df.shift()["surface"]).cumsum()
-        gpx_df_copy = gpx_df.copy()
-        gpx_df_copy[["surface", "surface_section", "use", "osm_way_id"]] = trace_data_df[
-            ["surface", "surface_section", "use", "osm_way_id"]]
-
-        # get distance
-        shift_frame = gpx_df_copy.shift(-1).drop("geometry", axis=1).rename(
-            columns={"longitude": "longitude_2", "latitude": "latitude_2"})
-
-        def dist(row: pd.core.series.Series) -> np.float64:
-            return geopy.distance.geodesic(
-                (row["latitude"], row["longitude"]), (row["latitude_2"], row["longitude_2"])
-            ).meters
-
-        gpx_df_copy["distance"] = pd.concat([gpx_df_copy, shift_frame], axis=1)[
-            ["longitude", "latitude", "longitude_2", "latitude_2"]
-        ].fillna(method="ffill", axis=0).apply(dist, axis=1).fillna(np.float64(0))
-        del shift_frame
+    def _edge_attributes(trace_df, edges_df) -> pd.DataFrame:
+        # take the edge of every point by its position, points without an edge get an empty row
+        # this keeps the categorical dtypes of the edges, a row wise apply would turn them back into objects
+        edge_positions = pd.to_numeric(trace_df["edge_index"]).fillna(-1).astype(np.int64).values
+        trace_data_df = pd.DataFrame(
+            edges_df[EDGE_ATTRIBUTES].reset_index(drop=True).reindex(edge_positions)).reset_index(drop=True)
+        trace_data_df["surface_section"] = (trace_data_df["surface"] != trace_data_df["surface"].shift()).cumsum()
+        return trace_data_df
 
+    @staticmethod
+    def _combine_data(gpx_df, trace_df, edges_df):
+        trace_data_df = ValhallaHandler._edge_attributes(trace_df, edges_df)
+        # only new columns are added, the points themselves are shared with gpx_df
+        gpx_df_copy = gpx_df.copy(deep=False)
+        for column in ["surface", "surface_section", "use", "osm_way_id"]:
+            gpx_df_copy[column] = trace_data_df[column].values
+        gpx_df_copy["distance"] = _next_distances(gpx_df_copy["longitude"].values, gpx_df_copy["latitude"].values)
         return gpx_df_copy
 
     def _match_section(self, locations: List[Tuple[int, int]], timestamps: List[int] = None) -> Dict:
@@ -141,7 +315,6 @@ class ValhallaHandler:
             # if we got less than two points it's not a proper shape
             return {}
 
-        url = f"{self.base_url}/trace_attributes"
         if timestamps is None:
             locations = [{"lon": lon, "lat": lat} for lon, lat in locations]
         else:
@@ -180,7 +353,7 @@ class ValhallaHandler:
         }
         response = self._request(
             method="post",
-            url=url,
+            path="/trace_attributes",
             params=None,
             json=payload,
         )
@@ -189,92 +362,85 @@ class ValhallaHandler:
         return {}
 
     @staticmethod
-    def _split_track(track: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    def split_track(track: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         # TODO: this whole function should be based on detecting pauses in movement
         #       so far I'm just splitting stuff at random
-        track = track.copy()
-
-        # search for splits in the trace bigger than 1s and label consecutive sections
-        # TODO: automatically determine default interval; it can't be 1s for every track right?
-        # NOTE: Smartphones really fuck up the interval, 5s seems to be save
-        #       10s and more confuse the matcher and 2~3 are still to short to catch all outliers
-        track["match_section"] = (track["timestamp"].diff() > pd.Timedelta(seconds=5)).cumsum()
-
-        # get distance
-        # we probably also do this somewhere else, but I really need it here and haven't cleaned up yet
-        # TODO: clean up
-        shift_track = track.shift(-1).drop("geometry", axis=1).rename(
-            columns={"longitude": "longitude_2", "latitude": "latitude_2"})
-
-        def dist(row: pd.Series) -> np.float64:
-            return geopy.distance.geodesic(
-                (row["latitude"], row["longitude"]), (row["latitude_2"], row["longitude_2"])
-            ).meters
-
-        track["distance"] = pd.concat([track, shift_track], axis=1)[
-            ["longitude", "latitude", "longitude_2", "latitude_2"]
-        ].fillna(method="ffill", axis=0).apply(dist, axis=1).fillna(np.float64(0))
-        del shift_track
-
-        # check if section we got so far are too long and split them up
-        group_sections = []
-        last_section_index = 0
-        for index, group in track.groupby("match_section"):
-            section_distance = group["distance"].sum()
-            if section_distance > 10000:  # 20000 is the maximum
-                new_sections = group["distance"].cumsum().apply(
-                    lambda d: int(d // 5000) + last_section_index).values.tolist()
-                group_sections.extend(new_sections)
-                last_section_index = new_sections[-1]
-            else:
-                last_section_index += 1
-                group_sections.extend([last_section_index] * len(group))
-
-        track["match_section"] = group_sections
+        # only new columns are added, the points themselves are shared with the track
+        track = track.copy(deep=False)
+        track["distance"] = _next_distances(track["longitude"].values, track["latitude"].values)
+
+        # split at gaps in the trace longer than SECTION_GAP and split up sections that are too long to match
+        # TODO: automatically determine default interval; it can't be 5s for every track right?
+        splitter = _SectionSplitter()
+        points = track[["timestamp", "distance"]]
+        pieces = splitter.push(points) + splitter.close() if len(points) else []
+        sections = [np.full(len(piece), label) for label, piece in pieces]
+        track.insert(
+            len(track.columns) - 1, "match_section",
+            np.concatenate(sections) if sections else np.empty(0, dtype=np.int64))
         return track
 
+    def _match_trace(self, section: pd.DataFrame) -> (gpd.GeoDataFrame, gpd.GeoDataFrame):
+        # trace of every point of a single section and the matched edges, None if nothing could be matched
+        kept = None
+        points = section
+        if self.filter_points:
+            with span("valhalla", "filter"):
+                kept = clean_points(
+                    section["longitude"].values, section["latitude"].values, section["timestamp"].values)
+            if len(kept) < len(section):
+                logger.debug("dropped %s of %s points before matching", len(section) - len(kept), len(section))
+                points = section.iloc[kept]
+
+        match = {}
+        if len(points):
+            start_time = points["timestamp"].iloc[0]
+            match = self._match_section(
+                points[["longitude", "latitude"]].values.tolist(),
+                points["timestamp"].apply(lambda t: (t - start_time).seconds).values.tolist()
+            )
+
+        if match.get("matched_points"):
+            trace_df = self._load_trace(match["matched_points"], len(match["edges"]))
+            if len(points) < len(section):
+                trace_df = trace_df.iloc[reindex_points(kept, len(section))].reset_index(drop=True)
+        else:
+            # add empty rows to keep the overall length the same as the source
+            data = [{
+                "lon": None,
+                "lat": None,
+                "type": None,
+                "edge_index": None,
+                "distance_along_edge": None,
+                "distance_from_trace_point": None
+            }] * len(section)
+            trace_df = gpd.GeoDataFrame(data)
+
+        edges_df = None
+        if match.get("edges"):
+            with span("valhalla", "decode"):
+                match_shape = routingpy_utils.decode_polyline6(match["shape"])
+                edges_df = self._load_edges(match["edges"], match_shape)
+        return trace_df, edges_df
+
     def match(self, track: gpd.GeoDataFrame) -> (gpd.GeoDataFrame, None):
         # split track in sections small enough for matching
-        track = self._split_track(track)
+        with span("valhalla", "split"):
+            track = self.split_track(track)
 
         traces = []
         edges = []
         edge_index_offset = 0
         for i, section in track.groupby(track["match_section"]):
-            start_time = section["timestamp"].iloc[0]
-            match = self._match_section(
-                section[["longitude", "latitude"]].values.tolist(),
-                section["timestamp"].apply(lambda t: (t - start_time).seconds).values.tolist()
-            )
-
-            if match.get("matched_points"):
-                trace_df = self._load_trace(match["matched_points"], len(match["edges"]))
-            else:
-                # add empty rows to keep the overall length the same as the source
-                data = [{
-                    "lon": None,
-                    "lat": None,
-                    "type": None,
-                    "edge_index": None,
-                    "distance_along_edge": None,
-                    "distance_from_trace_point": None
-                }] * len(section)
-                trace_df = gpd.GeoDataFrame(data)
-
-            if match.get("edges"):
-                match_shape = routingpy_utils.decode_polyline6(match["shape"])
-                edges_df = self._load_edges(match["edges"], match_shape)
+            trace_df, edges_df = self._match_trace(section)
+            if edges_df is not None:
                 try:
                     trace_df["edge_index"] = trace_df["edge_index"].apply(
                         lambda index: index + edge_index_offset if index is not None else None)
-                except TypeError as e:
-                    # TODO: logging instead of prints
-                    print("### Exception")
-                    print(match["matched_points"])
-                    print(match["edges"])
-                    print(trace_df["edge_index"])
-                    print()
-                    raise e
+                except TypeError:
+                    logger.exception(
+                        "can't offset edge_index of section %s\nedge_index: %s", i, trace_df["edge_index"].tolist())
+                    raise
 
                 edge_index_offset += len(edges_df)
                 edges.append(edges_df)
@@ -286,4 +452,81 @@ class ValhallaHandler:
 
         trace_df = pd.concat(traces, axis=0).reset_index(drop=True)
         edges_df = pd.concat(edges, axis=0).reset_index(drop=True)
-        return self._combine_data(track, trace_df, edges_df)
+        with span("valhalla", "combine"):
+            return self._combine_data(track, trace_df, edges_df)
+
+    @staticmethod
+    def _read_track(track_path: Path, batch_size: int) -> Iterator[pd.DataFrame]:
+        # the geometry is rebuilt from longitude and latitude, reading it would double the memory of a batch
+        parquet_file = pq.ParquetFile(track_path)
+        columns = [column for column in parquet_file.schema_arrow.names if column != "geometry"]
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
+
+    def _write_sections(self, pieces: Iterator[Tuple[int, pd.DataFrame]], path: Path) -> bool:
+        # matches and appends one section at a time, returns whether any section could be matched
+        writer = None
+        matched = False
+        # surface and surface_section of the last point written, the labels continue over sections
+        last_surface, last_surface_section = None, 0
+        try:
+            for label, section in _merge_labels(pieces):
+                trace_df, edges_df = self._match_trace(section)
+                matched |= edges_df is not None
+                if edges_df is None:
+                    edges_df = pd.DataFrame({column: pd.Series(dtype=float) for column in EDGE_ATTRIBUTES})
+                with span("valhalla", "combine"):
+                    attributes = self._edge_attributes(trace_df, with_match_dtypes(edges_df))
+                    continues = len(attributes) and attributes["surface"].iloc[0] == last_surface
+                    attributes["surface_section"] += last_surface_section - int(continues)
+                    last_surface, last_surface_section = (
+                        attributes["surface"].iloc[-1], int(attributes["surface_section"].iloc[-1]))
+
+                    section = section.reset_index(drop=True)
+                    distances = section.pop("distance")
+                    combined = gpd.GeoDataFrame(
+                        section,
+                        # x is longitude, y is latitude
+                        geometry=gpd.points_from_xy(section["longitude"], section["latitude"]),
+                        crs="EPSG:4326"
+                    ).to_crs("EPSG:3857")
+                    combined["match_section"] = np.int64(label)
+                    combined["distance"] = distances
+                    combined["surface"] = attributes["surface"]
+                    combined["surface_section"] = attributes["surface_section"].astype(np.int64)
+                    combined["use"] = attributes["use"]
+                    combined["osm_way_id"] = attributes["osm_way_id"].astype(float)
+                    table = _geo_table(combined)
+
+                with span("valhalla", "write"):
+                    if writer is None:
+                        writer = pq.ParquetWriter(path, table.schema)
+                    writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return matched
+
+    def match_chunked(self, track_path: Path, match_path: Path, batch_size: int = 10000) -> (Path, None):
+        """
+        Matches a track stored by TrackHandler section by section and appends every section to match_path,
+        the result is the same as storing match(track). For multi-day tracks that don't fit in memory a few times:
+        only batch_size points and the points of the section being matched are held at once,
+        neither depends on the length of the track. Returns None if nothing could be matched.
+        """
+        splitter = _SectionSplitter()
+
+        def pieces() -> Iterator[Tuple[int, pd.DataFrame]]:
+            for points in _stream_points(self._read_track(track_path, batch_size)):
+                yield from splitter.push(points)
+            yield from splitter.close()
+
+        # written next to match_path and renamed after the last section, a failed match never looks finished
+        try:
+            with atomic_path(Path(match_path)) as temporary:
+                if not self._write_sections(pieces(), temporary):
+                    # drops the temporary file, an earlier match of the activity is kept
+                    raise _NothingMatched
+        except _NothingMatched:
+            return None
+        return match_path
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, Set
+
+import numpy as np
+import pandas as pd
+
+from ..lazy import lazy_import
+from ..storage import atomic_path
+
+gpd = lazy_import("geopandas")
+
+KEY_COLUMNS = ["user_id", "osm_way_id", "surface", "period"]
+VALUE_COLUMNS = ["distance", "time", "count"]
+
+
+class WayAggregateHandler:
+    """
+    Keeps distance, time and number of activities per (user_id, osm_way_id, surface, period).
+    The totals are updated with every match added to or removed from the MatchHandler,
+    so questions about who rode which ways are answered without loading any match.
+    Periods are months formatted as YYYY-MM.
+    The contribution of every activity is stored in a file of its own, adding a match only writes that file.
+    The totals are written by save(), with autosave after every save_interval changes. Until then a marker
+    file says the stored totals are behind, they are rebuilt from the contributions on the next load.
+    """
+
+    def __init__(self, path: Path, autosave: bool = True, save_interval: int = 100):
+        self.path = path
+        self.aggregates_path = Path(self.path, "way_aggregates.parquet")
+        self.contributions_path = Path(self.path, "way_contributions")
+        self.contributions_path.mkdir(parents=True, exist_ok=True)
+        self.unsaved_path = Path(self.path, "way_aggregates.unsaved")
+        self.autosave = autosave
+        self.save_interval = save_interval
+
+        # activities with a stored contribution, needed to take them back out on deletes and rematches
+        self.activity_ids: Set[int] = set()
+        self._totals: Dict[tuple, np.ndarray] = {}
+        # materialized frame of _totals for queries, rebuilt after changes
+        self._aggregates: pd.DataFrame = None
+        self._unsaved = 0
+        self._load()
+
+    def _contribution_path(self, activity_id: int) -> Path:
+        return Path(self.contributions_path, f"{activity_id}.parquet")
+
+    def _read_contribution(self, activity_id: int) -> pd.DataFrame:
+        return pd.read_parquet(self._contribution_path(activity_id))
+
+    def _write_contribution(self, activity_id: int, contribution: pd.DataFrame):
+        with atomic_path(self._contribution_path(activity_id)) as temporary_path:
+            contribution.to_parquet(temporary_path)
+
+    def _load(self):
+        self.activity_ids = {int(file.stem)
+                             for file in self.contributions_path.iterdir()
+                             if file.suffix == ".parquet" and file.stem.isdigit()}
+
+        if self.aggregates_path.exists() and not self.unsaved_path.exists():
+            self._totals = self._totals_of(pd.read_parquet(self.aggregates_path))
+        elif self.activity_ids or self.unsaved_path.exists():
+            # the stored totals are missing or behind the contributions
+            self._rebuild()
+
+    @staticmethod
+    def _totals_of(aggregates: pd.DataFrame) -> Dict[tuple, np.ndarray]:
+        return {
+            tuple(key): np.array(values, dtype=np.float64)
+            for key, values in zip(
+                aggregates[KEY_COLUMNS].itertuples(index=False, name=None),
+                aggregates[VALUE_COLUMNS].values)
+        }
+
+    def _rebuild(self):
+        contributions = [self._read_contribution(activity_id) for activity_id in sorted(self.activity_ids)]
+        self._totals = {}
+        if contributions:
+            self._totals = self._totals_of(
+                pd.concat(contributions, ignore_index=True).groupby(KEY_COLUMNS, sort=False)[VALUE_COLUMNS]
+                .sum().reset_index())
+        self._aggregates = None
+        self.save()
+
+    def save(self):
+        with atomic_path(self.aggregates_path) as temporary_path:
+            self.aggregates.reset_index().to_parquet(temporary_path)
+        self.unsaved_path.unlink(missing_ok=True)
+        self._unsaved = 0
+
+    def _changing(self):
+        # the marker goes first, a crash before the next save leaves it behind
+        if not self._unsaved:
+            self.unsaved_path.touch()
+        self._unsaved += 1
+
+    def _changed(self):
+        if self.autosave and self._unsaved >= self.save_interval:
+            self.save()
+
+    @staticmethod
+    def _contribution(user_id: int, match: gpd.GeoDataFrame) -> pd.DataFrame:
+        # points are only counted if they could be matched to a way
+        matched = match["osm_way_id"].notnull().values
+
+        timestamps = match["timestamp"].values
+        # time until the next point of the same match section, the last point of a section gets none
+        time = np.zeros(len(match), dtype=np.float64)
+        time[:-1] = (timestamps[1:] - timestamps[:-1]) / np.timedelta64(1, "s")
+        sections = match["match_section"].values
+        time[:-1][sections[1:] != sections[:-1]] = 0.
+
+        frame = pd.DataFrame({
+            "osm_way_id": match["osm_way_id"].values[matched].astype(np.int64),
+            "surface": match["surface"].astype(object).fillna("unknown").astype(str).values[matched],
+            "period": timestamps[matched].astype("datetime64[M]").astype(str),
+            "distance": match["distance"].values[matched],
+            "time": time[matched],
+        })
+        contribution = frame.groupby(["osm_way_id", "surface", "period"], sort=False).sum().reset_index()
+        contribution.insert(0, "user_id", str(user_id))  # same as activities, should be int
+        contribution["count"] = 1.
+        return contribution
+
+    def _apply(self, contribution: pd.DataFrame, sign: int):
+        for key, values in zip(
+                contribution[KEY_COLUMNS].itertuples(index=False, name=None),
+                contribution[VALUE_COLUMNS].values):
+            total = self._totals.get(key)
+            if total is None:
+                self._totals[key] = sign * values
+                continue
+            total += sign * values
+            if total[2] <= 0:
+                # no activity left on this key
+                del self._totals[key]
+        self._aggregates = None
+
+    def add(self, activity_id: int, user_id: int, match: gpd.GeoDataFrame):
+        # adding an activity again replaces its previous contribution, e.g. after a rematch
+        contribution = self._contribution(user_id, match)
+        self._changing()
+        if activity_id in self.activity_ids:
+            self._apply(self._read_contribution(activity_id), -1)
+        self._apply(contribution, 1)
+        self._write_contribution(activity_id, contribution)
+        self.activity_ids.add(activity_id)
+        self._changed()
+
+    def remove(self, activity_id: int):
+        if activity_id not in self.activity_ids:
+            raise KeyError
+        self._changing()
+        self._apply(self._read_contribution(activity_id), -1)
+        self._contribution_path(activity_id).unlink()
+        self.activity_ids.remove(activity_id)
+        self._changed()
+
+    @property
+    def aggregates(self) -> pd.DataFrame:
+        if self._aggregates is None:
+            keys = list(self._totals.keys())
+            values = np.array(list(self._totals.values())).reshape(-1, len(VALUE_COLUMNS))
+            index = pd.MultiIndex.from_tuples(keys, names=KEY_COLUMNS) if keys else pd.MultiIndex.from_arrays(
+                [[]] * len(KEY_COLUMNS), names=KEY_COLUMNS)
+            aggregates = pd.DataFrame(values, index=index, columns=VALUE_COLUMNS)
+            aggregates["count"] = aggregates["count"].astype(np.int64)
+            self._aggregates = aggregates.sort_index()
+        return self._aggregates
+
+    def _select(self, user_id: int = None, surface: str = None, period: str = None) -> pd.DataFrame:
+        aggregates = self.aggregates
+        if user_id is not None:
+            aggregates = aggregates[aggregates.index.get_level_values("user_id") == str(user_id)]
+        if surface is not None:
+            aggregates = aggregates[aggregates.index.get_level_values("surface") == surface]
+        if period is not None:
+            # a year matches all its months
+            aggregates = aggregates[aggregates.index.get_level_values("period").str.startswith(period)]
+        return aggregates
+
+    def top_users(self, surface: str = None, period: str = None, n: int = 10, by: str = "distance") -> pd.DataFrame:
+        return self._select(surface=surface, period=period).groupby(level="user_id").agg(
+            {"distance": "sum", "time": "sum", "count": "sum"}).nlargest(n, by)
+
+    def user_ways(self, user_id: int, surface: str = None, period: str = None) -> pd.DataFrame:
+        return self._select(user_id=user_id, surface=surface, period=period).groupby(
+            level=["osm_way_id", "surface"]).sum().sort_values("distance", ascending=False)
+
+    def way_users(self, osm_way_id: int, period: str = None) -> pd.DataFrame:
+        aggregates = self._select(period=period)
+        aggregates = aggregates[aggregates.index.get_level_values("osm_way_id") == osm_way_id]
+        return aggregates.groupby(level="user_id").sum().sort_values("distance", ascending=False)
@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from chase_rank.wrappers.valhalla_handler import ValhallaHandler
+
+# smallest answer that makes it through ValhallaHandler._request
+TRACE_ATTRIBUTES = json.dumps({"edges": [], "matched_points": [], "shape": ""}).encode()
+LOCATIONS = [(9.18, 48.78), (9.181, 48.781), (9.182, 48.782)]
+LATENCY = 0.02
+
+
+class _StandIn:
+    # a stand-in valhalla on a local port that can be stopped and started again on the same port
+
+    def __init__(self, latency: float, status: int = 200):
+        self.latency = latency
+        self.status = status
+        self.port = 0
+        self.server: ThreadingHTTPServer = None
+        self.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._answer(200, b'{"version": "stand-in"}')
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(stand_in.latency)
+                self._answer(stand_in.status, TRACE_ATTRIBUTES if stand_in.status == 200 else b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_ins():
+    # the last stand-in is three times as slow as the others
+    servers = [_StandIn(LATENCY), _StandIn(LATENCY), _StandIn(LATENCY * 3)]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def _run_load(handler: ValhallaHandler, requests: int, concurrency: int = 6) -> int:
+    # returns the number of failed requests, an empty answer is a request no backend could serve
+    failed = 0
+    lock = threading.Lock()
+
+    def request(_):
+        nonlocal failed
+        try:
+            answered = bool(handler._match_section(LOCATIONS))
+        except Exception:
+            answered = False
+        if not answered:
+            with lock:
+                failed += 1
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(request, range(requests)))
+    return failed
+
+
+def test_slow_backend_gets_fewer_requests(stand_ins):
+    handler = ValhallaHandler([stand_in.url for stand_in in stand_ins])
+    try:
+        assert _run_load(handler, 150) == 0
+        report = handler.backend_report()
+    finally:
+        handler.close()
+
+    requests = report["requests"].values
+    assert requests.sum() == 150
+    assert requests[2] < min(requests[:2])
+    # per backend latency is recorded, the slow one shows it
+    assert report["mean_seconds"].iloc[2] > report["mean_seconds"].iloc[:2].max()
+    assert (report["max_seconds"] >= report["mean_seconds"]).all()
+    assert (report["errors"] == 0).all()
+
+
+def test_stopped_backend_is_ejected_and_readmitted(stand_ins):
+    handler = ValhallaHandler(
+        [stand_in.url for stand_in in stand_ins],
+        timeout=1., probe_interval=0.1, max_failures=1, eject_seconds=30.)
+    try:
+        stopped = threading.Timer(0.1, stand_ins[0].stop)
+        stopped.start()
+        assert _run_load(handler, 200) == 0
+        stopped.join()
+        report = handler.backend_report()
+        first = stand_ins[0].url
+        assert report.loc[first, "ejections"] >= 1
+        assert not report.loc[first, "healthy"]
+        assert not report.loc[first, "last_probe"]
+
+        stand_ins[0].start()
+        # eject_seconds is far off, only the probe can bring the backend back
+        deadline = time.monotonic() + 5.
+        while not handler.backend_report().loc[first, "healthy"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert handler.backend_report().loc[first, "healthy"]
+        assert handler.backend_report().loc[first, "last_probe"]
+
+        requests = handler.backend_report().loc[first, "requests"]
+        assert _run_load(handler, 60) == 0
+        assert handler.backend_report().loc[first, "requests"] > requests
+    finally:
+        handler.close()
+
+
+def test_server_errors_are_retried_and_counted(stand_ins):
+    stand_ins[1].status = 503
+    handler = ValhallaHandler(
+        [stand_in.url for stand_in in stand_ins[:2]], probe_interval=60., max_failures=2, eject_seconds=30.)
+    try:
+        assert _run_load(handler, 40) == 0
+        report = handler.backend_report()
+    finally:
+        handler.close()
+
+    failing = report.loc[stand_ins[1].url]
+    assert failing["errors"] == failing["requests"] >= 2
+    assert failing["error_rate"] == 1.
+    assert failing["ejections"] >= 1
+    assert report.loc[stand_ins[0].url, "errors"] == 0
+    assert report.loc[stand_ins[0].url, "requests"] == 40
@@ -0,0 +1,113 @@
+import io
+import struct
+
+import numpy as np
+import pytest
+
+from chase_rank.fit import FIT_EPOCH, SEMICIRCLES_TO_DEGREES, FitDecodeError, read_fit
+
+START = 1000000000
+
+
+def _semicircles(degrees: float) -> int:
+    return int(round(degrees / SEMICIRCLES_TO_DEGREES))
+
+
+def _definition(local_type: int, global_number: int, fields: list, big_endian: bool = False) -> bytes:
+    # fields as (number, size, base type)
+    byteorder = ">" if big_endian else "<"
+    header = bytes([0x40 | local_type, 0, int(big_endian)]) + struct.pack(f"{byteorder}H", global_number)
+    return header + bytes([len(fields)]) + b"".join(bytes(field) for field in fields)
+
+
+RECORD_FIELDS = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84)]
+
+
+def _record(timestamp: int, latitude: float, longitude: float, altitude: float, big_endian: bool = False) -> bytes:
+    byteorder = ">" if big_endian else "<"
+    return bytes([0x00]) + struct.pack(
+        f"{byteorder}IiiH", timestamp, _semicircles(latitude), _semicircles(longitude), int((altitude + 500) * 5))
+
+
+def _fit_file(records: bytes) -> bytes:
+    return struct.pack("<BBHI4s", 12, 16, 2100, len(records), b".FIT") + records + b"\0\0"
+
+
+def test_reads_records():
+    records = _definition(0, 20, RECORD_FIELDS) + b"".join(
+        _record(START + i, 48 + i * 1e-4, 9.5, 300 + i) for i in range(5))
+    track = read_fit(io.BytesIO(_fit_file(records)))
+
+    assert set(track) == {"time", "latitude", "longitude", "elevation", "segment"}
+    expected_time = FIT_EPOCH + np.arange(START, START + 5).astype("timedelta64[s]")
+    np.testing.assert_array_equal(track["time"], expected_time.astype("datetime64[ns]"))
+    np.testing.assert_allclose(track["latitude"], 48 + np.arange(5) * 1e-4, atol=1e-6)
+    np.testing.assert_allclose(track["longitude"], 9.5, atol=1e-6)
+    np.testing.assert_allclose(track["elevation"], 300 + np.arange(5))
+    np.testing.assert_array_equal(track["segment"], 0)
+
+
+def test_compressed_timestamps():
+    records = _definition(0, 20, RECORD_FIELDS) + _record(START, 48., 9., 100.)
+    # compressed timestamp headers only carry the lower 5 bits, the offset wraps around past 31
+    position = struct.pack("<iiH", _semicircles(48.001), _semicircles(9.), 3000)
+    for seconds in (3, 30, 35):
+        timestamp = START + seconds
+        records += bytes([0x80 | (timestamp & 0x1F)]) + struct.pack("<I", 0xFFFFFFFF) + position
+    track = read_fit(io.BytesIO(_fit_file(records)))
+
+    offsets = (track["time"] - track["time"][0]) / np.timedelta64(1, "s")
+    np.testing.assert_array_equal(offsets, [0, 3, 30, 35])
+
+
+def test_skips_records_without_position_and_other_messages():
+    invalid_position = bytes([0x00]) + struct.pack("<IiiH", START + 1, 0x7FFFFFFF, 0x7FFFFFFF, 3000)
+    records = (
+        _definition(0, 20, RECORD_FIELDS)
+        + _record(START, 48., 9., 100.)
+        + invalid_position
+        # a lap message with a timestamp
+        + _definition(1, 19, [(253, 4, 0x86)]) + bytes([0x01]) + struct.pack("<I", START + 2)
+        + _record(START + 3, 48.001, 9., 101.)
+    )
+    track = read_fit(io.BytesIO(_fit_file(records)))
+
+    assert len(track["time"]) == 2
+    np.testing.assert_allclose(track["elevation"], [100., 101.])
+
+
+def test_missing_altitude_and_enhanced_altitude():
+    fields = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84), (78, 4, 0x86)]
+    records = _definition(0, 20, fields)
+    # the enhanced altitude wins over the plain one
+    records += bytes([0x00]) + struct.pack(
+        "<IiiHI", START, _semicircles(48.), _semicircles(9.), 0xFFFF, int((1234.4 + 500) * 5))
+    records += bytes([0x00]) + struct.pack(
+        "<IiiHI", START + 1, _semicircles(48.), _semicircles(9.), 0xFFFF, 0xFFFFFFFF)
+    track = read_fit(io.BytesIO(_fit_file(records)))
+
+    assert track["elevation"][0] == pytest.approx(1234.4)
+    assert np.isnan(track["elevation"][1])
+
+
+def test_big_endian_and_chained_files():
+    first = _definition(0, 20, RECORD_FIELDS, big_endian=True) + b"".join(
+        _record(START + i, 48., 9., 200., big_endian=True) for i in range(3))
+    second = _definition(0, 20, RECORD_FIELDS) + b"".join(_record(START + 10 + i, 47., 8., 100.) for i in range(2))
+    track = read_fit(io.BytesIO(_fit_file(first) + _fit_file(second)))
+
+    np.testing.assert_array_equal(track["segment"], [0, 0, 0, 1, 1])
+    np.testing.assert_allclose(track["latitude"], [48.] * 3 + [47.] * 2, atol=1e-6)
+    np.testing.assert_allclose(track["elevation"], [200.] * 3 + [100.] * 2)
+
+
+def test_empty_file():
+    track = read_fit(io.BytesIO(b""))
+    assert all(len(values) == 0 for values in track.values())
+
+
+def test_broken_files():
+    with pytest.raises(FitDecodeError):
+        read_fit(io.BytesIO(struct.pack("<BBHI4s", 12, 16, 2100, 0, b"NOPE")))
+    with pytest.raises(FitDecodeError):
+        read_fit(io.BytesIO(_fit_file(_record(START, 48., 9., 100.))))
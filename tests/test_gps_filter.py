@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from chase_rank.gps_filter import clean_points, reindex_points
+
+METERS_PER_DEGREE = 111320.
+
+
+def _ride(size: int, speed: float = 7., seed: int = 0):
+    # straight ride to the north with a few meters of jitter, one point per second
+    rng = np.random.default_rng(seed)
+    latitudes = 48.78 + (np.arange(size) * speed + rng.normal(0, 1, size)) / METERS_PER_DEGREE
+    longitudes = 9.18 + rng.normal(0, 1, size) / (METERS_PER_DEGREE * np.cos(np.radians(48.78)))
+    timestamps = np.datetime64("2023-05-01T08:00:00") + np.arange(size).astype("timedelta64[s]")
+    return longitudes, latitudes, timestamps
+
+
+@pytest.mark.parametrize("kept, size, expected", [
+    # dropped points take the kept point before them
+    ([0, 2, 5], 7, [0, 0, 1, 1, 1, 2, 2]),
+    # dropped points at the start take the first kept point
+    ([2, 3], 5, [0, 0, 0, 1, 1]),
+    ([0, 1, 2], 3, [0, 1, 2]),
+    ([4], 6, [0, 0, 0, 0, 0, 0]),
+])
+def test_reindex_points(kept, size, expected):
+    np.testing.assert_array_equal(reindex_points(np.array(kept), size), expected)
+
+
+def test_reindex_points_restores_the_length():
+    longitudes, latitudes, timestamps = _ride(300)
+    latitudes[[50, 200]] += 500 / METERS_PER_DEGREE
+    kept = clean_points(longitudes, latitudes, timestamps)
+    positions = reindex_points(kept, len(longitudes))
+
+    assert len(positions) == len(longitudes)
+    # every kept point maps onto itself
+    np.testing.assert_array_equal(positions[kept], np.arange(len(kept)))
+    assert np.all(np.diff(positions) >= 0)
+
+
+def test_clean_track_keeps_everything():
+    longitudes, latitudes, timestamps = _ride(200)
+    np.testing.assert_array_equal(clean_points(longitudes, latitudes, timestamps), np.arange(200))
+
+
+def test_drops_invalid_and_repeated_points():
+    longitudes, latitudes, timestamps = _ride(50)
+    longitudes[3] = np.nan
+    longitudes[5], latitudes[5] = 0., 0.
+    latitudes[7] = 95.
+    # the same second twice and a point from the past
+    timestamps[11] = timestamps[10]
+    timestamps[20] = timestamps[15]
+    kept = clean_points(longitudes, latitudes, timestamps)
+
+    assert not set(kept) & {3, 5, 7, 11, 20}
+    assert len(kept) == 45
+
+
+def test_drops_spikes_but_not_jumps():
+    longitudes, latitudes, timestamps = _ride(200)
+    # single points far off the road
+    latitudes[40] += 400 / METERS_PER_DEGREE
+    longitudes[100] += 600 / METERS_PER_DEGREE
+    # the signal comes back 2km further on, everything after the jump is valid
+    latitudes[150:] += 2000 / METERS_PER_DEGREE
+    timestamps[150:] += np.timedelta64(60, "s")
+    kept = clean_points(longitudes, latitudes, timestamps)
+
+    assert not set(kept) & {40, 100}
+    assert len(kept) == 198
+    assert set(range(150, 200)) <= set(kept)
+
+
+def test_drops_standing_jitter():
+    longitudes, latitudes, timestamps = _ride(300, seed=1)
+    # standing at a crossing for two minutes, wobbling a few meters around the same spot
+    rng = np.random.default_rng(2)
+    stop = slice(100, 220)
+    latitudes[stop] = latitudes[100] + rng.normal(0, 3, 120) / METERS_PER_DEGREE
+    longitudes[stop] = longitudes[100] + rng.normal(0, 3, 120) / (METERS_PER_DEGREE * np.cos(np.radians(48.78)))
+    latitudes[220:] = latitudes[220:] - (latitudes[220] - latitudes[100]) + 7 / METERS_PER_DEGREE
+    kept = clean_points(longitudes, latitudes, timestamps)
+
+    standing = set(range(100, 220)) - set(kept)
+    assert len(standing) > 90
+    # the ride before and after the stop is kept
+    assert set(range(0, 90)) <= set(kept)
+    assert set(range(232, 300)) <= set(kept)
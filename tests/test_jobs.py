@@ -0,0 +1,176 @@
+import json
+import sqlite3
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from chase_rank.jobs import JobQueue, Worker, analyze_task
+from chase_rank.way_categorizer import with_match_dtypes
+from chase_rank.wrappers.match_handler import MatchHandler
+
+LEASE = 0.2
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(tmp_path / "jobs.sqlite", lease_seconds=LEASE, max_attempts=2)
+
+
+def _items(activity_ids):
+    return [(activity_id, 7, None) for activity_id in activity_ids]
+
+
+def _row(queue, shard, kind="match"):
+    connection = sqlite3.connect(queue.path)
+    try:
+        return connection.execute(
+            "SELECT status, worker, attempts, done, result, error FROM jobs WHERE kind = ? AND shard = ?",
+            (kind, shard)
+        ).fetchone()
+    finally:
+        connection.close()
+
+
+def test_submit_skips_queued_items(queue):
+    assert queue.submit("match", _items(range(10)), shard_size=4) == 3
+    assert queue.submit("match", _items(range(12)), shard_size=4) == 1
+    assert queue.outstanding() == 4
+    with pytest.raises(ValueError):
+        queue.submit("render", _items([1]))
+
+
+def test_claim_leases_a_shard_once(queue):
+    queue.submit("match", _items(range(4)), shard_size=2)
+    first = queue.claim("a")
+    second = queue.claim("b")
+    assert (first.shard, second.shard) == (0, 1)
+    assert first.items == [[0, 7, None], [1, 7, None]]
+    assert queue.claim("c") is None
+
+
+def test_expired_lease_goes_to_the_next_worker(queue):
+    queue.submit("match", _items(range(3)))
+    job = queue.claim("crashed")
+    job.done.append(0)
+    assert queue.heartbeat(job)
+    assert queue.claim("other") is None
+
+    time.sleep(LEASE * 1.5)
+    taken_over = queue.claim("other")
+    assert taken_over.shard == job.shard
+    assert taken_over.attempts == 2
+    # the progress of the crashed worker is kept
+    assert taken_over.done == [0]
+    # the crashed worker comes back, its lease is gone
+    assert not queue.heartbeat(job)
+
+    assert queue.complete(taken_over, {"done": 2})
+    assert not queue.complete(job, {"done": 3})
+    assert _row(queue, 0)[:3] == ("done", "other", 2)
+
+
+def test_expired_lease_fails_after_max_attempts(queue):
+    queue.submit("match", _items([1]))
+    for _ in range(2):
+        assert queue.claim("crashing") is not None
+        time.sleep(LEASE * 1.5)
+    assert queue.claim("other") is None
+    status, _, attempts, _, _, error = _row(queue, 0)
+    assert (status, attempts, error) == ("failed", 2, "lease expired")
+    assert queue.outstanding() == 0
+
+    assert queue.retry_failed("match") == 1
+    job = queue.claim("other")
+    assert job.attempts == 1
+
+
+def test_fail_requeues_until_max_attempts(queue):
+    queue.submit("match", _items([1]))
+    job = queue.claim("a")
+    queue.fail(job, "boom")
+    assert _row(queue, 0)[0] == "pending"
+    job = queue.claim("a")
+    queue.fail(job, "boom")
+    assert _row(queue, 0)[0] == "failed"
+    assert queue.claim("a") is None
+
+
+def test_worker_retries_failed_activities_only(queue):
+    queue.submit("match", _items(range(4)))
+    calls = []
+    failures = {2: 1}
+
+    def task(item):
+        calls.append(item[0])
+        if failures.get(item[0]):
+            failures[item[0]] -= 1
+            raise RuntimeError("valhalla is down")
+        return True
+
+    worker = Worker(queue, {"match": task}, worker_id="w", heartbeat_interval=LEASE / 4)
+    assert worker.run(poll_interval=0.01) == 2
+    # the second attempt only runs the activity that failed
+    assert calls == [0, 1, 2, 3, 2]
+    status, _, attempts, done, result, error = _row(queue, 0)
+    assert (status, attempts, error) == ("done", 2, None)
+    assert sorted(json.loads(done)) == [0, 1, 2, 3]
+    assert json.loads(result) == {"done": 1, "skipped": 3}
+
+
+def test_worker_gives_up_on_activities_that_keep_failing(queue):
+    queue.submit("match", _items(range(2)))
+
+    def task(item):
+        if item[0] == 1:
+            raise RuntimeError("broken track")
+        return True
+
+    Worker(queue, {"match": task}, worker_id="w", heartbeat_interval=LEASE / 4).run(poll_interval=0.01)
+    status, _, attempts, done, _, error = _row(queue, 0)
+    assert (status, attempts) == ("failed", 2)
+    assert json.loads(done) == [0]
+    assert "broken track" in json.loads(error)["1"]
+
+
+def _ride_match(size: int) -> gpd.GeoDataFrame:
+    # a ride to the north on asphalt, matched onto a single way
+    latitudes = 48.78 + np.arange(size) * 5e-5
+    longitudes = np.full(size, 9.18)
+    match = gpd.GeoDataFrame(
+        {
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "altitude": 250. + np.arange(size) * 0.1,
+            "timestamp": pd.Timestamp("2023-05-01 08:00") + pd.to_timedelta(np.arange(size), unit="s"),
+            "distance": np.full(size, 5.56),
+            "match_section": np.ones(size, dtype=np.int64),
+        },
+        geometry=gpd.points_from_xy(longitudes, latitudes),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3857")
+    match.insert(len(match.columns) - 1, "surface", "asphalt")
+    match["surface_section"] = 1
+    match["use"] = "road"
+    match["osm_way_id"] = 1.
+    return with_match_dtypes(match)
+
+
+def test_analyze_task_writes_summaries(tmp_path):
+    match_handler = MatchHandler(tmp_path)
+    match_handler.add(1, _ride_match(120))
+    # the summary folder doesn't exist yet on a fresh volume
+    analyze = analyze_task(match_handler, tmp_path / "summaries" / "rides")
+
+    assert analyze([1, 7, None])
+    assert [path.name for path in (tmp_path / "summaries" / "rides").iterdir()] == ["1.json"]
+    summary = json.loads((tmp_path / "summaries" / "rides" / "1.json").read_text())
+    assert summary["track_name"] == "1"
+    assert summary["duration"] == 120
+    # done already, the summary isn't written again
+    assert not analyze([1, 7, None])
+    with pytest.raises(KeyError):
+        analyze([2, 7, None])
+    assert not (tmp_path / "summaries" / "rides" / "2.json").exists()
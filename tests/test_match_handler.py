@@ -0,0 +1,163 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from chase_rank.way_categorizer import VALHALLA_SURFACES, with_match_dtypes
+from chase_rank.wrappers.match_handler import EDGE_COLUMNS, MatchHandler
+from chase_rank.wrappers.valhalla_handler import EDGE_ATTRIBUTES, ValhallaHandler
+
+
+def _match(size: int, seed: int) -> gpd.GeoDataFrame:
+    # a match as ValhallaHandler.match returns it, with a few unmatched points
+    rng = np.random.default_rng(seed)
+    latitudes = 48.78 + np.cumsum(rng.normal(0, 5e-5, size))
+    longitudes = 9.18 + np.cumsum(rng.normal(0, 5e-5, size))
+    surfaces = rng.choice(VALHALLA_SURFACES, size).astype(object)
+    uses = rng.choice(["road", "cycleway", "footway"], size).astype(object)
+    way_ids = rng.integers(seed * 1000, seed * 1000 + 30, size).astype(float)
+    unmatched = rng.random(size) < 0.1
+    surfaces[unmatched] = None
+    uses[unmatched] = None
+    way_ids[unmatched] = np.nan
+
+    match = gpd.GeoDataFrame(
+        {
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "altitude": rng.normal(250, 5, size),
+            "timestamp": pd.Timestamp("2023-05-01 08:00") + pd.to_timedelta(np.arange(size), unit="s"),
+            "distance": rng.uniform(0, 10, size),
+            "match_section": np.repeat([1, 2], [size // 2, size - size // 2]),
+        },
+        geometry=gpd.points_from_xy(longitudes, latitudes),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3857")
+    match.insert(len(match.columns) - 1, "surface", surfaces)
+    match["surface_section"] = (match["surface"] != match["surface"].shift()).cumsum()
+    match["use"] = uses
+    match["osm_way_id"] = way_ids
+    return with_match_dtypes(match)
+
+
+def _track(sections: int, size: int) -> gpd.GeoDataFrame:
+    # a track as TrackHandler stores it, the gaps of a minute between the sections start new match sections
+    latitudes = 48.78 + np.arange(sections * size) * 5e-5
+    longitudes = np.full(sections * size, 9.18)
+    seconds = np.arange(sections * size) + np.repeat(np.arange(sections) * 60, size)
+    return gpd.GeoDataFrame(
+        {
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "altitude": np.full(sections * size, 250.),
+            "timestamp": pd.Timestamp("2023-05-01 08:00") + pd.to_timedelta(seconds, unit="s"),
+        },
+        geometry=gpd.points_from_xy(longitudes, latitudes),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3857")
+
+
+class _FailingValhalla(ValhallaHandler):
+    # matches every point onto one edge and fails on the section fail_at, like a valhalla going away mid track
+
+    def __init__(self, fail_at: int = None):
+        super().__init__()
+        self.fail_at = fail_at
+        self.sections = 0
+
+    def _match_trace(self, section):
+        self.sections += 1
+        if self.sections == self.fail_at:
+            raise RuntimeError("valhalla is down")
+        edges = pd.DataFrame({column: [None] for column in EDGE_ATTRIBUTES})
+        edges["surface"], edges["use"], edges["osm_way_id"] = "asphalt", "road", float(self.sections)
+        return pd.DataFrame({"edge_index": np.zeros(len(section))}), edges
+
+
+def _assert_same_match(result: gpd.GeoDataFrame, expected: gpd.GeoDataFrame):
+    assert len(result) == len(expected)
+    for column in ["latitude", "longitude", "altitude", "distance"]:
+        np.testing.assert_allclose(result[column].values, expected[column].values)
+    np.testing.assert_array_equal(result["timestamp"].values, expected["timestamp"].values)
+    np.testing.assert_array_equal(result["match_section"].values, expected["match_section"].values)
+    np.testing.assert_array_equal(result["osm_way_id"].values, expected["osm_way_id"].values)
+    for column in ["surface", "use"]:
+        assert result[column].dtype == expected[column].dtype
+        pd.testing.assert_series_equal(
+            result[column].reset_index(drop=True), expected[column].reset_index(drop=True), check_names=False)
+    np.testing.assert_array_equal(result["surface_section"].values, expected["surface_section"].values)
+    assert result.crs == expected.crs
+    np.testing.assert_allclose(result.geometry.x.values, expected.geometry.x.values)
+    np.testing.assert_allclose(result.geometry.y.values, expected.geometry.y.values)
+
+
+@pytest.mark.parametrize("normalized", [False, True])
+def test_round_trip(tmp_path, normalized):
+    matches = {activity_id: _match(300, activity_id) for activity_id in (1, 2)}
+    handler = MatchHandler(tmp_path, normalized=normalized)
+    for activity_id, match in matches.items():
+        handler.add(activity_id, match)
+
+    stored = pq.read_schema(tmp_path / "1.parquet").names
+    assert ("edge_id" in stored) == normalized
+    assert all(column in stored for column in EDGE_COLUMNS) != normalized
+
+    # a fresh handler only knows what is on disk
+    reloaded = MatchHandler(tmp_path)
+    assert sorted(reloaded.match_id_list) == [1, 2]
+    for activity_id, match in matches.items():
+        _assert_same_match(reloaded.get(activity_id), match)
+
+
+def test_normalized_edges_are_shared(tmp_path):
+    # two handlers on the same folder, like two workers, each adding edges the other one hasn't seen
+    first = MatchHandler(tmp_path, normalized=True)
+    second = MatchHandler(tmp_path, normalized=True)
+    matches = {activity_id: _match(200, activity_id) for activity_id in range(1, 5)}
+    for activity_id, match in matches.items():
+        (first if activity_id % 2 else second).add(activity_id, match)
+
+    for handler in (first, second, MatchHandler(tmp_path)):
+        for activity_id in matches:
+            # picks up the matches stored by the other handler
+            assert handler.exists(activity_id)
+            _assert_same_match(handler.get(activity_id), matches[activity_id])
+    assert not (tmp_path / "edges.parquet.lock").exists()
+    assert len(MatchHandler(tmp_path).edges) == len(first.edges)
+
+
+def test_normalize_rewrites_wide_matches(tmp_path):
+    wide = MatchHandler(tmp_path)
+    matches = {activity_id: _match(200, activity_id) for activity_id in (3, 4)}
+    for activity_id, match in matches.items():
+        wide.add(activity_id, match)
+
+    MatchHandler(tmp_path, normalized=True).normalize()
+
+    assert "edge_id" in pq.read_schema(tmp_path / "3.parquet").names
+    reloaded = MatchHandler(tmp_path)
+    for activity_id, match in matches.items():
+        _assert_same_match(reloaded.get(activity_id), match)
+
+
+def test_chunked_match_that_fails_leaves_nothing(tmp_path):
+    track_path = tmp_path / "track.parquet"
+    _track(4, 50).to_parquet(track_path)
+    matches = tmp_path / "matches"
+    matches.mkdir()
+
+    with pytest.raises(RuntimeError):
+        MatchHandler(matches).add_chunked(1, track_path, _FailingValhalla(fail_at=3), batch_size=60)
+    assert list(matches.iterdir()) == []
+    assert not MatchHandler(matches).exists(1)
+
+    handler = MatchHandler(matches)
+    assert handler.add_chunked(1, track_path, _FailingValhalla(), batch_size=60)
+    stored = (matches / "1.parquet").read_bytes()
+    assert sorted(handler.get(1)["osm_way_id"].unique()) == [1., 2., 3., 4.]
+    # a rematch failing part way keeps the earlier match
+    with pytest.raises(RuntimeError):
+        handler.add_chunked(1, track_path, _FailingValhalla(fail_at=2), batch_size=60)
+    assert [path.name for path in matches.iterdir()] == ["1.parquet"]
+    assert (matches / "1.parquet").read_bytes() == stored
@@ -0,0 +1,74 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+from chase_rank.pipeline import Pipeline, Stage
+
+
+def _double(item: int) -> (int, None):
+    # fails on 3 and drops 5
+    if item == 3:
+        raise ValueError("broken activity")
+    if item == 5:
+        return None
+    return item * 2
+
+
+def _pipeline_threads() -> list:
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-") and thread.is_alive()]
+
+
+def test_needs_a_stage():
+    with pytest.raises(ValueError):
+        Pipeline([])
+
+
+def test_failed_items_dont_stop_the_run():
+    pipeline = Pipeline([
+        Stage("double", _double, concurrency=3, buffer_size=2),
+        Stage("increment", lambda item: item + 1, concurrency=2, buffer_size=1),
+    ])
+    results = list(pipeline.run(range(20)))
+
+    assert sorted(results) == [item * 2 + 1 for item in range(20) if item not in (3, 5)]
+    assert [(stage, item, type(error)) for stage, item, error in pipeline.errors] == [("double", 3, ValueError)]
+    counts = pipeline.report()[["items_in", "items_out", "items_failed", "items_dropped"]]
+    assert counts.loc["double"].tolist() == [20, 18, 1, 1]
+    assert counts.loc["increment"].tolist() == [18, 18, 0, 0]
+    assert not _pipeline_threads()
+
+
+def test_failing_source_ends_the_stream():
+    def source():
+        yield from range(3)
+        raise ConnectionError("strava is down")
+
+    pipeline = Pipeline([Stage("double", _double)])
+    assert sorted(pipeline.run(source())) == [0, 2, 4]
+    assert [(stage, type(error)) for stage, _, error in pipeline.errors] == [("source", ConnectionError)]
+
+
+def test_stopping_early_stops_every_stage():
+    def slow(item: int) -> int:
+        time.sleep(0.01)
+        return item
+
+    pipeline = Pipeline([
+        Stage("slow", slow, concurrency=2, buffer_size=2),
+        Stage("same", lambda item: item, buffer_size=1),
+    ])
+    # the source never ends, every queue is full once the consumer stops
+    run = pipeline.run(itertools.count())
+    results = [next(run) for _ in range(5)]
+    assert len(set(results)) == 5
+
+    closing = threading.Thread(target=run.close)
+    closing.start()
+    closing.join(timeout=5.)
+    assert not closing.is_alive()
+    assert not _pipeline_threads()
+    report = pipeline.report()
+    assert report.loc["slow", "items_in"] < 20
+    assert (report["items_failed"] == 0).all()
@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from chase_rank.process import get_section_analytics
+
+
+def _section_analytics_loop(gpx_frame: pd.DataFrame) -> pd.DataFrame:
+    # the implementation get_section_analytics replaced, one group and one point at a time
+    last_time = None
+    section_dict = {
+        "section": [],
+        "paused_time": [],
+        "total_asc": [],
+        "total_desc": [],
+        "total_distance": [],
+        "arg_kph": [],
+        "distance_between_stops": []
+    }
+    for index, group in gpx_frame.groupby(gpx_frame["section"]):
+        paused_time = group.iloc[0]["time"] - last_time if last_time else timedelta(days=0)
+        last_time = group.iloc[-1]["time"]
+        section_dict["section"].append(index)
+        section_dict["paused_time"].append(paused_time)
+
+        total_asc = 0
+        total_desc = 0
+        for i in range(0, len(group) - 1):
+            diff = group.iloc[i + 1]["elev"] - group.iloc[i]["elev"]
+            if diff >= 0:
+                total_asc = total_asc + diff
+            elif diff <= 0:
+                total_desc = total_desc + diff
+        section_dict["total_asc"].append(round(total_asc, 2))
+        section_dict["total_desc"].append(round(total_desc, 2))
+
+        distance = group["distance"].sum()
+        section_dict["total_distance"].append(round(distance, 2))
+        section_dict["arg_kph"].append(round(distance / len(group) * 3.6, 2))
+        section_dict["distance_between_stops"].append(group.iloc[-1]["distance"])
+    return pd.DataFrame(data=section_dict)
+
+
+def _points(size: int, seed: int, shuffle_sections: bool = False) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # pauses of a few minutes every now and then start a new section, like match.load_gpx labels them
+    steps = np.where(rng.random(size) < 0.02, rng.integers(10, 600, size), 1)
+    times = pd.Timestamp("2023-05-01 08:00") + pd.to_timedelta(np.cumsum(steps), unit="s")
+    sections = np.cumsum(steps != 1)
+    elevations = 300 + np.cumsum(rng.normal(0, 0.5, size)).round(1)
+    elevations[rng.random(size) < 0.01] = np.nan
+    frame = pd.DataFrame({
+        "time": times,
+        "section": sections,
+        "elev": elevations,
+        "distance": rng.uniform(0, 12, size).round(3),
+    })
+    if shuffle_sections:
+        # sections out of order, points inside a section keep theirs
+        order = rng.permutation(sections.max() + 1)
+        frame = pd.concat([frame[frame["section"] == section] for section in order], ignore_index=True)
+    return frame
+
+
+@pytest.mark.parametrize("size, seed, shuffle_sections", [
+    (1, 0, False),
+    (2, 1, False),
+    (500, 2, False),
+    (2000, 3, False),
+    (800, 4, True),
+])
+def test_same_as_loop(size, seed, shuffle_sections):
+    points = _points(size, seed, shuffle_sections)
+    expected = _section_analytics_loop(points)
+    result = get_section_analytics(points)
+
+    assert list(result.columns) == list(expected.columns)
+    np.testing.assert_array_equal(result["section"].values, expected["section"].values)
+    np.testing.assert_array_equal(
+        result["paused_time"].values, pd.to_timedelta(expected["paused_time"]).values)
+    for column in ["total_asc", "total_desc", "total_distance", "arg_kph", "distance_between_stops"]:
+        np.testing.assert_allclose(result[column].values, expected[column].values.astype(float), atol=0.011)
+
+
+def test_empty_frame():
+    points = _points(10, 5).iloc[:0]
+    result = get_section_analytics(points)
+
+    assert len(result) == 0
+    assert list(result.columns) == list(_section_analytics_loop(_points(10, 5)).columns)
+    assert result["paused_time"].dtype == "timedelta64[ns]"
+    assert result["total_distance"].dtype == np.float64